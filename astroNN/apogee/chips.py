@@ -216,15 +216,37 @@ def continuum(spectra, spectra_err, cont_mask, deg=2):
     """
     spectra = np.atleast_2d(np.array(spectra))
     spectra_err = np.atleast_2d(np.array(spectra_err))
-    flux_ivars = 1 / (np.square(np.array(spectra_err)) + 1e-8)  # for numerical stability
+    # only the pixels in continuum mask are needed for fitting
+    flux_ivars = 1 / (np.square(spectra_err[:, cont_mask]) + 1e-8)  # for numerical stability
 
+    # The continuum mask and the pixel grid are shared by all spectra, so is the Chebyshev design matrix. Pixels are
+    # mapped from the domain of the masked pixels to [-1, 1] the same way as np.polynomial.chebyshev.Chebyshev.fit
     pix_element = np.arange(spectra.shape[1])  # Array with size spectra
-
-    for counter, (spectrum, spectrum_err, flux_ivar) in enumerate(zip(spectra, spectra_err, flux_ivars)):
-        fit = np.polynomial.chebyshev.Chebyshev.fit(x=np.arange(spectrum.shape[0])[cont_mask], y=spectrum[cont_mask],
-                                                    w=flux_ivar[cont_mask], deg=deg)
-        spectra[counter] = spectrum / fit(pix_element)
-        spectra_err[counter] = spectrum_err / fit(pix_element)
+    cont_pix = pix_element[cont_mask]
+    pix_mapped = 2. * (pix_element - cont_pix.min()) / (cont_pix.max() - cont_pix.min()) - 1.
+    design = np.polynomial.chebyshev.chebvander(pix_mapped, deg)  # shape (pixels, deg + 1)
+    cont_design = design[cont_mask]
+
+    # Batched weighted least squares with the normal equations, weights multiply the residuals as in Chebyshev.fit
+    weights_sq = np.square(flux_ivars)
+    outer_design = (cont_design[:, :, None] * cont_design[:, None, :]).reshape(cont_design.shape[0], -1)
+    lhs = (weights_sq @ outer_design).reshape(-1, deg + 1, deg + 1)
+    rhs = (weights_sq * spectra[:, cont_mask]) @ cont_design
+
+    # scale the columns to improve the condition number of the normal equations
+    scl = np.sqrt(np.einsum('nii->ni', lhs))
+    scl[scl == 0.] = 1.
+    lhs /= scl[:, :, None] * scl[:, None, :]
+    rhs /= scl
+    try:
+        coeffs = np.linalg.solve(lhs, rhs[:, :, None])[:, :, 0] / scl
+    except np.linalg.LinAlgError:
+        # singular system for some spectra, fallback to least square solutions one by one
+        coeffs = np.stack([np.linalg.lstsq(_lhs, _rhs, rcond=None)[0] for _lhs, _rhs in zip(lhs, rhs)]) / scl
+
+    fit = coeffs @ design.T
+    spectra /= fit
+    spectra_err /= fit
 
     return spectra, spectra_err
 
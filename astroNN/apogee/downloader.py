@@ -8,18 +8,37 @@ import urllib.request
 
 import numpy as np
 from astroNN.apogee.apogee_shared import apogee_env, apogee_default_dr
-from astroNN.shared.downloader_tools import TqdmUpTo, filehash
+from astroNN.shared.downloader_tools import TqdmUpTo, bulk_download, cached_filehash, hash_manifest, \
+    manifest_lookup
 from astropy.io import fits
 
 currentdir = os.getcwd()
 
 # global var
 warning_flag = False
-_ALLSTAR_TEMP = {}
+_SAS_URL = 'https://data.sdss.org/sas'
+_ALLSTAR_INDEX = {}  # index of allStar of every DR
 __apogee_credentials_username = None
 __apogee_credentials_pw = None
 
 
+def __apogee_credentials():
+    """
+    Username and password of APOGEE proprietary data, this function will prompt for them once
+
+    :return: (username, password)
+    :rtype: tuple
+    """
+    global __apogee_credentials_username
+    global __apogee_credentials_pw
+    if __apogee_credentials_username is None:
+        print("You are trying to access APOGEE proprietary data...Please provide username and password...")
+        print("You are trying to access APOGEE proprietary data...Please provide username and password...")
+        __apogee_credentials_username = input('Username: ')
+        __apogee_credentials_pw = getpass.getpass('Password: ')
+    return __apogee_credentials_username, __apogee_credentials_pw
+
+
 def __apogee_credentials_downloader(url, fullfilename):
     """
     Download file at the URL with apogee credentials, this function will prompt for username and password
@@ -32,14 +51,7 @@ def __apogee_credentials_downloader(url, fullfilename):
     :History: 2018-Aug-31 - Written - Henry Leung (University of Toronto)
     """
     passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-    global __apogee_credentials_username
-    global __apogee_credentials_pw
-    if __apogee_credentials_username is None:
-        print("You are trying to access APOGEE proprietary data...Please provide username and password...")
-        print("You are trying to access APOGEE proprietary data...Please provide username and password...")
-        __apogee_credentials_username = input('Username: ')
-        __apogee_credentials_pw = getpass.getpass('Password: ')
-    passman.add_password(None, url, __apogee_credentials_username, __apogee_credentials_pw)
+    passman.add_password(None, url, *__apogee_credentials())
     authhandler = urllib.request.HTTPBasicAuthHandler(passman)
     opener = urllib.request.build_opener(authhandler)
     urllib.request.install_opener(opener)
@@ -107,8 +119,8 @@ def allstar(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm='sha1')
-        if checksum != file_hash.lower():
+        checksum = cached_filehash(fullfilename, algorithm='sha1')
+        if checksum is not None and checksum != file_hash.lower():
             print('File corruption detected, astroNN attempting to download again')
             allstar(dr=dr, flag=1)
         else:
@@ -120,7 +132,7 @@ def allstar(dr=None, flag=None):
             try:
                 urllib.request.urlretrieve(url, fullfilename, reporthook=t.update_to)
                 print(f'Downloaded DR{dr:d} allStar file catalog successfully to {fullfilename}')
-                checksum = filehash(fullfilename, algorithm='sha1')
+                checksum = cached_filehash(fullfilename, algorithm='sha1', policy='always')
                 if checksum != file_hash.lower():
                     print('File corruption detected, astroNN attempting to download again')
                     allstar(dr=dr, flag=1)
@@ -167,8 +179,8 @@ def allstarcannon(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm='sha1')
-        if checksum != file_hash.lower():
+        checksum = cached_filehash(fullfilename, algorithm='sha1')
+        if checksum is not None and checksum != file_hash.lower():
             print('File corruption detected, astroNN attempting to download again')
             allstarcannon(dr=dr, flag=1)
         else:
@@ -179,7 +191,7 @@ def allstarcannon(dr=None, flag=None):
         with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=url.split('/')[-1]) as t:
             urllib.request.urlretrieve(url, fullfilename, reporthook=t.update_to)
             print(f'Downloaded DR{dr:d} allStarCannon file catalog successfully to {fullfilename}')
-            checksum = filehash(fullfilename, algorithm='sha1')
+            checksum = cached_filehash(fullfilename, algorithm='sha1', policy='always')
             if checksum != file_hash.lower():
                 print('File corruption detected, astroNN attempting to download again')
                 allstarcannon(dr=dr, flag=1)
@@ -226,8 +238,8 @@ def allvisit(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm='sha1')
-        if checksum != file_hash.lower():
+        checksum = cached_filehash(fullfilename, algorithm='sha1')
+        if checksum is not None and checksum != file_hash.lower():
             print('File corruption detected, astroNN attempting to download again')
             allvisit(dr=dr, flag=1)
         else:
@@ -236,7 +248,7 @@ def allvisit(dr=None, flag=None):
         with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=url.split('/')[-1]) as t:
             urllib.request.urlretrieve(url, fullfilename, reporthook=t.update_to)
             print(f'Downloaded DR{dr:d} allVisit file catalog successfully to {fullfilepath}')
-            checksum = filehash(fullfilename, algorithm='sha1')
+            checksum = cached_filehash(fullfilename, algorithm='sha1', policy='always')
             if checksum != file_hash.lower():
                 print('File corruption detected, astroNN attempting to download again')
                 allstar(dr=dr, flag=1)
@@ -244,6 +256,144 @@ def allvisit(dr=None, flag=None):
     return fullfilename
 
 
+def _fits_str_column(data, name):
+    """
+    String column of FITS table as unicode array without trailing spaces
+    """
+    column = np.asarray(data[name])
+    if column.dtype.kind == 'S':
+        column = np.char.decode(column, 'ascii')
+    return np.char.strip(column)
+
+
+def _load_allstar_index(allstar_path):
+    """
+    Load the index of allStar from the file persisted next to allStar, or build and persist it if it does not exist or
+    allStar is modified. The index file is written atomically so it can be shared by processes.
+
+    :param allstar_path: full file name of allStar
+    :type allstar_path: str
+    :return: dictionary of row of APOGEE_ID and (APOGEE_ID, TELESCOPE), and columns LOCATION_ID, FIELD, TELESCOPE
+    :rtype: dict
+    """
+    index_path = f'{os.path.splitext(allstar_path)[0]}_index.npz'
+    allstar_stat = os.stat(allstar_path)
+    column_names = ('APOGEE_ID', 'TELESCOPE', 'LOCATION_ID', 'FIELD')
+
+    columns = None
+    if os.path.isfile(index_path):
+        try:
+            with np.load(index_path) as f:
+                if int(f['size']) == allstar_stat.st_size and int(f['mtime_ns']) == allstar_stat.st_mtime_ns:
+                    columns = {name: f[name] for name in column_names}
+        except (OSError, ValueError, KeyError):  # corrupted index is built again
+            pass
+
+    if columns is None:
+        data = fits.getdata(allstar_path)
+        columns = {name: _fits_str_column(data, name) for name in ('APOGEE_ID', 'TELESCOPE', 'FIELD')}
+        columns['LOCATION_ID'] = np.asarray(data['LOCATION_ID'])
+        temp_path = f'{index_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, size=allstar_stat.st_size, mtime_ns=allstar_stat.st_mtime_ns, **columns)
+            os.replace(temp_path, index_path)
+        except OSError:  # index is still usable in this process if the folder is read-only
+            pass
+
+    # first row of every star as what a search from the beginning would find
+    rows = {}
+    for row, (apogee, telescope) in enumerate(zip(columns['APOGEE_ID'].tolist(), columns['TELESCOPE'].tolist())):
+        rows.setdefault(apogee, row)
+        rows.setdefault((apogee, telescope), row)
+    return {'rows': rows, **columns}
+
+
+def _allstar_lookup(dr, apogee, telescope=None):
+    """
+    Find location ID, field and telescope of a star from the index of allStar
+
+    :param dr: APOGEE DR
+    :type dr: int
+    :param apogee: Apogee ID
+    :type apogee: str
+    :param telescope: Telescope ID, for example 'apo25m' or 'lco25m'
+    :type telescope: str
+    :return: location ID, field and telescope
+    :rtype: tuple
+    """
+    global _ALLSTAR_INDEX
+    if not str(f'dr{dr}') in _ALLSTAR_INDEX:
+        _ALLSTAR_INDEX[f'dr{dr}'] = _load_allstar_index(allstar(dr=dr))
+    index = _ALLSTAR_INDEX[f'dr{dr}']
+
+    row = index['rows'].get(apogee if telescope is None else (apogee, telescope))
+    if row is None:
+        raise ValueError(f"No entry found in allstar DR{dr} met with your requirement!!")
+    return index['LOCATION_ID'][row], index['FIELD'][row], index['TELESCOPE'][row]
+
+
+def _combined_spectra_info(dr, location, field, apogee, telescope):
+    """
+    Folder relative to SAS (the same relative to local mirror), file name, hash file name (None if not available) and
+    name of the file in hash file of combined spectra
+    """
+    if dr == 13:
+        reduce_prefix = 'r6'
+        aspcap_code = 'l30e'
+        folder = f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/{location}'
+        filename = f'aspcapStar-{reduce_prefix}-{aspcap_code}.2-{apogee}.fits'
+        hash_filename = f'stars_{aspcap_code}_{aspcap_code}.2_{location}.sha1sum'
+    elif dr == 14:
+        reduce_prefix = 'r8'
+        aspcap_code = 'l31c'
+        folder = f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/{location}'
+        filename = f'aspcapStar-{reduce_prefix}-{aspcap_code}.2-{apogee}.fits'
+        hash_filename = f'stars_{aspcap_code}_{aspcap_code}.2_{location}.sha1sum'
+    elif dr == 16:
+        reduce_prefix = 'r10'
+        aspcap_code = 'l31c'
+        folder = f'apogeework/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}/{field}'
+        filename = f'aspcapStar-{reduce_prefix}-{apogee}.fits'
+        hash_filename = None
+    else:
+        raise ValueError('combined_spectra() only supports DR13-DR16')
+    return folder, filename, hash_filename, filename
+
+
+def _visit_spectra_info(dr, location, field, apogee, telescope, commission=False):
+    """
+    Folder relative to SAS (the same relative to local mirror), file name, hash file name (None if not available) and
+    name of the file in hash file of visit spectra
+    """
+    if dr == 13 or dr == 14:
+        reduce_prefix = 'r6' if dr == 13 else 'r8'
+        folder = f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/{location}'
+        if commission:
+            filename = f'apStarC-{reduce_prefix}-{apogee}.fits'
+        else:
+            filename = f'apStar-{reduce_prefix}-{apogee}.fits'
+        hash_filename = f'{reduce_prefix}_stars_apo25m_{location}.sha1sum'
+    elif dr == 16:
+        reduce_prefix = 'r12'
+        folder = f'apogeework/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/{field}'
+        if telescope == 'lco25m':
+            if commission:
+                filename = f'asStarC-{reduce_prefix}-{apogee}.fits'
+            else:
+                filename = f'asStar-{reduce_prefix}-{apogee}.fits'
+        else:
+            if commission:
+                filename = f'apStarC-{reduce_prefix}-{apogee}.fits'
+            else:
+                filename = f'apStar-{reduce_prefix}-{apogee}.fits'
+        hash_filename = None
+    else:
+        raise ValueError('visit_spectra() only supports DR13-DR16')
+    # visit spectra has a different filename in checksum
+    return folder, filename, hash_filename, f'apStar-{reduce_prefix}-{apogee}.fits'
+
+
 def combined_spectra(dr=None, location=None, field=None, apogee=None, telescope=None, verbose=1, flag=None):
     """
     Download the required combined spectra file a.k.a aspcapStar
@@ -272,85 +422,20 @@ def combined_spectra(dr=None, location=None, field=None, apogee=None, telescope=
     dr = apogee_default_dr(dr=dr)
 
     if location is None and field is None:  # for DR16=<, location is expected to be none because field is used
-        global _ALLSTAR_TEMP
-        if not str(f'dr{dr}') in _ALLSTAR_TEMP:
-            _ALLSTAR_TEMP[f'dr{dr}'] = fits.getdata(allstar(dr=dr))
-        if telescope is None:
-            matched_idx = [np.nonzero(_ALLSTAR_TEMP[f'dr{dr}']['APOGEE_ID'] == apogee)[0]][0]
-        else:
-            matched_idx = [np.nonzero([(_ALLSTAR_TEMP[f'dr{dr}']['APOGEE_ID'] == apogee) &
-                                       (_ALLSTAR_TEMP[f'dr{dr}']['TELESCOPE'] == telescope)])][0][1]
-        if len(matched_idx) == 0:
-            raise ValueError(f"No entry found in allstar DR{dr} met with your requirement!!")
-
-        location = _ALLSTAR_TEMP[f'dr{dr}']['LOCATION_ID'][matched_idx][0]
-        field = _ALLSTAR_TEMP[f'dr{dr}']['FIELD'][matched_idx][0]
-        telescope = _ALLSTAR_TEMP[f'dr{dr}']['TELESCOPE'][matched_idx][0]
-
-    if dr == 13:
-        reduce_prefix = 'r6'
-        aspcap_code = 'l30e'
-        str1 = f'https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/{location}/'
-
-        filename = f'aspcapStar-{reduce_prefix}-{aspcap_code}.2-{apogee}.fits'
-        hash_filename = f'stars_{aspcap_code}_{aspcap_code}.2_{location}.sha1sum'
-        urlstr = str1 + filename
-
-        # check folder existence
-        fullfoldername = os.path.join(apogee_env(),
-                                      f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/',
-                                      str(location))
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+        location, field, telescope = _allstar_lookup(dr, apogee, telescope)
 
-        fullfilename = os.path.join(apogee_env(),
-                                    f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/',
-                                    str(location),
-                                    filename)
-    elif dr == 14:
-        reduce_prefix = 'r8'
-        aspcap_code = 'l31c'
-        str1 = f'https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/{location}/'
+    folder, filename, hash_filename, hash_name = _combined_spectra_info(dr, location, field, apogee, telescope)
+    str1 = f'{_SAS_URL}/{folder}/'
+    urlstr = str1 + filename
 
-        filename = f'aspcapStar-{reduce_prefix}-{aspcap_code}.2-{apogee}.fits'
-        hash_filename = f'stars_{aspcap_code}_{aspcap_code}.2_{location}.sha1sum'
-        urlstr = str1 + filename
-
-        # check folder existence
-        fullfoldername = os.path.join(apogee_env(),
-                                      f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/',
-                                      str(location))
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-        fullfilename = os.path.join(apogee_env(),
-                                    f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/',
-                                    str(location),
-                                    filename)
-    elif dr == 16:
-        reduce_prefix = 'r10'
-        aspcap_code = 'l31c'
-        str1 = f'https://data.sdss.org/sas/apogeework/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}/{field}/'
-
-        filename = f'aspcapStar-{reduce_prefix}-{apogee}.fits'
-        hash_filename = f'stars_{reduce_prefix}_{reduce_prefix}.2_{location}.sha1sum'
-        urlstr = str1 + filename
-
-        # check folder existence
-        fullfoldername = os.path.join(apogee_env(),
-                                      f'apogeework/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}',
-                                      str(f'{field}'))
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-        fullfilename = os.path.join(apogee_env(),
-                                    f'apogeework/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}',
-                                    str(f'{field}'), filename)
-    else:
-        raise ValueError('combined_spectra() only supports DR13-DR16')
+    # check folder existence
+    fullfoldername = os.path.join(apogee_env(), folder)
+    if not os.path.exists(fullfoldername):
+        os.makedirs(fullfoldername)
+    fullfilename = os.path.join(fullfoldername, filename)
 
     # check hash file
-    if dr != 16:
+    if hash_filename is not None:
         full_hash_filename = os.path.join(fullfoldername, hash_filename)
         if not os.path.isfile(full_hash_filename):
             # return warning flag if the location_id cannot even be found
@@ -360,17 +445,14 @@ def combined_spectra(dr=None, location=None, field=None, apogee=None, telescope=
                 return warning_flag
             urllib.request.urlretrieve(str1 + hash_filename, full_hash_filename)
 
-        hash_list = np.loadtxt(full_hash_filename, dtype='str').T
+        # In some rare case, the hash cant be found, so during checking, check file_hash is not None too
+        file_hash = manifest_lookup(hash_manifest(full_hash_filename), hash_name)
     else:
-        # just a dummy list
-        hash_list = np.array([np.array(['yyy', 'yyy', 'yyy']), np.array(['zzz', 'zzz', 'zzz'])])
-
-    # In some rare case, the hash cant be found, so during checking, check len(file_has)!=0 too
-    file_hash = hash_list[0][np.argwhere(hash_list[1] == filename)]
+        file_hash = None
 
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm='sha1')
-        if checksum != file_hash and len(file_hash) != 0:
+        checksum = cached_filehash(fullfilename, algorithm='sha1')
+        if checksum is not None and file_hash is not None and checksum != file_hash:
             print('File corruption detected, astroNN attempting to download again')
             combined_spectra(dr=dr, location=location, apogee=apogee, verbose=verbose, flag=1)
 
@@ -381,8 +463,8 @@ def combined_spectra(dr=None, location=None, field=None, apogee=None, telescope=
         try:
             urllib.request.urlretrieve(urlstr, fullfilename)
             print(f'Downloaded DR{dr} combined file successfully to {fullfilename}')
-            checksum = filehash(fullfilename, algorithm='sha1')
-            if checksum != file_hash and len(file_hash) != 0:
+            checksum = cached_filehash(fullfilename, algorithm='sha1', policy='always')
+            if file_hash is not None and checksum != file_hash:
                 print('File corruption detected, astroNN attempting to download again')
                 combined_spectra(dr=dr, location=location, apogee=apogee, verbose=verbose, flag=1)
         except urllib.request.HTTPError as emsg:
@@ -429,67 +511,20 @@ def visit_spectra(dr=None, location=None, field=None, apogee=None, telescope=Non
     dr = apogee_default_dr(dr=dr)
 
     if location is None and field is None:  # for DR16=<, location is expected to be none because field is used
-        global _ALLSTAR_TEMP
-        if not str(f'dr{dr}') in _ALLSTAR_TEMP:
-            _ALLSTAR_TEMP[f'dr{dr}'] = fits.getdata(allstar(dr=dr))
-        if telescope is None:
-            matched_idx = [np.nonzero(_ALLSTAR_TEMP[f'dr{dr}']['APOGEE_ID'] == apogee)[0]][0]
-        else:
-            matched_idx = [np.nonzero([(_ALLSTAR_TEMP[f'dr{dr}']['APOGEE_ID'] == apogee) &
-                                       (_ALLSTAR_TEMP[f'dr{dr}']['TELESCOPE'] == telescope)])][0][1]
-        if len(matched_idx) == 0:
-            raise ValueError(f"No entry found in allstar DR{dr} met with your requirement!!")
-
-        location = _ALLSTAR_TEMP[f'dr{dr}']['LOCATION_ID'][matched_idx][0]
-        field = _ALLSTAR_TEMP[f'dr{dr}']['FIELD'][matched_idx][0]
-        telescope = _ALLSTAR_TEMP[f'dr{dr}']['TELESCOPE'][matched_idx][0]
-
-    if dr == 13:
-        reduce_prefix = 'r6'
-        str1 = f'https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/{location}/'
-        if commission:
-            filename = f'apStarC-{reduce_prefix}-{apogee}.fits'
-        else:
-            filename = f'apStar-{reduce_prefix}-{apogee}.fits'
-        urlstr = str1 + filename
-        hash_filename = f'{reduce_prefix}_stars_apo25m_{location}.sha1sum'
-
-        fullfoldername = os.path.join(apogee_env(), f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/',
-                                      str(location))
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-        # check hash file
-        full_hash_filename = os.path.join(fullfoldername, hash_filename)
-        if not os.path.isfile(full_hash_filename):
-            # return warning flag if the location_id cannot even be found
-            try:
-                urllib.request.urlopen(str1)
-            except urllib.request.HTTPError:
-                return warning_flag
-            urllib.request.urlretrieve(str1 + hash_filename, full_hash_filename)
-
-        hash_list = np.loadtxt(full_hash_filename, dtype='str').T
-
-        fullfilename = os.path.join(apogee_env(), f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/',
-                                    str(location), filename)
+        location, field, telescope = _allstar_lookup(dr, apogee, telescope)
 
-    elif dr == 14:
-        reduce_prefix = 'r8'
-        str1 = f'https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/{location}/'
-        if commission:
-            filename = f'apStarC-{reduce_prefix}-{apogee}.fits'
-        else:
-            filename = f'apStar-{reduce_prefix}-{apogee}.fits'
-        urlstr = str1 + filename
-        hash_filename = f'{reduce_prefix}_stars_apo25m_{location}.sha1sum'
+    folder, filename, hash_filename, hash_name = _visit_spectra_info(dr, location, field, apogee, telescope,
+                                                                     commission=commission)
+    str1 = f'{_SAS_URL}/{folder}/'
+    urlstr = str1 + filename
 
-        fullfoldername = os.path.join(apogee_env(), f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/',
-                                      str(location))
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+    fullfoldername = os.path.join(apogee_env(), folder)
+    if not os.path.exists(fullfoldername):
+        os.makedirs(fullfoldername)
+    fullfilename = os.path.join(fullfoldername, filename)
 
-        # check hash file
+    # check hash file
+    if hash_filename is not None:
         full_hash_filename = os.path.join(fullfoldername, hash_filename)
         if not os.path.isfile(full_hash_filename):
             # return warning flag if the location_id cannot even be found
@@ -499,63 +534,15 @@ def visit_spectra(dr=None, location=None, field=None, apogee=None, telescope=Non
                 return warning_flag
             urllib.request.urlretrieve(str1 + hash_filename, full_hash_filename)
 
-        hash_list = np.loadtxt(full_hash_filename, dtype='str').T
-
-        fullfilename = os.path.join(apogee_env(), f'dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/',
-                                    str(location), filename)
-
-    elif dr == 16:
-        reduce_prefix = 'r12'
-        str1 = f'https://data.sdss.org/sas/apogeework/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/{field}/'
-        if telescope == 'lco25m':
-            if commission:
-                filename = f'asStarC-{reduce_prefix}-{apogee}.fits'
-            else:
-                filename = f'asStar-{reduce_prefix}-{apogee}.fits'
-        else:
-            if commission:
-                filename = f'apStarC-{reduce_prefix}-{apogee}.fits'
-            else:
-                filename = f'apStar-{reduce_prefix}-{apogee}.fits'
-        urlstr = str1 + filename
-        hash_filename = f'{reduce_prefix}_stars_apo25m_{location}.sha1sum'
-
-        fullfoldername = os.path.join(apogee_env(),
-                                      f'apogeework/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/',
-                                      str(f'{field}'))
-
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-        # # check hash file
-        # full_hash_filename = os.path.join(fullfoldername, hash_filename)
-        # if not os.path.isfile(full_hash_filename):
-        #     # return warning flag if the location_id cannot even be found
-        #     try:
-        #         urllib.request.urlopen(str1)
-        #     except urllib.request.HTTPError:
-        #         return warning_flag
-        #     urllib.request.urlretrieve(str1 + hash_filename, full_hash_filename)
-        #
-        # hash_list = np.loadtxt(full_hash_filename, dtype='str').T
-        hash_list = np.array([np.array(['yyy', 'yyy', 'yyy']), np.array(['zzz', 'zzz', 'zzz'])])
-
-        fullfilename = os.path.join(apogee_env(),
-                                    f'apogeework/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/',
-                                    str(f'{field}'), filename)
-
+        # In some rare case, the hash cant be found, so during checking, check file_hash is not None too
+        file_hash = manifest_lookup(hash_manifest(full_hash_filename), hash_name)
     else:
-        raise ValueError('visit_spectra() only supports DR13-DR16')
+        file_hash = None
 
-    # In some rare case, the hash cant be found, so during checking, check len(file_has)!=0 too
-    # visit spectra has a different filename in checksum
-    # handle the case where apogee_id cannot be found
-    hash_idx = [i for i, item in enumerate(hash_list[1]) if f'apStar-{reduce_prefix}-{apogee}' in item]
-    file_hash = hash_list[0][hash_idx]
 
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm='sha1')
-        if checksum != file_hash and len(file_hash) != 0:
+        checksum = cached_filehash(fullfilename, algorithm='sha1')
+        if checksum is not None and file_hash is not None and checksum != file_hash:
             print('File corruption detected, astroNN attempting to download again')
             visit_spectra(dr=dr, location=location, apogee=apogee, verbose=verbose, flag=1)
 
@@ -566,8 +553,8 @@ def visit_spectra(dr=None, location=None, field=None, apogee=None, telescope=Non
         try:
             urllib.request.urlretrieve(urlstr, fullfilename)
             print(f'Downloaded DR{dr} individual visit file successfully to {fullfilename}')
-            checksum = filehash(fullfilename, algorithm='sha1')
-            if checksum != file_hash and len(file_hash) != 0:
+            checksum = cached_filehash(fullfilename, algorithm='sha1', policy='always')
+            if file_hash is not None and checksum != file_hash:
                 print('File corruption detected, astroNN attempting to download again')
                 visit_spectra(dr=dr, location=location, apogee=apogee, verbose=verbose, flag=1)
         except urllib.request.HTTPError as emsg:
@@ -583,6 +570,88 @@ def visit_spectra(dr=None, location=None, field=None, apogee=None, telescope=Non
     return fullfilename
 
 
+def bulk_spectra(targets, dr=None, kind='combined', commission=False, max_workers=8, retries=3, backoff=1.,
+                 manifest=None, verbose=1, flag=None, base_url=None, auth=None):
+    """
+    | Download many combined spectra (aspcapStar) or visit spectra (apStar/asStar) concurrently over keep-alive
+    | connections with retry, checksum verification and a resumable manifest, see
+    | ``astroNN.shared.downloader_tools.bulk_download``
+    |
+    | Hash files are downloaded once for every location, stars without location (or field for DR16) are looked up
+    | in allStar. DR16 spectra are APOGEE proprietary data, username and password are prompted for if auth is None
+
+    :param targets: List of (apogee ID, location ID for DR13-14 or field for DR16 or None, telescope or None)
+    :type targets: list
+    :param dr: APOGEE DR
+    :type dr: int
+    :param kind: 'combined' for combined spectra or 'visit' for visit spectra
+    :type kind: str
+    :param commission: whether the visit spectra are taken during commissioning
+    :type commission: bool
+    :param max_workers: Maximum number of concurrent downloads
+    :type max_workers: int
+    :param retries: Maximum number of retries of a file
+    :type retries: int
+    :param backoff: Wait backoff * 2 ** (retry - 1) seconds before a retry
+    :type backoff: float
+    :param manifest: File name of the manifest to resume from and record downloaded files, None to not use manifest
+    :type manifest: Union[NoneType, str]
+    :param verbose: verbose, set 0 to silent most logging
+    :type verbose: int
+    :param flag: 0: normal, 1: force to re-download
+    :type flag: int
+    :param base_url: URL of SAS, default to https://data.sdss.org/sas
+    :type base_url: Union[NoneType, str]
+    :param auth: (username, password) for APOGEE proprietary data, only used for DR16
+    :type auth: Union[NoneType, tuple]
+    :return: list of full file path, False if cannot be found on server or wrong username or password
+    :rtype: list
+    """
+    dr = apogee_default_dr(dr=dr)
+    base_url = _SAS_URL if base_url is None else base_url.rstrip('/')
+    if kind == 'combined':
+        info_func = _combined_spectra_info
+    elif kind == 'visit':
+        def info_func(*args):
+            return _visit_spectra_info(*args, commission=commission)
+    else:
+        raise ValueError(f"Unknown kind -> {kind}, only 'combined' and 'visit' are supported")
+    if dr != 16:
+        auth = None
+    elif auth is None:
+        auth = __apogee_credentials()
+
+    infos = []
+    for apogee, location_or_field, telescope in targets:
+        if location_or_field is None:
+            location, field, telescope = _allstar_lookup(dr, apogee, telescope)
+        elif dr == 16:
+            location, field = None, location_or_field
+        else:
+            location, field = location_or_field, None
+        infos.append(info_func(dr, location, field, apogee, telescope))
+
+    # hash files of every folder first
+    hash_jobs = {folder: (f'{base_url}/{folder}/{hash_filename}',
+                          os.path.join(apogee_env(), folder, hash_filename), None)
+                 for folder, filename, hash_filename, hash_name in infos if hash_filename is not None}
+    hash_jobs = [job for job in hash_jobs.values() if not os.path.isfile(job[1])]
+    if len(hash_jobs) > 0:
+        bulk_download(hash_jobs, max_workers=max_workers, retries=retries, backoff=backoff, auth=auth, verbose=0)
+
+    jobs = []
+    for folder, filename, hash_filename, hash_name in infos:
+        file_hash = None
+        full_hash_filename = None if hash_filename is None else os.path.join(apogee_env(), folder, hash_filename)
+        if full_hash_filename is not None and os.path.isfile(full_hash_filename):
+            # In some rare case, the hash cant be found, then the file is not verified
+            file_hash = manifest_lookup(hash_manifest(full_hash_filename), hash_name)
+        jobs.append((f'{base_url}/{folder}/{filename}', os.path.join(apogee_env(), folder, filename), file_hash))
+
+    return bulk_download(jobs, algorithm='sha1', max_workers=max_workers, retries=retries, backoff=backoff,
+                         manifest=manifest, overwrite=flag == 1, auth=auth, verbose=verbose)
+
+
 def apogee_vac_rc(dr=None, flag=None):
     """
     Download the red clumps catalogue
@@ -624,8 +693,8 @@ def apogee_vac_rc(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm='sha1')
-        if checksum != file_hash.lower():
+        checksum = cached_filehash(fullfilename, algorithm='sha1')
+        if checksum is not None and checksum != file_hash.lower():
             print('File corruption detected, astroNN attempting to download again')
             apogee_vac_rc(dr=dr, flag=1)
         else:
@@ -636,7 +705,7 @@ def apogee_vac_rc(dr=None, flag=None):
             with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
                 urllib.request.urlretrieve(urlstr, fullfilename, reporthook=t.update_to)
                 print(f'Downloaded DR{dr} Red Clumps Catalog successfully to {fullfilename}')
-                checksum = filehash(fullfilename, algorithm='sha1')
+                checksum = cached_filehash(fullfilename, algorithm='sha1', policy='always')
                 if checksum != file_hash.lower():
                     print('File corruption detected, astroNN attempting to download again')
                     apogee_vac_rc(dr=dr, flag=1)
@@ -676,8 +745,8 @@ def apogee_distances(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm='sha1')
-        if checksum != file_hash.lower():
+        checksum = cached_filehash(fullfilename, algorithm='sha1')
+        if checksum is not None and checksum != file_hash.lower():
             print('File corruption detected, astroNN attempting to download again')
             apogee_distances(dr=dr, flag=1)
         else:
@@ -688,7 +757,7 @@ def apogee_distances(dr=None, flag=None):
             with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
                 urllib.request.urlretrieve(urlstr, fullfilename, reporthook=t.update_to)
                 print(f'Downloaded DR{dr} Distances successfully to {fullfilename}')
-                checksum = filehash(fullfilename, algorithm='sha1')
+                checksum = cached_filehash(fullfilename, algorithm='sha1', policy='always')
                 if checksum != file_hash.lower():
                     print('File corruption detected, astroNN attempting to download again')
                     apogee_distances(dr=dr, flag=1)
@@ -38,6 +38,7 @@ def config_path(flag=None):
         # by default initial settings
         magicnum_init = -9999
         envvar_warning_flag_init = True
+        checksum_verification_init = 'once'
         custom_model_init = 'None'
         cpu_fallback_init = False
         gpu_memratio_init = True
@@ -59,6 +60,10 @@ def config_path(flag=None):
                 envvar_warning_flag_init = config['Basics']['EnvironmentVariableWarning']
             except KeyError:
                 pass
+            try:
+                checksum_verification_init = config['Basics']['ChecksumVerification']
+            except KeyError:
+                pass
             try:
                 custom_model_init = config['NeuralNet']['CustomModelPath']
             except KeyError:
@@ -92,7 +97,8 @@ def config_path(flag=None):
         config = configparser.ConfigParser()
         config['Basics'] = {'MagicNumber': magicnum_init,
                             'Multiprocessing_Generator': multiprocessing_flag,
-                            'EnvironmentVariableWarning': envvar_warning_flag_init}
+                            'EnvironmentVariableWarning': envvar_warning_flag_init,
+                            'ChecksumVerification': checksum_verification_init}
         config['NeuralNet'] = {'CustomModelPath': custom_model_init,
                                'CPUFallback': cpu_fallback_init,
                                'GPU_Mem_ratio': gpu_memratio_init}
@@ -173,6 +179,30 @@ def envvar_warning_flag_reader():
         return envvar_warning_flag_reader()
 
 
+def checksum_verification_reader():
+    """
+    NAME: checksum_verification_reader
+    PURPOSE: to read the policy of verifying checksum of existing files from configuration file
+    INPUT:
+    OUTPUT:
+        (string): 'always' to hash every time, 'once' to hash again only if file changed, 'never' to not verify
+    """
+    cpath = config_path()
+    config = configparser.ConfigParser()
+    config.read(cpath)
+
+    try:
+        string = config['Basics']['ChecksumVerification'].lower()
+        if string not in ('always', 'once', 'never'):
+            print(f'Unknown checksumverification -> {string} in configuration file located at {cpath}, '
+                  f"'once' is used")
+            string = 'once'
+        return string
+    except KeyError:
+        config_path(flag=1)
+        return checksum_verification_reader()
+
+
 def custom_model_path_reader():
     """
     NAME: custom_model_path_reader
@@ -247,4 +277,5 @@ def cpu_gpu_check():
 MAGIC_NUMBER = magic_num_reader()
 MULTIPROCESS_FLAG = multiprocessing_flag_reader()
 ENVVAR_WARN_FLAG = envvar_warning_flag_reader()
+CHECKSUM_VERIFICATION = checksum_verification_reader()
 CUSTOM_MODEL_PATH = custom_model_path_reader()
@@ -4,3 +4,4 @@ from astroNN.datasets.galaxy10 import load_data as load_galaxy10
 from astroNN.datasets.h5 import H5Compiler
 from astroNN.datasets.h5 import H5Loader
 from astroNN.datasets.xmatch import xmatch
+from astroNN.datasets.xmatch import XMatchIndex
@@ -2,9 +2,11 @@
 #   astroNN.datasets.h5: compile h5 files for NN
 # ---------------------------------------------------------#
 
+import hashlib
 import os
 import time
 from functools import reduce
+from multiprocessing import Pool
 
 import h5py
 import numpy as np
@@ -14,15 +16,25 @@ import astroNN
 from astroNN.apogee import combined_spectra, visit_spectra, allstar
 from astroNN.apogee.apogee_shared import apogee_env, apogee_default_dr
 from astroNN.apogee.chips import gap_delete, apogee_continuum, chips_pix_info
-from astroNN.datasets.xmatch import xmatch
+from astroNN.datasets.xmatch import xmatch_index
 from astroNN.gaia import mag_to_fakemag, extinction_correction
 from astroNN.gaia.downloader import gaiadr2_parallax, anderson_2017_parallax
 from astroNN.gaia.gaia_shared import gaia_env
+from astroNN.shared.downloader_tools import _filehash_cache_worker_init
 
 currentdir = os.getcwd()
 _APOGEE_DATA = apogee_env()
 _GAIA_DATA = gaia_env()
 
+# (name in h5, allStar column, column index, allStar uncertainty column, uncertainty column index)
+_ASPCAP_LABELS = [('teff', 'PARAM', 0, 'TEFF_ERR', None),
+                  ('logg', 'PARAM', 1, 'LOGG_ERR', None),
+                  ('M', 'PARAM', 3, 'M_H_ERR', None),
+                  ('alpha', 'PARAM', 6, 'ALPHA_M_ERR', None)]
+_ASPCAP_LABELS.extend([(elem, 'X_H', i, 'X_H_ERR', i) for i, elem in
+                       enumerate(['C', 'C1', 'N', 'O', 'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'K', 'Ca', 'Ti', 'Ti2', 'V',
+                                  'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Ge', 'Ce', 'Rb', 'Y', 'Nd'])])
+
 
 def h5name_check(h5name):
     if h5name is None:
@@ -30,6 +42,17 @@ def h5name_check(h5name):
     return None
 
 
+def _xmatch_gaia(ra, dec, gaia_ra, gaia_dec, name):
+    """
+    Cross-match stars to a Gaia catalog within 2 arcsec with the cross-match index of the catalog persisted in
+    astroNN cache folder
+    """
+    from astroNN.config import astroNN_CACHE_DIR
+
+    index = xmatch_index(gaia_ra, gaia_dec, os.path.join(astroNN_CACHE_DIR, 'xmatch', f'{name}.pkl'))
+    return index.query(ra, dec, maxdist=2)
+
+
 class H5Compiler(object):
     """
     A class for compiling h5 dataset for Keras to use
@@ -56,6 +79,9 @@ class H5Compiler(object):
         self.use_anderson_2017 = False
         self.use_err = True  # Whether to include error information in h5 dataset
         self.continuum = True  # True to do continuum normalization, False to use aspcap normalized spectra
+        self.n_workers = 1  # Number of worker processes to read and normalize spectra
+        self.checkpoint = True  # True to resume an interrupted compilation from the unfinished h5 file
+        self.buffer_size = 5000  # Number of spectra kept in memory before appending them to the h5 file
 
     def load_allstar(self):
         self.apogee_dr = apogee_default_dr(dr=self.apogee_dr)
@@ -108,96 +134,199 @@ class H5Compiler(object):
         return apogee_continuum(spectra=spectra, spectra_err=spectra_err, cont_mask=self.cont_mask, deg=2,
                                 dr=self.apogee_dr, bitmask=bitmask, target_bit=[0, 1, 2, 3, 4, 5, 6, 7, 12])
 
+    def _read_star(self, star):
+        """
+        Read and normalize all the spectra of a single star, used by compile() either in the main process or in the
+        worker processes
+
+        :param star: APOGEE_ID and LOCATION_ID of the star
+        :type star: tuple
+        :return: spectra, spectra uncertainty and SNR of the star, None if the star cannot be found
+        :rtype: Union[tuple, NoneType]
+        """
+        apogee_id, location_id = star
+        if not self.continuum:
+            path = combined_spectra(dr=self.apogee_dr, location=location_id, apogee=apogee_id, verbose=0)
+            if path is False:
+                # if path is not found then we should skip
+                return None
+            combined_file = fits.open(path)
+            _spec = combined_file[1].data  # Pseudo-continuum normalized flux
+            _spec_err = combined_file[2].data  # Spectrum error array
+            _spec = gap_delete(_spec, dr=self.apogee_dr)  # Delete the gap between sensors
+            _spec_err = gap_delete(_spec_err, dr=self.apogee_dr)
+            inSNR = np.atleast_1d(combined_file[0].header['SNR'])
+            combined_file.close()
+        else:
+            path = visit_spectra(dr=self.apogee_dr, location=location_id, apogee=apogee_id, verbose=0)
+            if path is False:
+                # if path is not found then we should skip
+                return None
+            apstar_file = fits.open(path)
+            nvisits = apstar_file[0].header['NVISITS']
+            if nvisits == 1:
+                _spec = apstar_file[1].data
+                _spec_err = apstar_file[2].data
+                _spec_mask = apstar_file[3].data
+                inSNR = np.ones(nvisits)
+                inSNR[0] = apstar_file[0].header['SNR']
+            else:
+                _spec = apstar_file[1].data[1:]
+                _spec_err = apstar_file[2].data[1:]
+                _spec_mask = apstar_file[3].data[1:]
+                inSNR = np.ones(nvisits + 1)
+                inSNR[0] = apstar_file[0].header['SNR']
+                for i in range(nvisits):
+                    inSNR[i + 1] = apstar_file[0].header[f'SNRVIS{i + 1}']
+
+                # Deal with spectra thats all zeros flux
+                nonzero = np.count_nonzero(_spec, axis=1) != 0
+                _spec, _spec_err, _spec_mask, inSNR = _spec[nonzero], _spec_err[nonzero], _spec_mask[nonzero], \
+                                                      inSNR[nonzero]
+
+            # Normalize spectra and Set some bitmask to 0
+            _spec, _spec_err = self.apstar_normalization(_spec, _spec_err, _spec_mask)
+            apstar_file.close()
+
+        return np.atleast_2d(_spec).astype(np.float32), np.atleast_2d(_spec_err).astype(np.float32), \
+               inSNR.astype(np.float32)
+
+    def _settings_digest(self):
+        """
+        Digest of the settings which change the output of _read_star(), an unfinished file is only resumed with the
+        same digest
+
+        :return: SHA1 hex digest
+        :rtype: str
+        """
+        digest = hashlib.sha1(f'{self.apogee_dr} {self.continuum}'.encode())
+        if self.continuum:
+            # default mask depends on apogee_dr only
+            if self.cont_mask is not None:
+                digest.update(np.ascontiguousarray(self.cont_mask, dtype=bool).tobytes())
+            else:
+                digest.update(b'default')
+        return digest.hexdigest()
+
+    def _open_h5(self, indices, total_pix):
+        """
+        Open the resulting h5 file for streaming spectra into it. An unfinished file left by an interrupted
+        compilation is resumed if it was created from the same filtered stars with the same settings (apogee_dr,
+        continuum and cont_mask, see _settings_digest()), otherwise the compilation starts over
+
+        :param indices: filtered indices of allStar to compile
+        :type indices: ndarray
+        :param total_pix: number of pixels of a spectrum
+        :type total_pix: int
+        :return: h5 file and the number of stars already compiled
+        :rtype: (h5py.File, int)
+        """
+        h5path = f'{self.filename}.h5'
+        if self.checkpoint and os.path.isfile(h5path):
+            h5f = h5py.File(h5path, 'a')
+            if h5f.attrs.get('compiling', False) and h5f.attrs.get('settings') == self._settings_digest() \
+                    and np.array_equal(h5f['index'][()], indices):
+                stars_done = int(h5f.attrs['stars_done'])
+                # discard anything written after the last complete flush
+                rows_done = int(np.sum(h5f['nvisits'][:stars_done]))
+                for name in ('spectra', 'spectra_err', 'SNR'):
+                    h5f[name].resize(rows_done, axis=0)
+                h5f['nvisits'].resize(stars_done, axis=0)
+                # labels are written after all spectra, remove any left by an interruption while writing them
+                for name in list(h5f.keys()):
+                    if name not in ('index', 'spectra', 'spectra_err', 'SNR', 'nvisits'):
+                        del h5f[name]
+                print(f'Resuming {h5path}, {stars_done} of {indices.shape[0]} stars already compiled')
+                return h5f, stars_done
+            h5f.close()
+
+        print(f'Creating {h5path}')
+        h5f = h5py.File(h5path, 'w')
+        h5f.attrs['compiling'] = True
+        h5f.attrs['settings'] = self._settings_digest()
+        h5f.attrs['stars_done'] = 0
+        h5f.create_dataset('index', data=indices)
+        chunk_rows = max(1, min(32, self.buffer_size))
+        for name in ('spectra', 'spectra_err'):
+            h5f.create_dataset(name, shape=(0, total_pix), maxshape=(None, total_pix), dtype=np.float32,
+                               chunks=(chunk_rows, total_pix))
+        h5f.create_dataset('SNR', shape=(0,), maxshape=(None,), dtype=np.float32, chunks=(4096,))
+        h5f.create_dataset('nvisits', shape=(0,), maxshape=(None,), dtype=np.int32, chunks=(4096,))
+        return h5f, 0
+
+    @staticmethod
+    def _flush(h5f, results):
+        """
+        Append the buffered results of _read_star() to the h5 file, stars not found are recorded with zero spectrum
+        """
+        found = [result for result in results if result is not None]
+        nvisits = np.array([0 if result is None else result[0].shape[0] for result in results], dtype=np.int32)
+        rows_done = h5f['spectra'].shape[0]
+        num_rows = int(np.sum(nvisits))
+        for name, idx in (('spectra', 0), ('spectra_err', 1), ('SNR', 2)):
+            h5f[name].resize(rows_done + num_rows, axis=0)
+            if num_rows > 0:
+                h5f[name][rows_done:] = np.concatenate([result[idx] for result in found])
+        stars_done = h5f['nvisits'].shape[0]
+        h5f['nvisits'].resize(stars_done + nvisits.shape[0], axis=0)
+        h5f['nvisits'][stars_done:] = nvisits
+        # only mark the stars as done after all of their data are written
+        h5f.attrs['stars_done'] = stars_done + nvisits.shape[0]
+        h5f.flush()
+
+    def _compile_spectra(self, h5f, indices, apogee_ids, location_ids, stars_done):
+        """
+        Read and normalize the spectra of all filtered stars, optionally with a pool of worker processes, and append
+        them to the h5 file. Results are consumed in the same order as the stars so the output is deterministic
+        regardless of the number of workers. At most buffer_size spectra are kept in memory before flushing.
+
+        :return: number of spectra of each star (0 if not found)
+        :rtype: ndarray
+        """
+        total_num = indices.shape[0]
+        buffer = []
+        buffered_rows = 0
+
+        stars = list(zip(apogee_ids[stars_done:], location_ids[stars_done:]))
+        if self.n_workers > 1 and len(stars) > 0:
+            pool = Pool(self.n_workers, initializer=_filehash_cache_worker_init)
+        else:
+            pool = None
+        results = pool.imap(self._read_star, stars, chunksize=4) if pool is not None else map(self._read_star, stars)
+
+        start_time = time.time()
+        try:
+            for counter, result in enumerate(results, stars_done):
+                if counter % 100 == 0:
+                    print(f'Completed {counter + 1} of {total_num}, {(time.time() - start_time):.{2}f}s elapsed')
+                buffer.append(result)
+                buffered_rows += 0 if result is None else result[0].shape[0]
+                if buffered_rows >= self.buffer_size:
+                    self._flush(h5f, buffer)
+                    buffer, buffered_rows = [], 0
+            if len(buffer) > 0:
+                self._flush(h5f, buffer)
+            if pool is not None:
+                # workers save their new checksums only when they exit normally
+                pool.close()
+                pool.join()
+                pool = None
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return h5f['nvisits'][()]
+
     def compile(self):
         h5name_check(self.filename)
 
         hdulist = self.load_allstar()
         indices = self.filter_apogeeid_list(hdulist)
+        allstar_data = hdulist[1].data
 
         info = chips_pix_info(dr=self.apogee_dr)
         total_pix = (info[1] - info[0]) + (info[3] - info[2]) + (info[5] - info[4])
-        default_length = 900000
-
-        spec = np.zeros((default_length, total_pix), dtype=np.float32)
-        spec_err = np.zeros((default_length, total_pix), dtype=np.float32)
-        RA = np.zeros(default_length, dtype=np.float32)
-        DEC = np.zeros(default_length, dtype=np.float32)
-        SNR = np.zeros(default_length, dtype=np.float32)
-        individual_flag = np.zeros(default_length, dtype=np.float32)
-        Kmag = np.zeros(default_length, dtype=np.float32)
-        AK_TARG = np.zeros(default_length, dtype=np.float32)
-
-        # Data array
-        teff = np.zeros(default_length, dtype=np.float32)
-        logg = np.zeros(default_length, dtype=np.float32)
-        MH = np.zeros(default_length, dtype=np.float32)
-        alpha_M = np.zeros(default_length, dtype=np.float32)
-        C = np.zeros(default_length, dtype=np.float32)
-        C1 = np.zeros(default_length, dtype=np.float32)
-        N = np.zeros(default_length, dtype=np.float32)
-        O = np.zeros(default_length, dtype=np.float32)
-        Na = np.zeros(default_length, dtype=np.float32)
-        Mg = np.zeros(default_length, dtype=np.float32)
-        Al = np.zeros(default_length, dtype=np.float32)
-        Si = np.zeros(default_length, dtype=np.float32)
-        P = np.zeros(default_length, dtype=np.float32)
-        S = np.zeros(default_length, dtype=np.float32)
-        K = np.zeros(default_length, dtype=np.float32)
-        Ca = np.zeros(default_length, dtype=np.float32)
-        Ti = np.zeros(default_length, dtype=np.float32)
-        Ti2 = np.zeros(default_length, dtype=np.float32)
-        V = np.zeros(default_length, dtype=np.float32)
-        Cr = np.zeros(default_length, dtype=np.float32)
-        Mn = np.zeros(default_length, dtype=np.float32)
-        Fe = np.zeros(default_length, dtype=np.float32)
-        Co = np.zeros(default_length, dtype=np.float32)
-        Ni = np.zeros(default_length, dtype=np.float32)
-        Cu = np.zeros(default_length, dtype=np.float32)
-        Ge = np.zeros(default_length, dtype=np.float32)
-        Ce = np.zeros(default_length, dtype=np.float32)
-        Rb = np.zeros(default_length, dtype=np.float32)
-        Y = np.zeros(default_length, dtype=np.float32)
-        Nd = np.zeros(default_length, dtype=np.float32)
-        parallax = np.zeros(default_length, dtype=np.float32)
-        fakemag = np.zeros(default_length, dtype=np.float32)
-
-        # Error array
-        teff_err = np.zeros(default_length, dtype=np.float32)
-        logg_err = np.zeros(default_length, dtype=np.float32)
-        MH_err = np.zeros(default_length, dtype=np.float32)
-        alpha_M_err = np.zeros(default_length, dtype=np.float32)
-        C_err = np.zeros(default_length, dtype=np.float32)
-        C1_err = np.zeros(default_length, dtype=np.float32)
-        N_err = np.zeros(default_length, dtype=np.float32)
-        O_err = np.zeros(default_length, dtype=np.float32)
-        Na_err = np.zeros(default_length, dtype=np.float32)
-        Mg_err = np.zeros(default_length, dtype=np.float32)
-        Al_err = np.zeros(default_length, dtype=np.float32)
-        Si_err = np.zeros(default_length, dtype=np.float32)
-        P_err = np.zeros(default_length, dtype=np.float32)
-        S_err = np.zeros(default_length, dtype=np.float32)
-        K_err = np.zeros(default_length, dtype=np.float32)
-        Ca_err = np.zeros(default_length, dtype=np.float32)
-        Ti_err = np.zeros(default_length, dtype=np.float32)
-        Ti2_err = np.zeros(default_length, dtype=np.float32)
-        V_err = np.zeros(default_length, dtype=np.float32)
-        Cr_err = np.zeros(default_length, dtype=np.float32)
-        Mn_err = np.zeros(default_length, dtype=np.float32)
-        Fe_err = np.zeros(default_length, dtype=np.float32)
-        Co_err = np.zeros(default_length, dtype=np.float32)
-        Ni_err = np.zeros(default_length, dtype=np.float32)
-        Cu_err = np.zeros(default_length, dtype=np.float32)
-        Ge_err = np.zeros(default_length, dtype=np.float32)
-        Ce_err = np.zeros(default_length, dtype=np.float32)
-        Rb_err = np.zeros(default_length, dtype=np.float32)
-        Y_err = np.zeros(default_length, dtype=np.float32)
-        Nd_err = np.zeros(default_length, dtype=np.float32)
-        parallax_err = np.zeros(default_length, dtype=np.float32)
-        fakemag_err = np.zeros(default_length, dtype=np.float32)
-
-        array_counter = 0
-
-        start_time = time.time()
 
         # provide a cont mask so no need to read every loop
         if self.cont_mask is None:
@@ -205,359 +334,185 @@ class H5Compiler(object):
                                     f'dr{self.apogee_dr}_contmask.npy')
             self.cont_mask = np.load(maskpath)
 
-        for counter, index in enumerate(indices):
-            nvisits = 1
-            apogee_id = hdulist[1].data['APOGEE_ID'][index]
-            location_id = hdulist[1].data['LOCATION_ID'][index]
-            if counter % 100 == 0:
-                print(f'Completed {counter + 1} of {indices.shape[0]}, {(time.time() - start_time):.{2}f}s elapsed')
-            if not self.continuum:
-                path = combined_spectra(dr=self.apogee_dr, location=location_id, apogee=apogee_id,
-                                        verbose=0)
-                if path is False:
-                    # if path is not found then we should skip
-                    continue
-                combined_file = fits.open(path)
-                _spec = combined_file[1].data  # Pseudo-continuum normalized flux
-                _spec_err = combined_file[2].data  # Spectrum error array
-                _spec = gap_delete(_spec, dr=self.apogee_dr)  # Delete the gap between sensors
-                _spec_err = gap_delete(_spec_err, dr=self.apogee_dr)
-                inSNR = combined_file[0].header['SNR']
-                combined_file.close()
-            else:
-                path = visit_spectra(dr=self.apogee_dr, location=location_id, apogee=apogee_id,
-                                     verbose=0)
-                if path is False:
-                    # if path is not found then we should skip
-                    continue
-                apstar_file = fits.open(path)
-                nvisits = apstar_file[0].header['NVISITS']
-                if nvisits == 1:
-                    _spec = apstar_file[1].data
-                    _spec_err = apstar_file[2].data
-                    _spec_mask = apstar_file[3].data
-                    inSNR = np.ones(nvisits)
-                    inSNR[0] = apstar_file[0].header['SNR']
-                else:
-                    _spec = apstar_file[1].data[1:]
-                    _spec_err = apstar_file[2].data[1:]
-                    _spec_mask = apstar_file[3].data[1:]
-                    inSNR = np.ones(nvisits + 1)
-                    inSNR[0] = apstar_file[0].header['SNR']
-                    for i in range(nvisits):
-                        inSNR[i + 1] = apstar_file[0].header[f'SNRVIS{i + 1}']
-
-                    # Deal with spectra thats all zeros flux
-                    ii = 0
-                    while ii < _spec.shape[0]:
-                        if np.count_nonzero(_spec[ii]) == 0:
-                            nvisits -= 1
-                            _spec = np.delete(_spec, ii, 0)
-                            _spec_err = np.delete(_spec_err, ii, 0)
-                            _spec_mask = np.delete(_spec_mask, ii, 0)
-                            inSNR = np.delete(inSNR, ii, 0)
-                            ii -= 1
-                        ii += 1
-
-                    # Just for the sake of program to work, the real nvisits still nvisits
-                    nvisits += 1
-
-                # Normalize spectra and Set some bitmask to 0
-                _spec, _spec_err = self.apstar_normalization(_spec, _spec_err, _spec_mask)
-                apstar_file.close()
+        h5f, stars_done = self._open_h5(indices, total_pix)
+        try:
+            nvisits = self._compile_spectra(h5f, indices, allstar_data['APOGEE_ID'][indices],
+                                            allstar_data['LOCATION_ID'][indices], stars_done)
+        except BaseException:
+            # keep the unfinished file consistent and closed so compile() can resume from it
+            h5f.close()
+            raise
 
-            if nvisits == 1:
-                individual_flag[array_counter:array_counter + nvisits] = 0
-            else:
-                individual_flag[array_counter:array_counter + 1] = 0
-                individual_flag[array_counter + 1:array_counter + nvisits] = 1
-            spec[array_counter:array_counter + nvisits, :] = _spec
-            spec_err[array_counter:array_counter + nvisits, :] = _spec_err
-            SNR[array_counter:array_counter + nvisits] = inSNR
-            RA[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['RA'][index], nvisits)
-            DEC[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['DEC'][index], nvisits)
-            parallax[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            parallax_err[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            fakemag[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            fakemag_err[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            Kmag[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['K'][index], nvisits)
-            AK_TARG[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['AK_TARG'][index], nvisits)
-
-            if self.spectra_only is not True:
-                teff[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 0], nvisits)
-                logg[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 1], nvisits)
-                MH[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 3], nvisits)
-                alpha_M[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 6],
-                                                                         nvisits)
-                C[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 0], nvisits)
-                C1[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 1], nvisits)
-                N[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 2], nvisits)
-                O[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 3], nvisits)
-                Na[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 4], nvisits)
-                Mg[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 5], nvisits)
-                Al[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 6], nvisits)
-                Si[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 7], nvisits)
-                P[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 8], nvisits)
-                S[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 9], nvisits)
-                K[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 10], nvisits)
-                Ca[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 11], nvisits)
-                Ti[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 12], nvisits)
-                Ti2[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 13], nvisits)
-                V[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 14], nvisits)
-                Cr[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 15], nvisits)
-                Mn[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 16], nvisits)
-                Fe[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 17], nvisits)
-                Co[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 18], nvisits)
-                Ni[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 19], nvisits)
-                Cu[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 20], nvisits)
-                Ge[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 21], nvisits)
-                Ce[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 22], nvisits)
-                Rb[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 23], nvisits)
-                Y[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 24], nvisits)
-                Nd[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 25], nvisits)
-
-                if self.use_err is True:
-                    teff_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['TEFF_ERR'][index],
-                                                                              nvisits)
-                    logg_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['LOGG_ERR'][index],
-                                                                              nvisits)
-                    MH_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['M_H_ERR'][index],
-                                                                            nvisits)
-                    alpha_M_err[array_counter:array_counter + nvisits] = np.tile(
-                        hdulist[1].data['ALPHA_M_ERR'][index]
-                        , nvisits)
-                    C_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 0],
-                                                                           nvisits)
-                    C1_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 1],
-                                                                            nvisits)
-                    N_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 2],
-                                                                           nvisits)
-                    O_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 3],
-                                                                           nvisits)
-                    Na_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 4],
-                                                                            nvisits)
-                    Mg_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 5],
-                                                                            nvisits)
-                    Al_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 6],
-                                                                            nvisits)
-                    Si_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 7],
-                                                                            nvisits)
-                    P_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 8],
-                                                                           nvisits)
-                    S_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 9],
-                                                                           nvisits)
-                    K_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 10],
-                                                                           nvisits)
-                    Ca_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 11],
-                                                                            nvisits)
-                    Ti_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 12],
-                                                                            nvisits)
-                    Ti2_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 13],
-                                                                             nvisits)
-                    V_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 14],
-                                                                           nvisits)
-                    Cr_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 15],
-                                                                            nvisits)
-                    Mn_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 16],
-                                                                            nvisits)
-                    Fe_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 17],
-                                                                            nvisits)
-                    Co_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 18],
-                                                                            nvisits)
-                    Ni_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 19],
-                                                                            nvisits)
-                    Cu_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 20],
-                                                                            nvisits)
-                    Ge_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 21],
-                                                                            nvisits)
-                    Ce_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 22],
-                                                                            nvisits)
-                    Rb_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 23],
-                                                                            nvisits)
-                    Y_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 24],
-                                                                           nvisits)
-                    Nd_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 25],
-                                                                            nvisits)
-            array_counter += nvisits
-
-        spec = spec[0:array_counter]
-        spec_err = spec_err[0:array_counter]
-        individual_flag = individual_flag[0:array_counter]
-        RA = RA[0:array_counter]
-        DEC = DEC[0:array_counter]
-        SNR = SNR[0:array_counter]
+        # every spectrum points to the allStar row of its star, the first spectrum of a star is the combined one
+        star_idx = np.repeat(indices, nvisits)
+        individual_flag = np.ones(star_idx.shape[0], dtype=np.float32)
+        individual_flag[np.cumsum(nvisits)[nvisits > 0] - nvisits[nvisits > 0]] = 0
+
+        h5f.create_dataset('in_flag', data=individual_flag)
 
         if self.spectra_only is not True:
-            teff = teff[0:array_counter]
-            logg = logg[0:array_counter]
-            Kmag = Kmag[0:array_counter]
-            AK_TARG = AK_TARG[0:array_counter]
-            MH = MH[0:array_counter]
-            alpha_M = alpha_M[0:array_counter]
-            C = C[0:array_counter]
-            C1 = C1[0:array_counter]
-            N = N[0:array_counter]
-            O = O[0:array_counter]
-            Na = Na[0:array_counter]
-            Mg = Mg[0:array_counter]
-            Al = Al[0:array_counter]
-            Si = Si[0:array_counter]
-            P = P[0:array_counter]
-            S = S[0:array_counter]
-            K = K[0:array_counter]
-            Ca = Ca[0:array_counter]
-            Ti = Ti[0:array_counter]
-            Ti2 = Ti2[0:array_counter]
-            V = V[0:array_counter]
-            Cr = Cr[0:array_counter]
-            Mn = Mn[0:array_counter]
-            Fe = Fe[0:array_counter]
-            Co = Co[0:array_counter]
-            Ni = Ni[0:array_counter]
-            Cu = Cu[0:array_counter]
-            Ge = Ge[0:array_counter]
-            Ce = Ce[0:array_counter]
-            Rb = Rb[0:array_counter]
-            Y = Y[0:array_counter]
-            Nd = Nd[0:array_counter]
-            parallax = parallax[0:array_counter]
-            fakemag = fakemag[0:array_counter]
-
-            teff_err = teff_err[0:array_counter]
-            logg_err = logg_err[0:array_counter]
-            MH_err = MH_err[0:array_counter]
-            alpha_M_err = alpha_M_err[0:array_counter]
-            C_err = C_err[0:array_counter]
-            C1_err = C1_err[0:array_counter]
-            N_err = N_err[0:array_counter]
-            O_err = O_err[0:array_counter]
-            Na_err = Na_err[0:array_counter]
-            Mg_err = Mg_err[0:array_counter]
-            Al_err = Al_err[0:array_counter]
-            Si_err = Si_err[0:array_counter]
-            P_err = P_err[0:array_counter]
-            S_err = S_err[0:array_counter]
-            K_err = K_err[0:array_counter]
-            Ca_err = Ca_err[0:array_counter]
-            Ti_err = Ti_err[0:array_counter]
-            Ti2_err = Ti2_err[0:array_counter]
-            V_err = V_err[0:array_counter]
-            Cr_err = Cr_err[0:array_counter]
-            Mn_err = Mn_err[0:array_counter]
-            Fe_err = Fe_err[0:array_counter]
-            Co_err = Co_err[0:array_counter]
-            Ni_err = Ni_err[0:array_counter]
-            Cu_err = Cu_err[0:array_counter]
-            Ge_err = Ge_err[0:array_counter]
-            Ce_err = Ce_err[0:array_counter]
-            Rb_err = Rb_err[0:array_counter]
-            Y_err = Y_err[0:array_counter]
-            Nd_err = Nd_err[0:array_counter]
-            parallax_err = parallax_err[0:array_counter]
-            fakemag_err = fakemag_err[0:array_counter]
+            RA = allstar_data['RA'][star_idx].astype(np.float32)
+            DEC = allstar_data['DEC'][star_idx].astype(np.float32)
+            Kmag = allstar_data['K'][star_idx].astype(np.float32)
+            AK_TARG = allstar_data['AK_TARG'][star_idx].astype(np.float32)
+            parallax = np.tile(np.float32(-9999), star_idx.shape[0])
+            parallax_err = np.tile(np.float32(-9999), star_idx.shape[0])
+            fakemag = np.tile(np.float32(-9999), star_idx.shape[0])
+            fakemag_err = np.tile(np.float32(-9999), star_idx.shape[0])
 
             if self.use_esa_gaia is True:
                 gaia_ra, gaia_dec, gaia_parallax, gaia_err = gaiadr2_parallax(cuts=True, keepdims=False)
-                m1, m2, sep = xmatch(RA, gaia_ra, maxdist=2, colRA1=RA, colDec1=DEC, colRA2=gaia_ra, colDec2=gaia_dec,
-                                     swap=False)
+                m1, m2, sep = _xmatch_gaia(RA, DEC, gaia_ra, gaia_dec, 'gaiadr2_apogeedr14_parallax')
                 parallax[m1] = gaia_parallax[m2]
                 parallax_err[m1] = gaia_err[m2]
                 fakemag[m1], fakemag_err[m1] = mag_to_fakemag(extinction_correction(Kmag[m1], AK_TARG[m1]),
                                                               parallax[m1], parallax_err[m1])
             elif self.use_anderson_2017 is True:
                 gaia_ra, gaia_dec, gaia_parallax, gaia_err = anderson_2017_parallax()
-                m1, m2, sep = xmatch(RA, gaia_ra, maxdist=2, colRA1=RA, colDec1=DEC, epoch1=2000., colRA2=gaia_ra,
-                                     colDec2=gaia_dec, epoch2=2000., swap=False)
+                m1, m2, sep = _xmatch_gaia(RA, DEC, gaia_ra, gaia_dec, 'anderson_2017_parallax')
                 parallax[m1] = gaia_parallax[m2]
                 parallax_err[m1] = gaia_err[m2]
                 fakemag[m1], fakemag_err[m1] = mag_to_fakemag(extinction_correction(Kmag[m1], AK_TARG[m1]),
                                                               parallax[m1], parallax_err[m1])
 
-        print(f'Creating {self.filename}.h5')
-        h5f = h5py.File(f'{self.filename}.h5', 'w')
-        h5f.create_dataset('spectra', data=spec)
-        h5f.create_dataset('spectra_err', data=spec_err)
-        h5f.create_dataset('in_flag', data=individual_flag)
-        h5f.create_dataset('index', data=indices)
-
-        if self.spectra_only is not True:
-            h5f.create_dataset('SNR', data=SNR)
             h5f.create_dataset('RA', data=RA)
             h5f.create_dataset('DEC', data=DEC)
             h5f.create_dataset('Kmag', data=Kmag)
             h5f.create_dataset('AK_TARG', data=AK_TARG)
-            h5f.create_dataset('teff', data=teff)
-            h5f.create_dataset('logg', data=logg)
-            h5f.create_dataset('M', data=MH)
-            h5f.create_dataset('alpha', data=alpha_M)
-            h5f.create_dataset('C', data=C)
-            h5f.create_dataset('C1', data=C1)
-            h5f.create_dataset('N', data=N)
-            h5f.create_dataset('O', data=O)
-            h5f.create_dataset('Na', data=Na)
-            h5f.create_dataset('Mg', data=Mg)
-            h5f.create_dataset('Al', data=Al)
-            h5f.create_dataset('Si', data=Si)
-            h5f.create_dataset('P', data=P)
-            h5f.create_dataset('S', data=S)
-            h5f.create_dataset('K', data=K)
-            h5f.create_dataset('Ca', data=Ca)
-            h5f.create_dataset('Ti', data=Ti)
-            h5f.create_dataset('Ti2', data=Ti2)
-            h5f.create_dataset('V', data=V)
-            h5f.create_dataset('Cr', data=Cr)
-            h5f.create_dataset('Mn', data=Mn)
-            h5f.create_dataset('Fe', data=Fe)
-            h5f.create_dataset('Co', data=Co)
-            h5f.create_dataset('Ni', data=Ni)
-            h5f.create_dataset('Cu', data=Cu)
-            h5f.create_dataset('Ge', data=Ge)
-            h5f.create_dataset('Ce', data=Ce)
-            h5f.create_dataset('Rb', data=Rb)
-            h5f.create_dataset('Y', data=Y)
-            h5f.create_dataset('Nd', data=Nd)
+            for name, column, column_idx, _, _ in _ASPCAP_LABELS:
+                h5f.create_dataset(name, data=allstar_data[column][star_idx, column_idx].astype(np.float32))
             h5f.create_dataset('parallax', data=parallax)
             h5f.create_dataset('fakemag', data=fakemag)
 
             if self.use_err is True:
                 h5f.create_dataset('AK_TARG_err', data=np.zeros_like(AK_TARG))
-                h5f.create_dataset('teff_err', data=teff_err)
-                h5f.create_dataset('logg_err', data=logg_err)
-                h5f.create_dataset('M_err', data=MH_err)
-                h5f.create_dataset('alpha_err', data=alpha_M_err)
-                h5f.create_dataset('C_err', data=C_err)
-                h5f.create_dataset('C1_err', data=C1_err)
-                h5f.create_dataset('N_err', data=N_err)
-                h5f.create_dataset('O_err', data=O_err)
-                h5f.create_dataset('Na_err', data=Na_err)
-                h5f.create_dataset('Mg_err', data=Mg_err)
-                h5f.create_dataset('Al_err', data=Al_err)
-                h5f.create_dataset('Si_err', data=Si_err)
-                h5f.create_dataset('P_err', data=P_err)
-                h5f.create_dataset('S_err', data=S_err)
-                h5f.create_dataset('K_err', data=K_err)
-                h5f.create_dataset('Ca_err', data=Ca_err)
-                h5f.create_dataset('Ti_err', data=Ti_err)
-                h5f.create_dataset('Ti2_err', data=Ti2_err)
-                h5f.create_dataset('V_err', data=V_err)
-                h5f.create_dataset('Cr_err', data=Cr_err)
-                h5f.create_dataset('Mn_err', data=Mn_err)
-                h5f.create_dataset('Fe_err', data=Fe_err)
-                h5f.create_dataset('Co_err', data=Co_err)
-                h5f.create_dataset('Ni_err', data=Ni_err)
-                h5f.create_dataset('Cu_err', data=Cu_err)
-                h5f.create_dataset('Ge_err', data=Ge_err)
-                h5f.create_dataset('Ce_err', data=Ce_err)
-                h5f.create_dataset('Rb_err', data=Rb_err)
-                h5f.create_dataset('Y_err', data=Y_err)
-                h5f.create_dataset('Nd_err', data=Nd_err)
+                for name, _, _, err_column, err_column_idx in _ASPCAP_LABELS:
+                    if err_column_idx is None:
+                        err = allstar_data[err_column][star_idx]
+                    else:
+                        err = allstar_data[err_column][star_idx, err_column_idx]
+                    h5f.create_dataset(f'{name}_err', data=err.astype(np.float32))
                 h5f.create_dataset('parallax_err', data=parallax_err)
                 h5f.create_dataset('fakemag_err', data=fakemag_err)
 
+        if self.spectra_only is True:
+            del h5f['SNR']
+        del h5f['nvisits']
+        for attr in ('compiling', 'settings', 'stars_done'):
+            del h5f.attrs[attr]
         h5f.close()
         print(f'Successfully created {self.filename}.h5 in {currentdir}')
 
 
+class H5LazyArray(object):
+    """
+    Array-like lazy view of selected rows of a dataset in a h5 file, rows are only read from disk when being indexed.
+    Uncompressed contiguous datasets are memory-mapped, chunked datasets are read chunk by chunk so reading a subset of
+    rows only costs the I/O of the chunks containing them.
+
+    :param h5path: path to the h5 file
+    :type h5path: str
+    :param name: name of the dataset
+    :type name: str
+    :param index: sorted rows of the dataset in this view
+    :type index: ndarray
+    """
+    def __init__(self, h5path, name, index):
+        self.h5path = h5path
+        self.name = name
+        self.index = np.asarray(index, dtype=np.int64)
+        with h5py.File(self.h5path, 'r') as F:
+            self.shape = (self.index.shape[0],) + F[self.name].shape[1:]
+            self.dtype = F[self.name].dtype
+        self._h5f = None
+        self._dset = None
+        self._memmap = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # file handles cannot be pickled, they will be reopened in the new process
+        state = self.__dict__.copy()
+        state.update({'_h5f': None, '_dset': None, '_memmap': None})
+        return state
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows = self.index[key[0]]
+        if np.ndim(rows) == 0:
+            return self.read_rows(np.array([rows]))[0][key[1:]]
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        result = self.read_rows(unique_rows)
+        if unique_rows.shape[0] != rows.shape[0] or np.any(unique_rows != rows):
+            result = result[inverse]
+        return result[(slice(None),) + key[1:]]
+
+    def subset(self, key):
+        """
+        Lazy view of a subset of rows of this view without reading them
+
+        :param key: rows of this view
+        :type key: Union[slice, ndarray]
+        :return: lazy view of the subset
+        :rtype: H5LazyArray
+        """
+        return H5LazyArray(self.h5path, self.name, self.index[key])
+
+    def close(self):
+        """
+        Close the underlying h5 file, it will be reopened if the array is indexed again
+        """
+        if self._h5f is not None:
+            self._h5f.close()
+        self._h5f, self._dset, self._memmap = None, None, None
+
+    def _open(self):
+        if self._dset is None:
+            self._h5f = h5py.File(self.h5path, 'r')
+            self._dset = self._h5f[self.name]
+            offset = self._dset.id.get_offset()
+            if self._dset.chunks is None and offset is not None and self._dset.dtype.kind in 'biuf':
+                self._memmap = np.memmap(self.h5path, dtype=self._dset.dtype, mode='r', offset=offset,
+                                         shape=self._dset.shape)
+        return self._dset
+
+    def read_rows(self, rows):
+        """
+        Read rows of the dataset
+
+        :param rows: sorted and unique rows of the dataset (not of this view) to read
+        :type rows: ndarray
+        :return: the rows
+        :rtype: ndarray
+        """
+        dset = self._open()
+        if self._memmap is not None:
+            return np.asarray(self._memmap[rows])
+        if dset.chunks is None:
+            return dset[rows] if rows.shape[0] > 0 else np.empty((0,) + dset.shape[1:], dtype=dset.dtype)
+
+        # read once for every chunk touched and take the rows needed from it
+        out = np.empty((rows.shape[0],) + dset.shape[1:], dtype=dset.dtype)
+        chunk_id = rows // dset.chunks[0]
+        boundaries = np.concatenate([[0], np.flatnonzero(np.diff(chunk_id)) + 1, [rows.shape[0]]])
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            first, last = rows[start], rows[end - 1]
+            if last - first == end - start - 1:
+                dset.read_direct(out, np.s_[first:last + 1], np.s_[start:end])
+            else:
+                out[start:end] = dset[first:last + 1][rows[start:end] - first]
+        return out
+
+
 class H5Loader(object):
     def __init__(self, filename, target='all'):
         self.filename = filename
@@ -566,6 +521,7 @@ class H5Loader(object):
         self.load_combined = True
         self.load_err = False
         self.exclude9999 = False
+        self.lazy = False
 
         if os.path.isfile(os.path.join(self.currentdir, self.filename)) is True:
             self.h5path = os.path.join(self.currentdir, self.filename)
@@ -575,65 +531,90 @@ class H5Loader(object):
             raise FileNotFoundError(f'Cannot find {os.path.join(self.currentdir, self.filename)}')
 
         self.target = target_conversion(self.target)
+        self._allowed_index_cache = {}
 
     def load_allowed_index(self):
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            if self.exclude9999 is True:
-                index_not9999 = None
-                for counter, tg in enumerate(self.target):
-                    if index_not9999 is None:
-                        index_not9999 = np.arange(F[f'{tg}'].shape[0])
-                    temp_index = np.where(np.array(F[f'{tg}']) != -9999)[0]
-                    index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
-
-                in_flag = index_not9999
-                if self.load_combined is True:
-                    in_flag = np.where(np.array(F['in_flag']) == 0)[0]
-                elif self.load_combined is False:
-                    in_flag = np.where(np.array(F['in_flag']) == 1)[0]
-
-                allowed_index = reduce(np.intersect1d, (index_not9999, in_flag))
+        # the result only depends on these settings and the file, so it is computed once for every combination
+        cache_key = (tuple(self.target), self.exclude9999, self.load_combined, os.stat(self.h5path).st_mtime_ns)
+        if cache_key in self._allowed_index_cache:
+            return self._allowed_index_cache[cache_key]
+
+        with h5py.File(self.h5path, 'r') as F:  # ensure the file will be cleaned up
+            in_flag = np.arange(F['in_flag'].shape[0])
+            if self.load_combined is True:
+                in_flag = np.where(F['in_flag'][()] == 0)[0]
+            elif self.load_combined is False:
+                in_flag = np.where(F['in_flag'][()] == 1)[0]
 
+            if self.exclude9999 is True:
+                not9999 = np.ones(F['in_flag'].shape[0], dtype=bool)
+                for tg in self.target:
+                    not9999 &= F[f'{tg}'][()] != -9999
+                allowed_index = in_flag[not9999[in_flag]]
             else:
-                in_flag = []
-                if self.load_combined is True:
-                    in_flag = np.where(np.array(F['in_flag']) == 0)[0]
-                elif self.load_combined is False:
-                    in_flag = np.where(np.array(F['in_flag']) == 1)[0]
-
-                allowed_index = in_flag
-
-            F.close()
+                allowed_index = in_flag if self.load_combined is not None else np.array([], dtype=int)
 
+        self._allowed_index_cache[cache_key] = allowed_index
         return allowed_index
 
+    def _load_rows(self, name, allowed_index):
+        dataset = H5LazyArray(self.h5path, name, allowed_index)
+        return dataset if self.lazy is True else dataset[:]
+
     def load(self):
         allowed_index = self.load_allowed_index()
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            allowed_index_list = allowed_index.tolist()
-            spectra = np.array(F['spectra'])[allowed_index_list]
-            spectra_err = np.array(F['spectra_err'])[allowed_index_list]
-
-            y = np.array((spectra.shape[1]))
-            y_err = np.array((spectra.shape[1]))
-            for counter, tg in enumerate(self.target):
-                temp = np.array(F[f'{tg}'])[allowed_index_list]
-                if counter == 0:
-                    y = temp[:]
-                else:
-                    y = np.column_stack((y, temp[:]))
-                if self.load_err is True:
-                    temp_err = np.array(F[f'{tg}_err'])[allowed_index_list]
-                    if counter == 0:
-                        y_err = temp_err[:]
-                    else:
-                        y_err = np.column_stack((y_err, temp_err[:]))
+        spectra = self._load_rows('spectra', allowed_index)
+        spectra_err = self._load_rows('spectra_err', allowed_index)
+
+        # labels are small so they are always loaded into memory
+        y = np.column_stack([H5LazyArray(self.h5path, tg, allowed_index)[:] for tg in self.target])
+        if self.load_err is True:
+            y_err = np.column_stack([H5LazyArray(self.h5path, f'{tg}_err', allowed_index)[:] for tg in self.target])
+        if len(self.target) == 1:
+            y = y[:, 0]
+            y_err = y_err[:, 0] if self.load_err is True else None
 
         if self.load_err is True:
             return spectra, y, spectra_err, y_err
         else:
             return spectra, y
 
+    def load_normalization(self, mode, name='spectra'):
+        """
+        Load the normalization statistics of a dataset for the rows selected by this loader. They are computed in a
+        single streaming pass by Normalizer.fit() the first time and persisted in a ``_norm.h5`` file next to the h5
+        file, so they are only computed again if the h5 file is modified.
+
+        :param mode: normalization mode of Normalizer
+        :type mode: Union[int, str]
+        :param name: dataset name
+        :type name: str
+        :return: mean and std
+        :rtype: (ndarray, ndarray)
+        """
+        from astroNN.nn.utilities.normalizer import Normalizer
+
+        allowed_index = self.load_allowed_index()
+        digest = hashlib.sha1(np.ascontiguousarray(allowed_index, dtype=np.int64).tobytes()).hexdigest()
+        key = f'{name}/mode_{mode}/{digest}'
+        mtime = os.stat(self.h5path).st_mtime_ns
+        norm_path = f'{os.path.splitext(self.h5path)[0]}_norm.h5'
+
+        with h5py.File(norm_path, 'a') as F:
+            if key in F and F[key].attrs['mtime_ns'] == mtime:
+                return F[key]['mean'][()], F[key]['std'][()]
+
+            normalizer = Normalizer(mode=mode)
+            normalizer.fit(H5LazyArray(self.h5path, name, allowed_index))
+            if key in F:
+                del F[key]
+            grp = F.create_group(key)
+            grp.create_dataset('mean', data=normalizer.mean_labels)
+            grp.create_dataset('std', data=normalizer.std_labels)
+            grp.attrs['mtime_ns'] = mtime
+
+        return normalizer.mean_labels, normalizer.std_labels
+
     def load_entry(self, name):
         """
         NAME:
@@ -647,10 +628,7 @@ class H5Loader(object):
         HISTORY:
             2018-Feb-08 - Written - Henry Leung (University of Toronto)
         """
-        allowed_index = self.load_allowed_index()
-        allowed_index_list = allowed_index.tolist()
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            return np.array(F[f'{name}'])[allowed_index_list]
+        return self._load_rows(name, self.load_allowed_index())
 
 
 def target_conversion(target):
@@ -2,9 +2,14 @@
 #   astroNN.datasets.xmatch: matching function between catalog
 # ---------------------------------------------------------#
 
+import hashlib
+import os
+import pickle
+
 import astropy.coordinates as acoords
 import numpy as np
 from astropy import units as u
+from packaging import version
 
 
 # ---------------------------------------------------------#
@@ -68,3 +73,260 @@ def xmatch(cat1, cat2, maxdist=2, colRA1=1, colDec1=1, epoch1=2000., colRA2=1, c
         return m2, m1, d2d[mindx]
     else:
         return m1, m2, d2d[mindx]
+
+
+def _radec_to_xyz(ra, dec):
+    """
+    Convert RA and DEC in degree to unit vectors
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _chord_to_arcsec(chord):
+    """
+    Convert distance between unit vectors to angular separation in arcsec
+    """
+    return np.degrees(2. * np.arcsin(np.clip(chord / 2., 0., 1.))) * 3600.
+
+
+def _workers_kwargs(workers):
+    """
+    Keyword argument of number of processes of KD-tree queries, which is n_jobs before scipy 1.6
+    """
+    import scipy
+
+    return {'workers' if version.parse(scipy.__version__) >= version.parse('1.6.0') else 'n_jobs': workers}
+
+
+def _catalog_checksum(ra, dec, epoch, pmra, pmdec, leafsize):
+    """
+    Checksum of a catalog and the parameters of its cross-match index
+    """
+    sha1 = hashlib.sha1()
+    for array in (ra, dec):
+        sha1.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    for array in (pmra, pmdec):
+        if array is not None:
+            sha1.update(np.nan_to_num(np.asarray(array, dtype=np.float64)).tobytes())
+    sha1.update(repr((float(epoch), leafsize)).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class XMatchIndex(object):
+    """
+    | Reusable cross-match index of a catalog, a KD-tree of unit vectors of the catalog is built once and then used to
+    | answer nearest and all-within-radius queries for many sources in chunks on multiple cores. Proper motion of the
+    | catalog is used to propagate the catalog to the epoch of queries as ``xmatch()`` does, the KD-tree of every epoch
+    | is only built once. The index can be saved to disk with ``save()`` and loaded with ``XMatchIndex.load()``.
+    | Sources with unknown (NaN) proper motion are not propagated.
+
+    :param ra: right ascension in degree of the catalog (assumed to be ICRS)
+    :type ra: ndarray
+    :param dec: declination in degree of the catalog (assumed to be ICRS)
+    :type dec: ndarray
+    :param epoch: epoch of the coordinates of the catalog
+    :type epoch: float
+    :param pmra: proper motion in right ascension in mas/yr of the catalog (includes cos(Dec)),
+        None for no proper motion
+    :type pmra: Union[NoneType, ndarray]
+    :param pmdec: proper motion in declination in mas/yr of the catalog, None for no proper motion
+    :type pmdec: Union[NoneType, ndarray]
+    :param leafsize: Leaf size of the KD-tree
+    :type leafsize: int
+    """
+
+    def __init__(self, ra, dec, epoch=2000., pmra=None, pmdec=None, leafsize=16):
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.epoch = float(epoch)
+        if (pmra is None) != (pmdec is None):
+            raise ValueError('Both or neither of pmra and pmdec should be provided')
+        self.pmra = None if pmra is None else np.nan_to_num(np.asarray(pmra, dtype=np.float64))
+        self.pmdec = None if pmdec is None else np.nan_to_num(np.asarray(pmdec, dtype=np.float64))
+        self.leafsize = leafsize
+        self._trees = {}
+        self.tree(self.epoch)
+
+    def __len__(self):
+        return self.ra.shape[0]
+
+    def tree(self, epoch=None):
+        """
+        KD-tree of unit vectors of the catalog at an epoch, built if it is not built yet
+
+        :param epoch: epoch, default to the epoch of the catalog
+        :type epoch: Union[NoneType, float]
+        :return: KD-tree
+        :rtype: scipy.spatial.cKDTree
+        """
+        from scipy.spatial import cKDTree
+
+        epoch = self.epoch if epoch is None or self.pmra is None else float(epoch)
+        if epoch not in self._trees:
+            depoch = self.epoch - epoch
+            ra, dec = self.ra, self.dec
+            if depoch != 0.:
+                # Use proper motion to get the catalog at the epoch
+                ra = ra - self.pmra / np.cos(np.radians(dec)) / 3600000. * depoch
+                dec = dec - self.pmdec / 3600000. * depoch
+            self._trees[epoch] = cKDTree(_radec_to_xyz(ra, dec), leafsize=self.leafsize)
+        return self._trees[epoch]
+
+    def _chunks(self, ra, dec, chunk_size):
+        ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+        if ra.shape != dec.shape:
+            raise ValueError('ra and dec should have the same shape')
+        for i in range(0, ra.shape[0], chunk_size):
+            yield i, _radec_to_xyz(ra[i:i + chunk_size], dec[i:i + chunk_size])
+
+    def query(self, ra, dec, maxdist=2, epoch=2000., chunk_size=1000000, workers=-1):
+        """
+        Find the closest source in the catalog within maxdist for each source, same as
+        ``xmatch(cat1, catalog, swap=False)``
+
+        :param ra: right ascension in degree of the sources (assumed to be ICRS)
+        :type ra: ndarray
+        :param dec: declination in degree of the sources (assumed to be ICRS)
+        :type dec: ndarray
+        :param maxdist: maximum distance in arcsec
+        :type maxdist: float
+        :param epoch: epoch of the coordinates of the sources
+        :type epoch: float
+        :param chunk_size: Number of sources queried at once
+        :type chunk_size: int
+        :param workers: Number of processes used by the query, -1 to use all CPUs
+        :type workers: int
+        :return: index into sources of matching objects, index into the catalog of matching objects,
+            angular separation between matching objects
+        :rtype: (ndarray, ndarray, astropy.coordinates.Angle)
+        """
+        tree = self.tree(epoch)
+        max_chord = 2. * np.sin(np.radians(maxdist / 3600.) / 2.)
+        m1, m2, sep = [], [], []
+        for start, xyz in self._chunks(ra, dec, chunk_size):
+            chord, idx = tree.query(xyz, k=1, distance_upper_bound=max_chord, **_workers_kwargs(workers))
+            # unmatched sources have infinite distance and index of len(catalog)
+            matched = np.isfinite(chord) & (chord < max_chord)
+            m1.append(np.nonzero(matched)[0] + start)
+            m2.append(idx[matched])
+            sep.append(_chord_to_arcsec(chord[matched]))
+        return (np.concatenate(m1), np.concatenate(m2),
+                acoords.Angle(np.concatenate(sep) / 3600., unit=u.degree))
+
+    def query_radius(self, ra, dec, radius=2, epoch=2000., chunk_size=100000, workers=-1):
+        """
+        Find every source in the catalog within radius for each source
+
+        :param ra: right ascension in degree of the sources (assumed to be ICRS)
+        :type ra: ndarray
+        :param dec: declination in degree of the sources (assumed to be ICRS)
+        :type dec: ndarray
+        :param radius: radius in arcsec
+        :type radius: float
+        :param epoch: epoch of the coordinates of the sources
+        :type epoch: float
+        :param chunk_size: Number of sources queried at once
+        :type chunk_size: int
+        :param workers: Number of processes used by the query, -1 to use all CPUs
+        :type workers: int
+        :return: index into sources of every pair, index into the catalog of every pair,
+            angular separation of every pair
+        :rtype: (ndarray, ndarray, astropy.coordinates.Angle)
+        """
+        tree = self.tree(epoch)
+        max_chord = 2. * np.sin(np.radians(radius / 3600.) / 2.)
+        catalog_xyz = tree.data
+        m1, m2, sep = [], [], []
+        for start, xyz in self._chunks(ra, dec, chunk_size):
+            neighbours = tree.query_ball_point(xyz, r=max_chord, **_workers_kwargs(workers))
+            num = np.fromiter(map(len, neighbours), dtype=np.intp, count=xyz.shape[0])
+            idx1 = np.repeat(np.arange(xyz.shape[0]), num)
+            idx2 = np.fromiter((i for neighbour in neighbours for i in neighbour), dtype=np.intp, count=num.sum())
+            m1.append(idx1 + start)
+            m2.append(idx2)
+            sep.append(_chord_to_arcsec(np.linalg.norm(xyz[idx1] - catalog_xyz[idx2], axis=-1)))
+        return (np.concatenate(m1), np.concatenate(m2),
+                acoords.Angle(np.concatenate(sep) / 3600., unit=u.degree))
+
+    def checksum(self):
+        """
+        Checksum of the catalog to check if a saved index is built from the same catalog
+
+        :return: checksum
+        :rtype: str
+        """
+        return _catalog_checksum(self.ra, self.dec, self.epoch, self.pmra, self.pmdec, self.leafsize)
+
+    def save(self, filename):
+        """
+        Save the index with every built KD-tree, written atomically so it can be shared by processes
+
+        :param filename: file name
+        :type filename: str
+        :return: None
+        """
+        temp_path = f'{filename}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, filename)
+
+    @staticmethod
+    def load(filename):
+        """
+        Load an index saved by ``save()``
+
+        :param filename: file name
+        :type filename: str
+        :return: cross-match index
+        :rtype: XMatchIndex
+        """
+        with open(filename, 'rb') as f:
+            index = pickle.load(f)
+        if not isinstance(index, XMatchIndex):
+            raise ValueError(f'{filename} is not a cross-match index')
+        return index
+
+
+def xmatch_index(ra, dec, filename, epoch=2000., pmra=None, pmdec=None, leafsize=16):
+    """
+    Load a cross-match index of a catalog saved to filename, or build and save it if it does not exist or is built
+    from a different catalog
+
+    :param ra: right ascension in degree of the catalog (assumed to be ICRS)
+    :type ra: ndarray
+    :param dec: declination in degree of the catalog (assumed to be ICRS)
+    :type dec: ndarray
+    :param filename: file name of the saved index
+    :type filename: str
+    :param epoch: epoch of the coordinates of the catalog
+    :type epoch: float
+    :param pmra: proper motion in right ascension in mas/yr of the catalog (includes cos(Dec)),
+        None for no proper motion
+    :type pmra: Union[NoneType, ndarray]
+    :param pmdec: proper motion in declination in mas/yr of the catalog, None for no proper motion
+    :type pmdec: Union[NoneType, ndarray]
+    :param leafsize: Leaf size of the KD-tree
+    :type leafsize: int
+    :return: cross-match index
+    :rtype: XMatchIndex
+    """
+    checksum = _catalog_checksum(ra, dec, epoch, pmra, pmdec, leafsize)
+
+    if os.path.isfile(filename):
+        try:
+            saved_index = XMatchIndex.load(filename)
+            if saved_index.checksum() == checksum:
+                return saved_index
+        # corrupted index is built again
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError):
+            pass
+
+    index = XMatchIndex(ra, dec, epoch=epoch, pmra=pmra, pmdec=pmdec, leafsize=leafsize)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        index.save(filename)
+    except OSError:  # index is still usable in this process if the folder is read-only
+        pass
+    return index
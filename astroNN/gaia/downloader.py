@@ -11,7 +11,7 @@ from astropy.io import fits
 import astroNN
 from astroNN.gaia.gaia_shared import gaia_env, gaia_default_dr
 from astroNN.shared.custom_warnings import deprecated
-from astroNN.shared.downloader_tools import TqdmUpTo, filehash
+from astroNN.shared.downloader_tools import TqdmUpTo, cached_filehash, hash_manifest
 
 currentdir = os.getcwd()
 
@@ -39,19 +39,19 @@ def tgas(flag=None):
     if not os.path.isfile(full_hash_filename):
         urllib.request.urlretrieve(urlbase + hash_filename, full_hash_filename)
 
-    hash_list = np.loadtxt(full_hash_filename, dtype='str').T
+    hashes = hash_manifest(full_hash_filename)
 
     for i in range(0, 16, 1):
         filename = f'TgasSource_000-000-0{i:0{2}d}.fits'
         fullfilename = os.path.join(folderpath, filename)
         urlstr = urlbase + filename
-        file_hash = (hash_list[0])[np.argwhere(hash_list[1] == filename)]
+        file_hash = hashes.get(filename)
 
         # Check if files exists
         if os.path.isfile(fullfilename) and flag is None:
-            checksum = filehash(fullfilename, algorithm='md5')
-            # In some rare case, the hash cant be found, so during checking, check len(file_has)!=0 too
-            if checksum != file_hash and len(file_hash) != 0:
+            checksum = cached_filehash(fullfilename, algorithm='md5')
+            # In some rare case, the hash cant be found, so during checking, check file_hash is not None too
+            if checksum is not None and file_hash is not None and checksum != file_hash:
                 print(checksum)
                 print(file_hash)
                 print('File corruption detected, astroNN attempting to download again')
@@ -64,8 +64,8 @@ def tgas(flag=None):
             with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
                 # Download
                 urllib.request.urlretrieve(urlstr, fullfilename, reporthook=t.update_to)
-                checksum = filehash(fullfilename, algorithm='md5')
-                if checksum != file_hash and len(file_hash) != 0:
+                checksum = cached_filehash(fullfilename, algorithm='md5', policy='always')
+                if file_hash is not None and checksum != file_hash:
                     print('File corruption detected, astroNN attempting to download again')
                     tgas(flag=1)
             print(f'Downloaded Gaia DR1 TGAS ({i:d} of 15) file catalog successfully to {fullfilename}')
@@ -154,7 +154,7 @@ def gaia_source(dr=None, flag=None):
         if not os.path.isfile(full_hash_filename):
             urllib.request.urlretrieve(urlbase + hash_filename, full_hash_filename)
 
-        hash_list = np.loadtxt(full_hash_filename, dtype='str').T
+        hashes = hash_manifest(full_hash_filename)
 
         for j in range(0, 20, 1):
             for i in range(0, 256, 1):
@@ -162,13 +162,13 @@ def gaia_source(dr=None, flag=None):
                 urlstr = urlbase + filename
 
                 fullfilename = os.path.join(folderpath, filename)
-                file_hash = (hash_list[0])[np.argwhere(hash_list[1] == filename)]
+                file_hash = hashes.get(filename)
 
                 # Check if files exists
                 if os.path.isfile(fullfilename) and flag is None:
-                    checksum = filehash(fullfilename, algorithm='md5')
-                    # In some rare case, the hash cant be found, so during checking, check len(file_has)!=0 too
-                    if checksum != file_hash and len(file_hash) != 0:
+                    checksum = cached_filehash(fullfilename, algorithm='md5')
+                    # In some rare case, the hash cant be found, so during checking, check file_hash is not None too
+                    if checksum is not None and file_hash is not None and checksum != file_hash:
                         print(checksum)
                         print(file_hash)
                         print('File corruption detected, astroNN attempting to download again')
@@ -179,8 +179,8 @@ def gaia_source(dr=None, flag=None):
                     # progress bar
                     with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
                         urllib.request.urlretrieve(urlstr, fullfilename, reporthook=t.update_to)
-                        checksum = filehash(fullfilename, algorithm='md5')
-                        if checksum != file_hash and len(file_hash) != 0:
+                        checksum = cached_filehash(fullfilename, algorithm='md5', policy='always')
+                        if file_hash is not None and checksum != file_hash:
                             print('File corruption detected, astroNN attempting to download again')
                             gaia_source(dr=dr, flag=1)
                     print(f'Downloaded Gaia DR{dr} Gaia Source ({(j * 256 + i):d} of {(256 * 20 + 112):d}) '
@@ -192,12 +192,12 @@ def gaia_source(dr=None, flag=None):
             urlstr = urlbase + filename
 
             fullfilename = os.path.join(folderpath, filename)
-            file_hash = (hash_list[0])[np.argwhere(hash_list[1] == filename)]
+            file_hash = hashes.get(filename)
             # Check if files exists
             if os.path.isfile(fullfilename) and flag is None:
-                checksum = filehash(fullfilename, algorithm='md5')
-                # In some rare case, the hash cant be found, so during checking, check len(file_has)!=0 too
-                if checksum != file_hash and len(file_hash) != 0:
+                checksum = cached_filehash(fullfilename, algorithm='md5')
+                # In some rare case, the hash cant be found, so during checking, check file_hash is not None too
+                if checksum is not None and file_hash is not None and checksum != file_hash:
                     print(checksum)
                     print(file_hash)
                     print('File corruption detected, astroNN attempting to download again')
@@ -208,8 +208,8 @@ def gaia_source(dr=None, flag=None):
                 # progress bar
                 with TqdmUpTo(unit='B', unit_scale=True, miniters=1, desc=urlstr.split('/')[-1]) as t:
                     urllib.request.urlretrieve(urlstr, fullfilename, reporthook=t.update_to)
-                    checksum = filehash(fullfilename, algorithm='md5')
-                    if checksum != file_hash and len(file_hash) != 0:
+                    checksum = cached_filehash(fullfilename, algorithm='md5', policy='always')
+                    if file_hash is not None and checksum != file_hash:
                         print('File corruption detected, astroNN attempting to download again')
                         gaia_source(dr=dr, flag=1)
                     print(f'Downloaded Gaia DR{dr} Gaia Source ({(20 * 256 + i):d} of {(256 * 20 + 112):d}) file '
@@ -21,46 +21,73 @@ def wavelength_solution(dr=None):
     return lamost_wavegrid
 
 
-def smooth_spec(flux, ivar, wavelength, L=50):
+def smooth_spec(flux, ivar, wavelength, L=50, truncate=4., block_size=256):
     """
-    Smooth a spectrum with a running Gaussian.
+    Smooth a spectrum or a batch of spectra with a running Gaussian.
 
-    :param flux: The observed flux array.
+    The Gaussian kernel is truncated at ``truncate`` times ``L`` so each block of output pixels only needs the
+    neighbouring pixels within the cutoff instead of a dense weight matrix of all pixels pairs.
+
+    :param flux: The observed flux array, 1D for a spectrum or 2D for a batch of spectra
     :type flux: ndarray
-    :param ivar: The inverse variances of the fluxes.
+    :param ivar: The inverse variances of the fluxes, same shape as flux
     :type ivar: ndarray
     :param wavelength: An array of the wavelengths.
     :type wavelength: ndarray
-    :param L: The width of the Gaussian in pixels.
+    :param L: The width of the Gaussian in the unit of wavelength.
     :type L: int
+    :param truncate: Truncate the Gaussian at this many L, None to use all pixels
+    :type truncate: Union(float, NoneType)
+    :param block_size: Number of output pixels to be smoothed together
+    :type block_size: int
     :returns: An array of smoothed fluxes
     :rtype: ndarray
     """
 
     # Partial Credit: https://github.com/chanconrad/slomp/blob/master/lamost.py
-    w = np.exp(-0.5 * (wavelength[:, None] - wavelength[None, :]) ** 2 / L ** 2)
-    denominator = np.dot(ivar, w.T)
-    numerator = np.dot(flux * ivar, w.T)
+    flux = np.asarray(flux)
+    ivar = np.asarray(ivar)
+    wavelength = np.asarray(wavelength)
+    flux_ivar = flux * ivar
+
+    numerator = np.zeros(np.broadcast(flux_ivar, ivar).shape)
+    denominator = np.zeros(numerator.shape)
+    for start in range(0, wavelength.shape[0], block_size):
+        end = min(start + block_size, wavelength.shape[0])
+        if truncate is None:
+            low, high = 0, wavelength.shape[0]
+        else:
+            # wavelength is sorted so the pixels within cutoff of a block are contiguous
+            low = np.searchsorted(wavelength, wavelength[start] - truncate * L, side='left')
+            high = np.searchsorted(wavelength, wavelength[end - 1] + truncate * L, side='right')
+        w = np.exp(-0.5 * (wavelength[start:end, None] - wavelength[None, low:high]) ** 2 / L ** 2)
+        if truncate is not None:
+            w[np.abs(wavelength[start:end, None] - wavelength[None, low:high]) > truncate * L] = 0.
+        denominator[..., start:end] = np.dot(ivar[..., low:high], w.T)
+        numerator[..., start:end] = np.dot(flux_ivar[..., low:high], w.T)
+
     bad_pixel = denominator == 0
     smoothed = np.zeros(numerator.shape)
     smoothed[~bad_pixel] = numerator[~bad_pixel] / denominator[~bad_pixel]
     return smoothed
 
 
-def pseudo_continuum(flux, ivar, wavelength=None, L=50, dr=None):
+def pseudo_continuum(flux, ivar, wavelength=None, L=50, dr=None, truncate=4.):
     """
-    Pseudo-Continuum normalise a spectrum by dividing by a Gaussian-weighted smoothed spectrum.
+    Pseudo-Continuum normalise a spectrum or a batch of spectra by dividing by a Gaussian-weighted smoothed spectrum.
 
-    :param flux: The observed flux array.
+    :param flux: The observed flux array, 1D for a spectrum or 2D for a batch of spectra
     :type flux: ndarray
-    :param ivar: The inverse variances of the fluxes.
+    :param ivar: The inverse variances of the fluxes, same shape as flux
     :type ivar: ndarray
     :param wavelength: An array of the wavelengths.
     :type wavelength: ndarray
-    :param L: [optional] The width of the Gaussian in pixels.
+    :param L: [optional] The width of the Gaussian in the unit of wavelength.
     :type L: int
     :param dr: [optional] dara release
     :type dr: int
+    :param truncate: [optional] Truncate the Gaussian at this many L, None to use all pixels
+    :type truncate: Union(float, NoneType)
     :returns: Continuum normalized flux and flux uncerteinty
     :rtype: ndarray
     """
@@ -72,7 +99,7 @@ def pseudo_continuum(flux, ivar, wavelength=None, L=50, dr=None):
     if wavelength is None:
         wavelength = wavelength_solution(dr=dr)
 
-    smoothed_spec = smooth_spec(wavelength, flux, ivar, L)
+    smoothed_spec = smooth_spec(flux, ivar, wavelength, L=L, truncate=truncate)
     norm_flux = flux / smoothed_spec
     norm_ivar = smoothed_spec * ivar * smoothed_spec
 
@@ -2,6 +2,7 @@ import importlib
 import json
 import os
 import sys
+import threading
 
 import h5py
 import numpy as np
@@ -33,6 +34,9 @@ _GRAPH_COUTNER = 0  # keep track of the indices used in list storage below
 _GRAPH_STORAGE = []  # store all the graph used by multiple models
 _SESSION_STORAGE = []  # store all the graph used by multiple models
 
+_MODEL_CACHE = {}  # inference only models loaded in this process, folder path -> (files modification time, model)
+_MODEL_CACHE_LOCK = threading.Lock()
+
 
 def Galaxy10CNN():
     """
@@ -85,16 +89,47 @@ def convert_custom_objects(obj):
     return obj
 
 
-def load_folder(folder=None):
+def load_folder(folder=None, inference_only=False):
     """
     To load astroNN model object from folder
 
+    | With inference_only=True, optimizer weights are not restored and train function is not built so the model can
+    | only be used for inference (test, evaluate, jacobian...). The model is cached in this process by folder path
+    | and modification time of model files, loading the same unchanged folder again returns the same model object.
+
     :param folder: [optional] you should provide folder name if outside folder, do not specific when you are inside the folder
     :type folder: str
+    :param inference_only: True to load the model for inference only with the process cache
+    :type inference_only: bool
     :return: astroNN Neural Network instance
     :rtype: astroNN.nn.NeuralNetMaster.NeuralNetMaster
     :History: 2017-Dec-29 - Written - Henry Leung (University of Toronto)
     """
+    if inference_only is not True:
+        return _load_folder(folder)
+
+    fullfilepath = os.path.realpath(os.path.join(os.getcwd(), folder) if folder is not None else os.getcwd())
+    stamp = []
+    for filename in ('astroNN_model_parameter.json', 'model_weights.h5'):
+        try:
+            stamp.append(os.stat(os.path.join(fullfilepath, filename)).st_mtime_ns)
+        except FileNotFoundError:
+            stamp.append(None)
+    stamp = tuple(stamp)
+
+    with _MODEL_CACHE_LOCK:
+        cached = _MODEL_CACHE.get(fullfilepath)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        astronn_model_obj = _load_folder(folder, inference_only=True)
+        _MODEL_CACHE[fullfilepath] = (stamp, astronn_model_obj)
+    return astronn_model_obj
+
+
+def _load_folder(folder=None, inference_only=False):
+    """
+    Load astroNN model object from folder without cache, see ``load_folder()``
+    """
     currentdir = os.getcwd()
 
     if folder is not None:
@@ -290,12 +325,13 @@ def load_folder(folder=None):
         astronn_model_obj.keras_model.load_weights(
             os.path.join(astronn_model_obj.fullfilepath, 'model_weights.h5'))
 
-        # Build train function (to get weight updates), need to consider Sequential model too
-        astronn_model_obj.keras_model._make_train_function()
-        optimizer_weights_group = f['optimizer_weights']
-        optimizer_weight_names = [n.decode('utf8') for n in optimizer_weights_group.attrs['weight_names']]
-        optimizer_weight_values = [optimizer_weights_group[n] for n in optimizer_weight_names]
-        astronn_model_obj.keras_model.optimizer.set_weights(optimizer_weight_values)
+        if inference_only is not True:
+            # Build train function (to get weight updates), need to consider Sequential model too
+            astronn_model_obj.keras_model._make_train_function()
+            optimizer_weights_group = f['optimizer_weights']
+            optimizer_weight_names = [n.decode('utf8') for n in optimizer_weights_group.attrs['weight_names']]
+            optimizer_weight_values = [optimizer_weights_group[n] for n in optimizer_weight_names]
+            astronn_model_obj.keras_model.optimizer.set_weights(optimizer_weight_values)
 
     astronn_model_obj.graph = _GRAPH_STORAGE[_GRAPH_COUTNER - 1]  # the graph associated with the model
     astronn_model_obj.session = _SESSION_STORAGE[_GRAPH_COUTNER - 1]  # the model associated with the model
@@ -1,15 +1,18 @@
+import copy
 import json
-import os
 import time
 import warnings
 from abc import ABC
 
+import h5py
 import numpy as np
+import tensorflow as tf
 import tensorflow.keras as tfk
 from astroNN.config import MULTIPROCESS_FLAG
 from astroNN.config import _astroNN_MODEL_NAME
 from astroNN.datasets import H5Loader
 from astroNN.models.base_master_nn import NeuralNetMaster
+from astroNN.nn import reduce_var
 from astroNN.nn.callbacks import VirutalCSVLogger
 from astroNN.nn.layers import FastMCInference
 from astroNN.nn.losses import mean_absolute_error, mean_error
@@ -38,40 +41,54 @@ class BayesianCNNDataGenerator(GeneratorMaster):
     :type data: list
     :param manual_reset: Whether need to reset the generator manually, usually it is handled by tensorflow
     :type manual_reset: bool
+    :param input_normalizer: Normalizer to normalize inputs and inputs error batch by batch, None if data are normalized
+    :type input_normalizer: Union[NoneType, astroNN.nn.utilities.normalizer.Normalizer]
     :History:
         | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
         | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False):
+    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False, input_normalizer=None):
         super().__init__(batch_size=batch_size, shuffle=shuffle, steps_per_epoch=steps_per_epoch, data=data,
                          manual_reset=manual_reset)
         self.inputs = self.data[0]
         self.labels = self.data[1]
         self.input_err = self.data[2]
         self.labels_err = self.data[3]
+        self.input_normalizer = input_normalizer
 
         # initial idx
         self.idx_list = self._get_exploration_order(range(self.inputs.shape[0]))
         self.current_idx = 0
 
     def _data_generation(self, inputs, labels, input_err, labels_err, idx_list_temp):
+        if self.input_normalizer is not None:
+            # inputs are read (e.g. from H5LazyArray) and normalized only for this batch
+            inputs_batch = inputs[idx_list_temp]
+            if input_err is None:
+                input_err = np.zeros_like(inputs_batch)
+            else:
+                input_err = input_err[idx_list_temp] / self.input_normalizer.std_labels
+            inputs = self.input_normalizer.normalize(inputs_batch, calc=False, out=inputs_batch)
+            labels, labels_err = labels[idx_list_temp], labels_err[idx_list_temp]
+            idx_list_temp = np.arange(len(idx_list_temp))
         x = self.input_d_checking(inputs, idx_list_temp)
         y = labels[idx_list_temp]
-        x_err = self.input_d_checking(input_err, idx_list_temp)
+        x_err = self.input_d_checking(input_err, idx_list_temp, key='input_err')
         y_err = labels_err[idx_list_temp]
         return x, y, x_err, y_err
 
+    def _get_batch(self, idx_list_temp):
+        x, y, x_err, y_err = self._data_generation(self.inputs, self.labels, self.input_err, self.labels_err,
+                                                   idx_list_temp)
+        return {'input': x, 'labels_err': y_err, 'input_err': x_err}, {'output': y, 'variance_output': y}
+
     def __getitem__(self, index):
-        x, y, x_err, y_err = self._data_generation(self.inputs,
-                                                   self.labels,
-                                                   self.input_err,
-                                                   self.labels_err,
-                                                   self.idx_list[self.current_idx:self.current_idx + self.batch_size])
+        batch = self._get_batch(self.idx_list[self.current_idx:self.current_idx + self.batch_size])
         self.current_idx += self.batch_size
         if (self.current_idx+self.batch_size >= self.steps_per_epoch*self.batch_size-1) and self.manual_reset:
             self.current_idx = 0
-        return {'input': x, 'labels_err': y_err, 'input_err': x_err}, {'output': y, 'variance_output': y}
+        return batch
 
     def on_epoch_end(self):
         # shuffle the list when epoch ends for the next epoch
@@ -109,17 +126,19 @@ class BayesianCNNPredDataGenerator(GeneratorMaster):
 
     def _data_generation(self, inputs, input_err, idx_list_temp):
         x = self.input_d_checking(inputs, idx_list_temp)
-        x_err = self.input_d_checking(input_err, idx_list_temp)
+        x_err = self.input_d_checking(input_err, idx_list_temp, key='input_err')
         return x, x_err
 
+    def _get_batch(self, idx_list_temp):
+        x, x_err = self._data_generation(self.inputs, self.input_err, idx_list_temp)
+        return {'input': x, 'input_err': x_err}
+
     def __getitem__(self, index):
-        x, x_err = self._data_generation(self.inputs,
-                                         self.input_err,
-                                         self.idx_list[self.current_idx:self.current_idx + self.batch_size])
+        batch = self._get_batch(self.idx_list[self.current_idx:self.current_idx + self.batch_size])
         self.current_idx += self.batch_size
         if (self.current_idx+self.batch_size >= self.steps_per_epoch*self.batch_size-1) and self.manual_reset:
             self.current_idx = 0
-        return {'input': x, 'input_err': x_err}
+        return batch
 
     def on_epoch_end(self):
         # shuffle the list when epoch ends for the next epoch
@@ -156,6 +175,7 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         self.dropout_rate = 0.2
         self.length_scale = 3  # prior length scale
         self.mc_num = 100  # increased to 100 due to high performance VI on GPU implemented on 14 April 2018 (Henry)
+        self.mc_memory_budget = 2 ** 30  # bytes of activations allowed in a Monte Carlo forward pass in test()
         self.val_size = 0.1
         self.disable_dropout = False
 
@@ -163,29 +183,46 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         self.labels_norm_mode = 2
 
         self.keras_model_predict = None
+        self._mc_model_cache = {}  # FastMCInference models of keras_model_predict by (mc_num, input shape)
 
     def pre_training_checklist_child(self, input_data, labels, input_err, labels_err):
-        self.pre_training_checklist_master(input_data, labels)
-
+        # H5Loader is loaded lazily and inputs are normalized batch by batch to avoid loading the dataset in memory
+        lazy_loader = None
         if isinstance(input_data, H5Loader):
-            self.targetname = input_data.target
-            input_data, labels = input_data.load()
+            # lazily loaded by a copy so the loader of the caller is unchanged
+            lazy_loader = copy.copy(input_data)
+            self.targetname = lazy_loader.target
+            lazy_loader.lazy = True
+            if lazy_loader.load_err is True:
+                input_data, labels, input_err, labels_err = lazy_loader.load()
+            else:
+                input_data, labels = lazy_loader.load()
+                input_err, labels_err = None, np.zeros_like(labels)
+
+        self.pre_training_checklist_master(input_data, labels)
 
         # check if exists (exists mean fine-tuning, so we do not need calculate mean/std again)
         if self.input_normalizer is None:
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            if lazy_loader is not None:
+                # use the persisted statistics of the dataset, computed only if they do not exist yet
+                self.input_normalizer.set_statistics(*lazy_loader.load_normalization(self.input_norm_mode))
+                norm_data = input_data
+            else:
+                norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = input_data if lazy_loader is not None else \
+                self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
         # No need to care about Magic number as loss function looks for magic num in y_true only
-        norm_input_err = input_err / self.input_std
+        norm_input_err = input_err if lazy_loader is not None else \
+            np.divide(input_err, self.input_std, dtype=np.float32)
         norm_labels_err = labels_err / self.labels_std
 
         if self.keras_model is None:  # only compiler if there is no keras_model, e.g. fine-tuning does not required
@@ -196,24 +233,37 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
 
         self.inv_model_precision = (2 * self.num_train * self.l2) / (self.length_scale ** 2 * (1 - self.dropout_rate))
 
+        if lazy_loader is not None:
+            # sorted so the lazy subsets read the file in order, the generators shuffle them anyway
+            self.train_idx, self.val_idx = np.sort(self.train_idx), np.sort(self.val_idx)
+            train_data = [norm_data.subset(self.train_idx), norm_labels[self.train_idx],
+                          None if norm_input_err is None else norm_input_err.subset(self.train_idx),
+                          norm_labels_err[self.train_idx]]
+            val_data = [norm_data.subset(self.val_idx), norm_labels[self.val_idx],
+                        None if norm_input_err is None else norm_input_err.subset(self.val_idx),
+                        norm_labels_err[self.val_idx]]
+            generator_normalizer = self.input_normalizer
+        else:
+            train_data = [norm_data[self.train_idx], norm_labels[self.train_idx], norm_input_err[self.train_idx],
+                          norm_labels_err[self.train_idx]]
+            val_data = [norm_data[self.val_idx], norm_labels[self.val_idx], norm_input_err[self.val_idx],
+                        norm_labels_err[self.val_idx]]
+            generator_normalizer = None
+
         self.training_generator = BayesianCNNDataGenerator(batch_size=self.batch_size,
                                                            shuffle=True,
                                                            steps_per_epoch=self.num_train // self.batch_size,
-                                                           data=[norm_data[self.train_idx],
-                                                                 norm_labels[self.train_idx],
-                                                                 norm_input_err[self.train_idx],
-                                                                 norm_labels_err[self.train_idx]],
-                                                           manual_reset=False)
+                                                           data=train_data,
+                                                           manual_reset=False,
+                                                           input_normalizer=generator_normalizer)
 
         val_batchsize = self.batch_size if len(self.val_idx) > self.batch_size else len(self.val_idx)
         self.validation_generator = BayesianCNNDataGenerator(batch_size=val_batchsize,
                                                              shuffle=False,
                                                              steps_per_epoch=max(self.val_num // self.batch_size, 1),
-                                                             data=[norm_data[self.val_idx],
-                                                                   norm_labels[self.val_idx],
-                                                                   norm_input_err[self.val_idx],
-                                                                   norm_labels_err[self.val_idx]],
-                                                           manual_reset=True)
+                                                             data=val_data,
+                                                             manual_reset=True,
+                                                             input_normalizer=generator_normalizer)
 
         return norm_data, norm_labels, norm_input_err, norm_labels_err
 
@@ -241,6 +291,9 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             raise RuntimeError('Only "regression", "classification" and "binary_classification" are supported')
 
         self.keras_model, self.keras_model_predict, output_loss, variance_loss = self.model()
+        # cached models and gradient tensors are of the old models
+        self._mc_model_cache = {}
+        self._jacobian_cache = {}
 
         if self.task == 'regression':
             self.metrics = [mean_absolute_error, mean_error] if not (metrics and self.metrics) else metrics
@@ -275,9 +328,9 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         """
         Train a Bayesian neural network
 
-        :param input_data: Data to be trained with neural network
-        :type input_data: ndarray
-        :param labels: Labels to be trained with neural network
+        :param input_data: Data to be trained with neural network, or H5Loader to stream data from h5 file
+        :type input_data: Union([ndarray, H5Loader])
+        :param labels: Labels to be trained with neural network, ignored if input_data is H5Loader
         :type labels: ndarray
         :param inputs_err: Error for input_data (if any), same shape with input_data.
         :type inputs_err: Union([NoneType, ndarray])
@@ -289,11 +342,12 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             | 2018-Jan-06 - Written - Henry Leung (University of Toronto)
             | 2018-Apr-12 - Updated - Henry Leung (University of Toronto)
         """
-        if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+        if not isinstance(input_data, H5Loader):
+            if inputs_err is None:
+                inputs_err = np.zeros_like(input_data)
 
-        if labels_err is None:
-            labels_err = np.zeros_like(labels)
+            if labels_err is None:
+                labels_err = np.zeros_like(labels)
 
         # Call the checklist to create astroNN folder and save parameters
         self.pre_training_checklist_child(input_data, labels, inputs_err, labels_err)
@@ -314,12 +368,7 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
 
         start_time = time.time()
 
-        self.history = self.keras_model.fit_generator(generator=self.training_generator,
-                                                      validation_data=self.validation_generator,
-                                                      epochs=self.max_epochs, verbose=self.verbose,
-                                                      workers=os.cpu_count(),
-                                                      callbacks=self.__callbacks,
-                                                      use_multiprocessing=MULTIPROCESS_FLAG)
+        self.history = self._fit_pipeline(self.__callbacks)
 
         print(f'Completed Training, {(time.time() - start_time):.{2}f}s in total')
 
@@ -358,16 +407,16 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
         # No need to care about Magic number as loss function looks for magic num in y_true only
-        norm_input_err = inputs_err / self.input_std
+        norm_input_err = np.divide(inputs_err, self.input_std, dtype=np.float32)
         norm_labels_err = labels_err / self.labels_std
 
         start_time = time.time()
@@ -383,8 +432,8 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         score = self.keras_model.fit_generator(fit_generator,
                                                epochs=1,
                                                verbose=self.verbose,
-                                               workers=os.cpu_count(),
-                                               use_multiprocessing=MULTIPROCESS_FLAG)
+                                               use_multiprocessing=MULTIPROCESS_FLAG,
+                                               **self._queue_kwargs([fit_generator]))
 
         print(f'Completed Training on Batch, {(time.time() - start_time):.{2}f}s in total')
 
@@ -427,18 +476,86 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         with open(self.fullfilepath + '/astroNN_model_parameter.json', 'w') as f:
             json.dump(data, f, indent=4, sort_keys=True)
 
-    def test(self, input_data, inputs_err=None):
+    def _mc_pass_nbytes(self):
         """
-        Test model, High performance version designed for fast variational inference on GPU
+        Estimate memory of activations in bytes of a single forward pass of a single data from layers output shapes
 
-        :param input_data: Data to be inferred with neural network
-        :type input_data: ndarray
-        :param inputs_err: Error for input_data, same shape with input_data.
-        :type inputs_err: Union([NoneType, ndarray])
-        :return: prediction and prediction uncertainty
-        :History:
-            | 2018-Jan-06 - Written - Henry Leung (University of Toronto)
-            | 2018-Apr-12 - Updated - Henry Leung (University of Toronto)
+        :return: Number of bytes
+        :rtype: int
+        """
+        num_activations = 0
+        for layer in self.keras_model_predict.layers:
+            try:
+                output_shapes = layer.output_shape
+            except (AttributeError, RuntimeError):  # layer with multiple inbound nodes
+                continue
+            if not isinstance(output_shapes, list):
+                output_shapes = [output_shapes]
+            for output_shape in output_shapes:
+                num_activations += int(np.prod([dim for dim in output_shape[1:] if dim is not None]))
+        return 4 * max(num_activations, 1)
+
+    def _fast_mc_model(self, mc_num):
+        """
+        Get FastMCInference model of keras_model_predict with mc_num forward passes, models are memoized by
+        (mc_num, input shape) until compile() so the graph does not grow with every call
+
+        :param mc_num: Number of Monte Carlo integration
+        :type mc_num: int
+        :return: Keras model
+        :rtype: tf.keras.Model
+        """
+        key = (mc_num, tuple(self.keras_model_predict.input_shape[1:]))
+        if key not in self._mc_model_cache:
+            self._mc_model_cache[key] = FastMCInference(mc_num)(self.keras_model_predict)
+        return self._mc_model_cache[key]
+
+    def _mc_inference(self, input_array, inputs_err):
+        """
+        Monte Carlo inference with batch size and number of forward passes at a time chosen from mc_memory_budget,
+        mean and variance of chunks of forward passes are merged with Chan et al. parallel algorithm so the result is
+        the same as doing all mc_num forward passes at once
+
+        :param input_array: Normalized data to be inferred with neural network
+        :type input_array: ndarray
+        :param inputs_err: Normalized error for input_array
+        :type inputs_err: ndarray
+        :return: Mean and variance of mc_num forward passes with shape (number of data, number of outputs, 2)
+        :rtype: ndarray
+        """
+        total_test_num = input_array.shape[0]  # Number of testing data
+
+        # number of (data, forward pass) allowed at a time, at least one forward pass of a data
+        num_passes = max(1, int(self.mc_memory_budget // self._mc_pass_nbytes()))
+        batch_size = max(1, min(self.batch_size, num_passes))
+        mc_chunk = int(np.clip(num_passes // batch_size, 1, self.mc_num))
+        output_size = int(np.prod(self.keras_model_predict.output_shape[1:]))
+
+        mean, m2, count = 0., 0., 0
+        while count < self.mc_num:
+            chunk_num = min(mc_chunk, self.mc_num - count)
+            new = self._fast_mc_model(chunk_num)
+
+            # Data Generator for prediction, batches are padded to batch_size
+            prediction_generator = BayesianCNNPredDataGenerator(batch_size=batch_size,
+                                                                shuffle=False,
+                                                                steps_per_epoch=-(-total_test_num // batch_size),
+                                                                data=[input_array, inputs_err])
+            # squeezed batch of single data is reshaped back to (number of data, number of outputs, 2)
+            chunk_result = self._predict_padded(new, prediction_generator, output_shape=(output_size, 2))
+
+            # merge mean and variance of this chunk of forward passes with those so far
+            new_count = count + chunk_num
+            delta = chunk_result[:, :, 0] - mean
+            mean = mean + delta * (chunk_num / new_count)
+            m2 = m2 + chunk_result[:, :, 1] * chunk_num + np.square(delta) * (count * chunk_num / new_count)
+            count = new_count
+
+        return np.stack((mean, m2 / self.mc_num), axis=-1)
+
+    def _test_checklist(self):
+        """
+        Checks before Monte Carlo inference
         """
         self.has_model_check()
         if gpu_availability() is False and self.mc_num > 25:
@@ -450,10 +567,21 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             raise AttributeError("mc_num cannot be smaller than 2")
         self.pre_testing_checklist_master()
 
+    def _test_normalize(self, input_data, inputs_err):
+        """
+        Normalize data and error to be inferred with neural network
+
+        :param input_data: Data to be inferred with neural network
+        :type input_data: ndarray
+        :param inputs_err: Error for input_data, same shape with input_data.
+        :type inputs_err: Union([NoneType, ndarray])
+        :return: normalized data and error
+        :rtype: tuple
+        """
         input_data = np.atleast_2d(input_data)
 
         if self.input_normalizer is not None:
-            input_array = self.input_normalizer.normalize(input_data, calc=False)
+            input_array = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
         else:
             # Prevent shallow copy issue
             input_array = np.array(input_data)
@@ -462,61 +590,27 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
 
         # if no error array then just zeros
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            inputs_err = np.zeros_like(input_array)
         else:
-            inputs_err = np.atleast_2d(inputs_err)
-            inputs_err /= self.input_std
+            inputs_err = np.divide(np.atleast_2d(inputs_err), self.input_std, dtype=np.float32)
 
-        total_test_num = input_data.shape[0]  # Number of testing data
+        return input_array, inputs_err
 
-        # for number of training data smaller than batch_size
-        if total_test_num < self.batch_size:
-            batch_size = total_test_num
-        else:
-            batch_size = self.batch_size
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // batch_size) * batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        start_time = time.time()
-        print("Starting Dropout Variational Inference")
-
-        # Data Generator for prediction
-        prediction_generator = BayesianCNNPredDataGenerator(batch_size=batch_size,
-                                                            shuffle=False,
-                                                            steps_per_epoch=data_gen_shape // batch_size,
-                                                            data=[input_array[:data_gen_shape],
-                                                                  inputs_err[:data_gen_shape]])
-
-        new = FastMCInference(self.mc_num)(self.keras_model_predict)
-
-        result = np.asarray(new.predict_generator(prediction_generator))
-
-        if remainder_shape != 0:  # deal with remainder
-            remainder_generator = BayesianCNNPredDataGenerator(batch_size=remainder_shape,
-                                                               shuffle=False,
-                                                               steps_per_epoch=1,
-                                                               data=[input_array[data_gen_shape:],
-                                                                     inputs_err[data_gen_shape:]])
-            remainder_result = np.asarray(new.predict_generator(remainder_generator))
-            if remainder_shape == 1:
-                remainder_result = np.expand_dims(remainder_result, axis=0)
-            result = np.concatenate((result, remainder_result))
-
-        # in case only 1 test data point, in such case we need to add a dimension
-        if result.ndim < 3 and batch_size == 1:
-            result = np.expand_dims(result, axis=0)
+    def _test_postprocess(self, result):
+        """
+        Turn mean and variance of Monte Carlo inference to denormalized prediction and uncertainty
 
+        :param result: Mean and variance of mc_num forward passes from _mc_inference()
+        :type result: ndarray
+        :return: prediction and prediction uncertainty
+        :rtype: tuple
+        """
         half_first_dim = result.shape[1] // 2  # result.shape[1] is guarantee an even number, otherwise sth is wrong
 
         predictions = result[:, :half_first_dim, 0]  # mean prediction
         mc_dropout_uncertainty = result[:, :half_first_dim, 1] * (self.labels_std ** 2)  # model uncertainty
         predictions_var = np.exp(result[:, half_first_dim:, 0]) * (self.labels_std ** 2)  # predictive uncertainty
 
-        print(f'Completed Dropout Variational Inference with {self.mc_num} forward passes, '
-              f'{(time.time() - start_time):.{2}f}s elapsed')
-
         if self.labels_normalizer is not None:
             predictions = self.labels_normalizer.denormalize(predictions)
         else:
@@ -563,6 +657,152 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         return predictions, {'total': pred_uncertainty, 'model': mc_dropout_uncertainty,
                              'predictive': predictive_uncertainty}
 
+    def _export_outputs(self, uncertainty):
+        """
+        keras_model_predict and its output, only the prediction part of the concatenated output if uncertainty is not
+        needed so variance output is pruned from the exported graph
+        """
+        output = self.keras_model_predict.output
+        if uncertainty is not True and output.op.type == 'ConcatV2':
+            output = output.op.inputs[0]
+        return self.keras_model_predict, {'output': output}
+
+    def _export_postprocess(self, outputs, mc_num, uncertainty):
+        """
+        Mean and variance of mc_num forward passes turned to denormalized prediction and uncertainty as
+        _test_postprocess() does
+        """
+        num_labels = int(self.keras_model_predict.output_shape[-1]) // 2
+        output = outputs['output']
+        output = tf.reshape(output, [-1, mc_num, int(output.shape[-1])])
+        output_mean = tf.reduce_mean(output, axis=1)
+        mean, std = self._export_norm_constants(self.labels_normalizer, self.labels_mean, self.labels_std, 1)
+        results = {'prediction': output_mean[:, :num_labels] * std + mean}
+        if uncertainty is True:
+            labels_var = np.square(np.asarray(self.labels_std, dtype=np.float32))
+            mc_dropout_uncertainty = reduce_var(output[:, :, :num_labels], axis=1) * labels_var
+            predictions_var = tf.exp(output_mean[:, num_labels:]) * labels_var
+            results.update({'total': tf.sqrt(predictions_var + mc_dropout_uncertainty),
+                            'model': tf.sqrt(mc_dropout_uncertainty),
+                            'predictive': tf.sqrt(predictions_var)})
+        return results
+
+    def export_inference_graph(self, filename, mc_num=None, uncertainty=True, float16=False):
+        """
+        | Export a frozen graph of Monte Carlo inference, variables are converted to constants and nodes not needed by
+        | the outputs are pruned (including the variance output if uncertainty=False). Normalization of data, mc_num
+        | forward passes and denormalization of prediction and uncertainty are operations inside the graph.
+        |
+        | The graph can be loaded with ``astroNN.nn.utilities.inference_graph.load_inference_graph()`` which only needs
+        | tensorflow, outputs are 'prediction' and 'total', 'model', 'predictive' uncertainty as ``test()`` returns.
+
+        :param filename: File name of the exported graph
+        :type filename: str
+        :param mc_num: Number of Monte Carlo integration, default to mc_num of the model
+        :type mc_num: Union[NoneType, int]
+        :param uncertainty: True to export uncertainty outputs, only for regression
+        :type uncertainty: bool
+        :param float16: True to store weights in float16 to halve the size of the graph, inference is still in float32
+        :type float16: bool
+        :return: None
+        """
+        if uncertainty is True and self.task != 'regression':
+            raise ValueError('Uncertainty can only be exported for regression, please use uncertainty=False')
+        mc_num = self.mc_num if mc_num is None else mc_num
+        super().export_inference_graph(filename, mc_num=mc_num, uncertainty=uncertainty, float16=float16)
+
+    def test(self, input_data, inputs_err=None):
+        """
+        Test model, High performance version designed for fast variational inference on GPU
+
+        :param input_data: Data to be inferred with neural network
+        :type input_data: ndarray
+        :param inputs_err: Error for input_data, same shape with input_data.
+        :type inputs_err: Union([NoneType, ndarray])
+        :return: prediction and prediction uncertainty
+        :History:
+            | 2018-Jan-06 - Written - Henry Leung (University of Toronto)
+            | 2018-Apr-12 - Updated - Henry Leung (University of Toronto)
+        """
+        self._test_checklist()
+        input_array, inputs_err = self._test_normalize(input_data, inputs_err)
+
+        start_time = time.time()
+        print("Starting Dropout Variational Inference")
+
+        result = self._mc_inference(input_array, inputs_err)
+
+        print(f'Completed Dropout Variational Inference with {self.mc_num} forward passes, '
+              f'{(time.time() - start_time):.{2}f}s elapsed')
+
+        return self._test_postprocess(result)
+
+    def _test_stream(self, input_data, inputs_err, chunk_size):
+        """
+        Generator of prediction and prediction uncertainty chunk by chunk, see test_stream()
+        """
+        if hasattr(input_data, 'shape') and hasattr(input_data, '__getitem__'):
+            chunks = ((input_data[i:i + chunk_size], None if inputs_err is None else inputs_err[i:i + chunk_size])
+                      for i in range(0, input_data.shape[0], chunk_size))
+        elif inputs_err is not None:
+            chunks = zip(input_data, inputs_err)
+        else:
+            chunks = (chunk if isinstance(chunk, tuple) else (chunk, None) for chunk in input_data)
+
+        start_time = time.time()
+        total_num = 0
+        for chunk, chunk_err in chunks:
+            input_array, chunk_err = self._test_normalize(np.asarray(chunk),
+                                                          None if chunk_err is None else np.asarray(chunk_err))
+            yield self._test_postprocess(self._mc_inference(input_array, chunk_err))
+            total_num += input_array.shape[0]
+
+        print(f'Completed Dropout Variational Inference of {total_num} data with {self.mc_num} forward passes, '
+              f'{(time.time() - start_time):.{2}f}s elapsed')
+
+    def test_stream(self, input_data, inputs_err=None, chunk_size=4096, sink=None):
+        """
+        Test model chunk by chunk so memory usage does not depend on the number of data
+
+        :param input_data: Data to be inferred with neural network, can be array-like supporting shape and slicing like
+            h5py dataset or H5LazyArray, or an iterator of chunks of data or (data, error) tuples
+        :type input_data: Union[ndarray, h5py.Dataset, astroNN.datasets.h5.H5LazyArray, Iterable]
+        :param inputs_err: Error for input_data in the same form with input_data
+        :type inputs_err: Union[NoneType, ndarray, h5py.Dataset, astroNN.datasets.h5.H5LazyArray, Iterable]
+        :param chunk_size: Number of data in a chunk if input_data supports slicing
+        :type chunk_size: int
+        :param sink: HDF5 file path or h5py group to write prediction and uncertainty (datasets "prediction",
+            "total", "model" and "predictive") chunk by chunk, or None to return a generator
+        :type sink: Union[NoneType, str, h5py.Group]
+        :return: Generator of prediction and prediction uncertainty of every chunk if sink is None, otherwise number
+            of data written to sink
+        :rtype: Union[Generator, int]
+        """
+        self._test_checklist()
+        results = self._test_stream(input_data, inputs_err, chunk_size)
+        if sink is None:
+            return results
+
+        h5f = h5py.File(sink, 'w') if isinstance(sink, str) else sink
+        try:
+            total_num = 0
+            for predictions, pred_uncertainty in results:
+                entries = {'prediction': predictions, **pred_uncertainty}
+                for name, entry in entries.items():
+                    entry = np.asarray(entry)
+                    if name not in h5f:
+                        h5f.create_dataset(name, shape=(0,) + entry.shape[1:], maxshape=(None,) + entry.shape[1:],
+                                           dtype=entry.dtype, chunks=True)
+                    h5f[name].resize(h5f[name].shape[0] + entry.shape[0], axis=0)
+                    h5f[name][-entry.shape[0]:] = entry
+                total_num += predictions.shape[0]
+                h5f.file.flush()
+        finally:
+            if isinstance(sink, str):
+                h5f.close()
+
+        return total_num
+
     @deprecated
     def test_old(self, input_data, inputs_err=None):
         """
@@ -578,7 +818,7 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         self.pre_testing_checklist_master()
 
         if self.input_normalizer is not None:
-            input_array = self.input_normalizer.normalize(input_data, calc=False)
+            input_array = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
         else:
             # Prevent shallow copy issue
             input_array = np.array(input_data)
@@ -618,7 +858,8 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
                                                                 data=[input_array[:data_gen_shape],
                                                                       inputs_err[:data_gen_shape]])
 
-            result = np.asarray(self.keras_model_predict.predict_generator(prediction_generator))
+            result = np.asarray(self.keras_model_predict.predict_generator(
+                prediction_generator, **self._queue_kwargs([prediction_generator], workers=1)))
 
             if result.ndim < 2:  # in case only 1 test data point, in such case we need to add a dimension
                 result = np.expand_dims(result, axis=0)
@@ -716,33 +957,30 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
         # No need to care about Magic number as loss function looks for magic num in y_true only
-        norm_input_err = inputs_err / self.input_std
+        norm_input_err = np.divide(inputs_err, self.input_std, dtype=np.float32)
         norm_labels_err = labels_err / self.labels_std
 
-        eval_batchsize = self.batch_size if input_data.shape[0] > self.batch_size else input_data.shape[0]
-        steps = input_data.shape[0] // self.batch_size if input_data.shape[0] > self.batch_size else 1
-
         start_time = time.time()
         print("Starting Evaluation")
 
-        evaluate_generator = BayesianCNNDataGenerator(batch_size=eval_batchsize,
+        evaluate_generator = BayesianCNNDataGenerator(batch_size=self.batch_size,
                                                       shuffle=False,
-                                                      steps_per_epoch=steps,
+                                                      steps_per_epoch=-(-input_data.shape[0] // self.batch_size),
                                                       data=[norm_data,
                                                             norm_labels,
                                                             norm_input_err,
                                                             norm_labels_err])
 
-        scores = self.keras_model.evaluate_generator(evaluate_generator)
+        scores = self._evaluate_batches(self.keras_model, evaluate_generator)
         if isinstance(scores, float):  # make sure scores is iterable
             scores = list(str(scores))
         outputname = self.keras_model.output_names
@@ -1,5 +1,4 @@
 import json
-import os
 import time
 from abc import ABC
 
@@ -53,10 +52,11 @@ class CNNDataGenerator(GeneratorMaster):
         y = labels[idx_list_temp]
         return x, y
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, self.labels, idx_list_temp)
+
     def __getitem__(self, index):
-        x, y = self._data_generation(self.inputs,
-                                     self.labels,
-                                     self.idx_list[self.current_idx:self.current_idx + self.batch_size])
+        x, y = self._get_batch(self.idx_list[self.current_idx:self.current_idx + self.batch_size])
         self.current_idx += self.batch_size
         if (self.current_idx+self.batch_size >= self.steps_per_epoch*self.batch_size-1) and self.manual_reset:
             self.current_idx = 0
@@ -100,8 +100,11 @@ class CNNPredDataGenerator(GeneratorMaster):
         x = self.input_d_checking(inputs, idx_list_temp)
         return x
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, idx_list_temp)
+
     def __getitem__(self, index):
-        x = self._data_generation(self.inputs, self.idx_list[self.current_idx:self.current_idx + self.batch_size])
+        x = self._get_batch(self.idx_list[self.current_idx:self.current_idx + self.batch_size])
         self.current_idx += self.batch_size
         if (self.current_idx+self.batch_size >= self.steps_per_epoch*self.batch_size-1) and self.manual_reset:
             self.current_idx = 0
@@ -179,6 +182,7 @@ class CNNBase(NeuralNetMaster, ABC):
             raise RuntimeError('Only "regression", "classification" and "binary_classification" are supported')
 
         self.keras_model = self.model()
+        self._jacobian_cache = {}  # cached gradient tensors are of the old keras_model
 
         self.keras_model.compile(loss=loss_func,
                                  optimizer=self.optimizer,
@@ -197,12 +201,12 @@ class CNNBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
         if self.keras_model is None:  # only compiler if there is no keras_model, e.g. fine-tuning does not required
@@ -263,12 +267,7 @@ class CNNBase(NeuralNetMaster, ABC):
 
         start_time = time.time()
 
-        self.history = self.keras_model.fit_generator(generator=self.training_generator,
-                                                      validation_data=self.validation_generator,
-                                                      epochs=self.max_epochs, verbose=self.verbose,
-                                                      workers=os.cpu_count(),
-                                                      callbacks=self.__callbacks,
-                                                      use_multiprocessing=MULTIPROCESS_FLAG)
+        self.history = self._fit_pipeline(self.__callbacks)
 
         print(f'Completed Training, {(time.time() - start_time):.{2}f}s in total')
 
@@ -296,12 +295,12 @@ class CNNBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
         start_time = time.time()
@@ -314,8 +313,8 @@ class CNNBase(NeuralNetMaster, ABC):
         scores = self.keras_model.fit_generator(generator=fit_generator,
                                                 epochs=1,
                                                 verbose=self.verbose,
-                                                workers=os.cpu_count(),
-                                                use_multiprocessing=MULTIPROCESS_FLAG)
+                                                use_multiprocessing=MULTIPROCESS_FLAG,
+                                                **self._queue_kwargs([fit_generator]))
 
         print(f'Completed Training on Batch, {(time.time() - start_time):.{2}f}s in total')
 
@@ -372,7 +371,7 @@ class CNNBase(NeuralNetMaster, ABC):
         input_data = np.atleast_2d(input_data)
 
         if self.input_normalizer is not None:
-            input_array = self.input_normalizer.normalize(input_data, calc=False)
+            input_array = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
         else:
             # Prevent shallow copy issue
             input_array = np.array(input_data)
@@ -381,33 +380,15 @@ class CNNBase(NeuralNetMaster, ABC):
 
         total_test_num = input_data.shape[0]  # Number of testing data
 
-        # for number of training data smaller than batch_size
-        if input_data.shape[0] < self.batch_size:
-            self.batch_size = input_data.shape[0]
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // self.batch_size) * self.batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        predictions = np.zeros((total_test_num, self._labels_shape))
-
         start_time = time.time()
         print("Starting Inference")
 
-        # Data Generator for prediction
+        # Data Generator for prediction, batches are padded to batch_size
         prediction_generator = CNNPredDataGenerator(batch_size=self.batch_size,
                                                     shuffle=False,
-                                                    steps_per_epoch=input_array.shape[0] // self.batch_size,
-                                                    data=[input_array[:data_gen_shape]])
-        predictions[:data_gen_shape] = np.asarray(self.keras_model.predict_generator(prediction_generator))
-
-        if remainder_shape != 0:
-            remainder_data = input_array[data_gen_shape:]
-            # assume its caused by mono images, so need to expand dim by 1
-            if len(input_array[0].shape) != len(self._input_shape):
-                remainder_data = np.expand_dims(remainder_data, axis=-1)
-            result = self.keras_model.predict(remainder_data)
-            predictions[data_gen_shape:] = result.reshape((remainder_shape, self._labels_shape))
+                                                    steps_per_epoch=-(-total_test_num // self.batch_size),
+                                                    data=[input_array])
+        predictions = self._predict_padded(self.keras_model, prediction_generator, output_shape=(self._labels_shape,))
 
         if self.labels_normalizer is not None:
             predictions = self.labels_normalizer.denormalize(predictions)
@@ -437,26 +418,23 @@ class CNNBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
-        eval_batchsize = self.batch_size if input_data.shape[0] > self.batch_size else input_data.shape[0]
-        steps = input_data.shape[0] // self.batch_size if input_data.shape[0] > self.batch_size else 1
-
         start_time = time.time()
         print("Starting Evaluation")
 
-        evaluate_generator = CNNDataGenerator(batch_size=eval_batchsize,
+        evaluate_generator = CNNDataGenerator(batch_size=self.batch_size,
                                               shuffle=False,
-                                              steps_per_epoch=steps,
+                                              steps_per_epoch=-(-input_data.shape[0] // self.batch_size),
                                               data=[norm_data, norm_labels])
 
-        scores = self.keras_model.evaluate_generator(evaluate_generator)
+        scores = self._evaluate_batches(self.keras_model, evaluate_generator)
         if isinstance(scores, float):  # make sure scores is iterable
             scores = list(str(scores))
         outputname = self.keras_model.output_names
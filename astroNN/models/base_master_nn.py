@@ -1,9 +1,11 @@
 ###############################################################################
 #   base_master_nn.py: top-level class for a neural network
 ###############################################################################
+import json
 import os
 import sys
 import time
+import warnings
 from abc import ABC, abstractmethod
 
 import numpy as np
@@ -12,8 +14,12 @@ import tensorflow as tf
 import tensorflow.keras as tfk
 
 import astroNN
+from astroNN.config import MAGIC_NUMBER
+from astroNN.config import MULTIPROCESS_FLAG
 from astroNN.config import _astroNN_MODEL_NAME
 from astroNN.config import cpu_gpu_check
+from astroNN.nn.utilities.generator import PaddedBatchGenerator
+from astroNN.nn.utilities.inference_graph import _METADATA_NODE, float16_constants
 from astroNN.shared.custom_warnings import deprecated
 from astroNN.shared.nn_tools import folder_runnum
 
@@ -37,6 +43,9 @@ class NeuralNetMaster(ABC):
     :ivar fullfilepath: Full file path
     :ivar batch_size: Batch size for training, by default 64
     :ivar autosave: Boolean to flag whether autosave model or not
+    :ivar data_pipeline: Input pipeline for training, 'generator' for keras generator or 'tf.data' for tf.data pipeline
+        with parallel map and prefetch, by default 'generator'
+    :ivar data_pipeline_deterministic: Boolean to flag whether tf.data pipeline should keep the order of batches
 
     :ivar task: Task
     :ivar lr: Learning rate
@@ -70,6 +79,8 @@ class NeuralNetMaster(ABC):
         self.fullfilepath = None
         self.batch_size = 64
         self.autosave = False
+        self.data_pipeline = 'generator'
+        self.data_pipeline_deterministic = False
 
         # Hyperparameter
         self.task = None
@@ -118,12 +129,110 @@ class NeuralNetMaster(ABC):
 
         self.session = None
         self.graph = None
+        self._jacobian_cache = {}  # jacobian tensors by input and output tensors
 
         cpu_gpu_check()
 
     def __str__(self):
         return f"Name: {self.name}\nModel Type: {self._model_type}\nModel ID: {self._model_identifier}"
 
+    @staticmethod
+    def _queue_kwargs(generators, workers=None, max_queue_size=10):
+        """
+        Keyword arguments of workers and queue to pass to keras when consuming generators, ring buffers of the
+        generators are sized for them
+
+        :param generators: astroNN generators to be consumed by keras
+        :type generators: list
+        :param workers: Number of workers, default to number of CPUs
+        :type workers: Union[NoneType, int]
+        :param max_queue_size: Maximum number of batches in the queue
+        :type max_queue_size: int
+        :return: keyword arguments of workers and max_queue_size
+        :rtype: dict
+        """
+        workers = os.cpu_count() if workers is None else workers
+        for generator in generators:
+            if generator is not None:
+                generator.set_queue(workers, max_queue_size)
+        return {'workers': workers, 'max_queue_size': max_queue_size}
+
+    def _fit_pipeline(self, callbacks):
+        """
+        Fit keras model with training_generator and validation_generator through the selected data_pipeline
+
+        :param callbacks: List of keras callbacks
+        :type callbacks: list
+        :return: Keras history
+        """
+        if self.data_pipeline == 'generator':
+            return self.keras_model.fit_generator(generator=self.training_generator,
+                                                  validation_data=self.validation_generator,
+                                                  epochs=self.max_epochs, verbose=self.verbose,
+                                                  callbacks=callbacks,
+                                                  use_multiprocessing=MULTIPROCESS_FLAG,
+                                                  **self._queue_kwargs([self.training_generator,
+                                                                        self.validation_generator]))
+        elif self.data_pipeline == 'tf.data':
+            deterministic = self.data_pipeline_deterministic
+            train_dataset = self.training_generator.tf_dataset(deterministic=deterministic)
+            val_dataset = self.validation_generator.tf_dataset(deterministic=deterministic)
+            return self.keras_model.fit(train_dataset, steps_per_epoch=len(self.training_generator),
+                                        validation_data=val_dataset,
+                                        validation_steps=len(self.validation_generator),
+                                        epochs=self.max_epochs, verbose=self.verbose,
+                                        callbacks=callbacks)
+        else:
+            raise ValueError(f"Unknown data_pipeline -> {self.data_pipeline}, only 'generator' or 'tf.data'")
+
+    def _predict_padded(self, model, generator, output_shape=None):
+        """
+        Inference with fixed shape batches of generator.batch_size for any number of data, the last batch is padded
+        and the padding is removed from the result so model state and batch shape do not change between calls
+
+        :param model: Keras model
+        :type model: tf.keras.Model
+        :param generator: astroNN prediction generator
+        :type generator: astroNN.nn.utilities.generator.GeneratorMaster
+        :param output_shape: Shape of the output of a single data to reshape the result to, if not None
+        :type output_shape: Union[NoneType, tuple]
+        :return: Result of all data
+        :rtype: ndarray
+        """
+        padded_generator = PaddedBatchGenerator(generator)
+        result = np.asarray(model.predict_generator(padded_generator, **self._queue_kwargs([generator], workers=1)))
+        if output_shape is not None:
+            result = result.reshape((-1,) + tuple(output_shape))
+        return result[:padded_generator.num_data]
+
+    def _evaluate_batches(self, model, generator):
+        """
+        Evaluate all data in fixed shape batches built by workers, the last batch is padded and padded data have zero
+        sample weight, scores of batches are averaged by their number of data so every data has the same weight in
+        the scores for any number of data
+
+        :param model: Keras model
+        :type model: tf.keras.Model
+        :param generator: astroNN generator of (inputs, targets)
+        :type generator: astroNN.nn.utilities.generator.GeneratorMaster
+        :return: Scores
+        :rtype: Union[float, list]
+        """
+        padded_generator = PaddedBatchGenerator(generator, sample_weight=True)
+        enqueuer = tfk.utils.OrderedEnqueuer(padded_generator, use_multiprocessing=MULTIPROCESS_FLAG, shuffle=False)
+        enqueuer.start(**self._queue_kwargs([generator]))
+        scores, num_batch_data = [], []
+        try:
+            batches = enqueuer.get()
+            for index in range(len(padded_generator)):
+                x, y, sample_weight = next(batches)
+                scores.append(np.atleast_1d(model.test_on_batch(x, y, sample_weight=sample_weight)))
+                num_batch_data.append(padded_generator.num_batch_data(index))
+        finally:
+            enqueuer.stop()
+        scores = np.average(np.stack(scores), axis=0, weights=num_batch_data)
+        return float(scores[0]) if scores.shape[0] == 1 else scores.tolist()
+
     @property
     def has_model(self):
         """
@@ -297,168 +406,133 @@ class NeuralNetMaster(ABC):
             print('Skipped plot_model! graphviz and pydot_ng are required to plot the model architecture')
             pass
 
-    def hessian(self, x=None, mean_output=False, mc_num=1, denormalize=False, method='exact'):
+    @staticmethod
+    def _export_norm_constants(normalizer, mean, std, ndim):
         """
-        | Calculate the hessian of output to input
-        |
-        | Please notice that the de-normalize (if True) assumes the output depends on the input data first orderly
-        | in which the hessians does not depends on input scaling and only depends on output scaling
-        |
-        | The hessians can be all zeros and the common cause is you did not use any activation or
-        | activation that is still too linear in some sense like ReLU.
-
-        :param x: Input Data
-        :type x: ndarray
-        :param mean_output: False to get all hessian, True to get the mean
-        :type mean_output: boolean
-        :param mc_num: Number of monte carlo integration
-        :type mc_num: int
-        :param denormalize: De-normalize diagonal part of Hessian
-        :type denormalize: bool
-        :param method: Either 'exact' to calculate numerical Hessian or 'approx' to approximate Hessian from Jacobian
-        :type method: str
-        :return: An array of Hessian
-        :rtype: ndarray
-        :History: 2018-Jun-14 - Written - Henry Leung (University of Toronto)
+        Mean and standard derivation of a normalizer as float32 arrays broadcastable to data with ndim dimensions
+        (without the data axis)
         """
-        if not mean_output:
-            print('only mean output is supported at this moment')
-            mean_output = True
-        if method == 'approx':
-            all_args = locals()
-            # remove unnecessary argument
-            all_args.pop('self')
-            all_args.pop('method')
-            jacobian = self.jacobian(**all_args)
-            hessians_master = np.stack([np.dot(jacobian[x_shape:x_shape + 1].T, jacobian[x_shape:x_shape + 1])
-                                        for x_shape in range(jacobian.shape[0])], axis=0)
-            return hessians_master
-
-        elif method == 'exact':
-            self.has_model_check()
-            if x is None:
-                raise ValueError('Please provide data to calculate the jacobian')
-
-            if mc_num < 1 or isinstance(mc_num, float):
-                raise ValueError('mc_num must be a positive integer')
-
-            if self.input_normalizer is not None:
-                x_data = self.input_normalizer.normalize(x, calc=False)
-            else:
-                # Prevent shallow copy issue
-                x_data = np.array(x)
-                x_data -= self.input_mean
-                x_data /= self.input_std
-
+        if normalizer is not None:
             try:
-                input_tens = self.keras_model_predict.get_layer("input").input
-                output_tens = self.keras_model_predict.get_layer("output").output
-                input_shape_expectation = self.keras_model_predict.get_layer("input").input_shape
-                output_shape_expectation = self.keras_model_predict.get_layer("output").output_shape
-            except AttributeError:
-                input_tens = self.keras_model.get_layer("input").input
-                output_tens = self.keras_model.get_layer("output").output
-                input_shape_expectation = self.keras_model.get_layer("input").input_shape
-                output_shape_expectation = self.keras_model.get_layer("output").output_shape
+                mean, std = normalizer.get_statistics(linear_only=True)
             except ValueError:
-                raise ValueError(
-                    "astroNN expects input layer is named as 'input' and output layer is named as 'output', "
-                    "but None is found.")
-
-            # just in case only 1 data point is provided and mess up the shape issue
-            if len(input_shape_expectation) == 3:
-                x_data = np.atleast_3d(x_data)
-            elif len(input_shape_expectation) == 4:
-                if len(x_data.shape) < 4:
-                    x_data = x_data[:, :, :, np.newaxis]
-            else:
-                raise ValueError('Input data shape do not match neural network expectation')
-
-            total_num = x_data.shape[0]
-
-            hessians_list = []
-            for j in range(self._labels_shape):
-                hessians_list.append(tf.hessians(output_tens[:, j], input_tens))
+                raise ValueError(f'Normalization mode {normalizer.normalization_mode} cannot be exported')
+        mean, std = np.asarray(mean, dtype=np.float32), np.asarray(std, dtype=np.float32)
+        mean = mean.reshape(mean.shape + (1,) * (ndim - mean.ndim))
+        std = std.reshape(std.shape + (1,) * (ndim - std.ndim))
+        return mean, std
 
-            final_stack = tf.stack(tf.squeeze(hessians_list))
-
-            # Looping variables for tensorflow setup
-            i = tf.constant(0)
-            mc_num_tf = tf.constant(mc_num)
-            #  To store final result
-            l = tf.TensorArray(dtype=tf.float32, infer_shape=False, size=1, dynamic_size=True)
-
-            def body(i, l):
-                l = l.write(i, final_stack)
-                return i + 1, l
-
-            tf_index, loop = tf.while_loop(lambda i, *_: tf.less(i, mc_num_tf), body, [i, l])
-
-            loops = tf.cond(tf.greater(mc_num_tf, 1), lambda: tf.reduce_mean(loop.stack(), axis=0),
-                            lambda: loop.stack())
-
-            start_time = time.time()
-
-            hessians = np.concatenate(
-                [get_session().run(loops, feed_dict={input_tens: x_data[i:i + 1], tfk.backend.learning_phase(): 0})
-                 for i
-                 in range(0, total_num)], axis=0)
+    def _export_outputs(self, uncertainty):
+        """
+        Keras model to be exported and the output tensors of it to be frozen
 
-            if np.all(hessians == 0.):  # warn user about not so linear activation like ReLU will get all zeros
-                print(
-                    'The hessians is detected to be all zeros. The common cause is you did not use any activation or '
-                    'activation that is still too linear in some sense like ReLU.')
+        :return: keras model and dictionary of output tensors
+        :rtype: tuple
+        """
+        return self.keras_model, {'prediction': self.keras_model.output}
 
-            if mean_output is True:
-                hessians_master = np.mean(hessians, axis=0)
-            else:
-                hessians_master = np.array(hessians)
+    def _export_postprocess(self, outputs, mc_num, uncertainty):
+        """
+        Build tensors of the final outputs of the exported graph from the output tensors of the frozen model, for
+        every data repeated mc_num times
 
-            hessians_master = np.squeeze(hessians_master)
+        :return: dictionary of output tensors
+        :rtype: dict
+        """
+        prediction = outputs['prediction']
+        prediction = tf.reduce_mean(tf.reshape(prediction, [-1, mc_num] + prediction.shape[1:].as_list()), axis=1)
+        mean, std = self._export_norm_constants(self.labels_normalizer, self.labels_mean, self.labels_std,
+                                                len(prediction.shape) - 1)
+        return {'prediction': prediction * std + mean}
 
-            if denormalize:  # no need to denorm input scaling because of we assume first order dependence
-                if self.labels_std is not None:
-                    try:
-                        hessians_master = hessians_master * self.labels_std
-                    except ValueError:
-                        hessians_master = hessians_master * self.labels_std.reshape(-1, 1)
+    def export_inference_graph(self, filename, mc_num=1, uncertainty=False, float16=False):
+        """
+        | Export a frozen graph for inference only, variables are converted to constants and nodes not needed by the
+        | outputs are pruned. Normalization of data, Monte Carlo integration of mc_num forward passes and
+        | denormalization of outputs are operations inside the graph.
+        |
+        | The graph can be loaded with ``astroNN.nn.utilities.inference_graph.load_inference_graph()`` which only needs
+        | tensorflow, so astroNN models do not need to be built or imported.
 
-            print(f'Finished hessian ({method}) calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
-            return hessians_master
-        else:
-            raise ValueError(f'Unknown method -> {method}')
+        :param filename: File name of the exported graph
+        :type filename: str
+        :param mc_num: Number of Monte Carlo integration
+        :type mc_num: int
+        :param uncertainty: True to export uncertainty outputs (only for Bayesian neural network)
+        :type uncertainty: bool
+        :param float16: True to store weights in float16 to halve the size of the graph, inference is still in float32
+        :type float16: bool
+        :return: None
+        """
+        self.has_model_check()
+        if mc_num < 1 or isinstance(mc_num, float):
+            raise ValueError('mc_num must be a positive integer')
 
-    def hessian_diag(self, x=None, mean_output=False, mc_num=1, denormalize=False):
+        model, outputs = self._export_outputs(uncertainty)
+        if len(model.inputs) != 1:
+            raise ValueError('Only neural network with a single input can be exported')
+
+        graph = self.graph if self.graph is not None else tf.get_default_graph()
+        session = self.session if self.session is not None else get_session()
+        with graph.as_default():
+            learning_phase = tfk.backend.learning_phase()
+            frozen_graph_def = tf.graph_util.convert_variables_to_constants(
+                session, graph.as_graph_def(), sorted({tensor.op.name for tensor in outputs.values()}))
+        frozen_nodes = {node.name for node in frozen_graph_def.node}
+
+        export_graph = tf.Graph()
+        with export_graph.as_default():
+            input_tens = tf.placeholder(tf.float32, shape=model.input_shape, name='input')
+            mean, std = self._export_norm_constants(self.input_normalizer, self.input_mean, self.input_std,
+                                                    len(model.input_shape) - 1)
+            x = tf.where(tf.equal(input_tens, MAGIC_NUMBER), input_tens, (input_tens - mean) / std)
+            if mc_num > 1:  # repeat every data mc_num times to draw independent dropout masks
+                x = tf.tile(tf.expand_dims(x, 1), [1, mc_num] + [1] * (len(model.input_shape) - 1))
+                x = tf.reshape(x, tf.concat([[-1], tf.shape(x)[2:]], axis=0))
+
+            input_map = {model.input.name: x}
+            if learning_phase.op.name in frozen_nodes:
+                input_map[learning_phase.name] = tf.constant(False)
+            imported = tf.import_graph_def(frozen_graph_def, input_map=input_map,
+                                           return_elements=[tensor.name for tensor in outputs.values()], name='model')
+            results = self._export_postprocess(dict(zip(outputs.keys(), imported)), mc_num, uncertainty)
+            output_names = {name: tf.identity(tensor, name=name).name for name, tensor in results.items()}
+
+            metadata = {'input': input_tens.name, 'outputs': output_names, 'mc_num': mc_num,
+                        'model': self._model_identifier, 'targetname': np.asarray(self.targetname).tolist()}
+            tf.constant(json.dumps(metadata), name=_METADATA_NODE)
+
+        keep_nodes = [name.split(':')[0] for name in output_names.values()] + [_METADATA_NODE]
+        graph_def = tf.graph_util.remove_training_nodes(export_graph.as_graph_def(),
+                                                        protected_nodes=keep_nodes + ['input'])
+        graph_def = tf.graph_util.extract_sub_graph(graph_def, keep_nodes)
+        if float16 is True:
+            graph_def = float16_constants(graph_def)
+
+        with open(filename, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        print(f'Exported inference graph to {filename}')
+
+    def _gradient_setup(self, x, mc_num):
         """
-        | Calculate the diagonal part of hessian of output to input, avoids the calculation of the whole hessian and takes its diagonal
-        |
-        | Please notice that the de-normalize (if True) assumes the output depends on the input data first orderly
-        | in which the diagonal part of the hessians does not depends on input scaling and only depends on output scaling
-        |
-        | The diagonal part of the hessians can be all zeros and the common cause is you did not use
-        | any activation or activation that is still too linear in some sense like ReLU.
+        Normalize data and get input and output tensors to calculate derivatives of output to input
 
         :param x: Input Data
         :type x: ndarray
-        :param mean_output: False to get all hessian, True to get the mean
-        :type mean_output: boolean
         :param mc_num: Number of monte carlo integration
         :type mc_num: int
-        :param denormalize: De-normalize diagonal part of Hessian
-        :type denormalize: bool
-        :return: An array of Hessian
-        :rtype: ndarray
-        :History: 2018-Jun-13 - Written - Henry Leung (University of Toronto)
+        :return: normalized data with channel axis, input tensor, output tensor, input shape and output shape
+        :rtype: tuple
         """
         self.has_model_check()
         if x is None:
-            raise ValueError('Please provide data to calculate the jacobian')
+            raise ValueError('Please provide data to calculate the derivatives')
 
         if mc_num < 1 or isinstance(mc_num, float):
             raise ValueError('mc_num must be a positive integer')
 
         if self.input_normalizer is not None:
-            x_data = self.input_normalizer.normalize(x, calc=False)
+            x_data = self.input_normalizer.normalize(x, calc=False, dtype=np.float32)
         else:
             # Prevent shallow copy issue
             x_data = np.array(x)
@@ -488,57 +562,361 @@ class NeuralNetMaster(ABC):
         else:
             raise ValueError('Input data shape do not match neural network expectation')
 
+        return x_data, input_tens, output_tens, input_shape_expectation, output_shape_expectation
+
+    def _hvp_tensor(self, input_tens, output_tens, output_shape):
+        """
+        Build (or get the memoized) tensors of Hessian-vector product of every output for a batch of data, gradients of
+        the sum over the batch is the gradients of every data because data are independent
+
+        :return: placeholder of vectors, tensor of Hessian-vector product with shape (number of data, number of
+            outputs, input shape) and tensor of vector-Hessian-vector product with shape (number of data, number of
+            outputs)
+        :rtype: tuple
+        """
+        key = ('hvp', input_tens, output_tens)
+        if key not in self._jacobian_cache:
+            v_tens = tf.placeholder(tf.float32, shape=input_tens.shape, name='hessian_vector')
+            num_outputs = int(np.prod(output_shape[1:]))
+            output_flat = tf.reshape(output_tens, [-1, num_outputs])
+            hvp_list = []
+            for j in range(num_outputs):
+                grad = tf.gradients(output_flat[:, j], input_tens)[0]
+                hvp = tf.gradients(tf.reduce_sum(grad * v_tens), input_tens)[0]
+                # gradients is None if output is linear to input
+                hvp_list.append(hvp if hvp is not None else tf.zeros_like(input_tens))
+            hvp_tens = tf.stack(hvp_list, axis=1)
+            input_axes = list(range(2, len(input_tens.shape) + 1))
+            vhv_tens = tf.reduce_sum(hvp_tens * tf.expand_dims(v_tens, 1), axis=input_axes)
+            self._jacobian_cache[key] = (v_tens, hvp_tens, vhv_tens)
+        return self._jacobian_cache[key]
+
+    def _hessian_probe(self, x_data, input_tens, v_tens, target_tens, num_outputs, mc_num, batch_size, mean_output,
+                       probe):
+        """
+        Evaluate target_tens of Hessian-vector product for every data against one-hot vectors of every input (or given
+        vectors), rows of batch_size are (data, vector) pairs each repeated mc_num times to draw independent dropout
+        masks, results are scattered (or summed for mean_output) to bounded size output
+
+        :param probe: 'diag' for diagonal of Hessian, 'full' for full Hessian or vectors with the shape of x_data for
+            Hessian-vector product
+        :return: result of every data or mean over data
+        :rtype: ndarray
+        """
         total_num = x_data.shape[0]
+        input_shape = x_data.shape[1:]
+        num_inputs = int(np.prod(input_shape))
+        mode = probe if isinstance(probe, str) else 'hvp'
+        if mode == 'hvp':
+            num_probes = total_num
+            vectors = np.broadcast_to(np.asarray(probe, dtype=np.float32), x_data.shape)
+        else:
+            num_probes = total_num * num_inputs
 
-        hessians_diag_list = []
-        for j in range(self._labels_shape):
-            hessians_diag_list.append(tf.gradients(tf.gradients(output_tens[:, j], input_tens), input_tens))
+        if mode == 'diag':
+            result_shape = (num_outputs, num_inputs)
+        elif mode == 'full':
+            result_shape = (num_outputs, num_inputs, num_inputs)
+        else:
+            result_shape = (num_outputs,) + input_shape
+        if mean_output is True:
+            result = np.zeros(result_shape, dtype=np.float64)
+        else:
+            result = np.zeros((total_num,) + result_shape, dtype=np.float32)
+
+        probes_per_run = max(1, batch_size // mc_num)
+        for i in range(0, num_probes, probes_per_run):
+            probe_idx = np.arange(i, min(i + probes_per_run, num_probes))
+            if mode != 'hvp':
+                data_idx, input_idx = np.divmod(probe_idx, num_inputs)
+                v_batch = np.zeros((probe_idx.shape[0], num_inputs), dtype=np.float32)
+                v_batch[np.arange(probe_idx.shape[0]), input_idx] = 1.
+                v_batch = v_batch.reshape((-1,) + input_shape)
+            else:
+                data_idx, input_idx = probe_idx, None
+                v_batch = vectors[data_idx]
+
+            output = get_session().run(target_tens,
+                                       feed_dict={input_tens: np.repeat(x_data[data_idx], mc_num, axis=0),
+                                                  v_tens: np.repeat(v_batch, mc_num, axis=0),
+                                                  tfk.backend.learning_phase(): 0})
+            output = output.reshape((probe_idx.shape[0], mc_num) + output.shape[1:]).mean(axis=1)
+
+            if mode == 'diag':
+                if mean_output is True:
+                    np.add.at(result, (slice(None), input_idx), output.T)
+                else:
+                    result[data_idx, :, input_idx] = output
+            elif mode == 'full':
+                # Hessian-vector product with one-hot vector of an input is a column of Hessian
+                output = output.reshape(output.shape[0], output.shape[1], num_inputs)
+                if mean_output is True:
+                    np.add.at(result, (slice(None), slice(None), input_idx), output.transpose(1, 2, 0))
+                else:
+                    result[data_idx, :, :, input_idx] = output
+            else:
+                if mean_output is True:
+                    result += np.sum(output, axis=0)
+                else:
+                    result[data_idx] = output
 
-        final_stack = tf.stack(tf.squeeze(hessians_diag_list))
+        if mean_output is True:
+            result /= total_num
+        return result
 
-        # Looping variables for tensorflow setup
-        i = tf.constant(0)
-        mc_num_tf = tf.constant(mc_num)
-        #  To store final result
-        l = tf.TensorArray(dtype=tf.float32, infer_shape=False, size=1, dynamic_size=True)
+    def _hessian_finalize(self, hessians, denormalize):
+        """
+        Warn about all zeros Hessian, squeeze and de-normalize output scaling
+        """
+        if np.all(hessians == 0.):  # warn user about not so linear activation like ReLU will get all zeros
+            print('The hessians is detected to be all zeros. The common cause is you did not use any activation or '
+                  'activation that is still too linear in some sense like ReLU.')
 
-        def body(i, l):
-            l = l.write(i, final_stack)
-            return i + 1, l
+        hessians = np.squeeze(hessians)
 
-        tf_index, loop = tf.while_loop(lambda i, *_: tf.less(i, mc_num_tf), body, [i, l])
+        if denormalize:  # no need to denorm input scaling because of we assume first order dependence
+            if self.labels_std is not None:
+                try:
+                    hessians = hessians * self.labels_std
+                except ValueError:
+                    hessians = hessians * self.labels_std.reshape((-1,) + (1,) * (hessians.ndim - 1))
+        return hessians
 
-        loops = tf.cond(tf.greater(mc_num_tf, 1), lambda: tf.reduce_mean(loop.stack(), axis=0), lambda: loop.stack())
+    def hessian(self, x=None, mean_output=None, mc_num=1, denormalize=False, method='exact', v=None,
+                batch_size=None):
+        """
+        | Calculate the hessian of output to input
+        |
+        | Please notice that the de-normalize (if True) assumes the output depends on the input data first orderly
+        | in which the hessians does not depends on input scaling and only depends on output scaling
+        |
+        | The hessians can be all zeros and the common cause is you did not use any activation or
+        | activation that is still too linear in some sense like ReLU.
+        |
+        | Exact Hessian is calculated column by column from Hessian-vector products in batches of batch_size rows,
+        | so memory usage only depends on the size of the result which is bounded with mean_output=True
+
+        :param x: Input Data
+        :type x: ndarray
+        :param mean_output: False to get all hessian, True to get the mean. Default to True for method='exact' and
+            'approx' (which is deprecated, the default will be False in future) and False for 'diag' and 'hvp'
+        :type mean_output: Union[NoneType, boolean]
+        :param mc_num: Number of monte carlo integration
+        :type mc_num: int
+        :param denormalize: De-normalize diagonal part of Hessian
+        :type denormalize: bool
+        :param method: 'exact' to calculate numerical Hessian, 'approx' to approximate Hessian from Jacobian (see
+            ``hessian_approx()``), 'diag' for the diagonal part of Hessian or 'hvp' for Hessian-vector product with v
+        :type method: str
+        :param v: Vector for method='hvp', with the shape of a single data or the same shape with x
+        :type v: Union[NoneType, ndarray]
+        :param batch_size: Number of rows of (data, vector) pairs per session run, default to batch_size of the model
+        :type batch_size: Union[NoneType, int]
+        :return: An array of Hessian, with shape (data, output, input, input) for 'exact', (data, output, input) for
+            'diag' and 'hvp', without data axis if mean_output=True
+        :rtype: ndarray
+        :History: 2018-Jun-14 - Written - Henry Leung (University of Toronto)
+        """
+        if mean_output is None:
+            mean_output = method in ('exact', 'approx')
+            if mean_output is True:
+                warnings.warn(f"hessian(method='{method}') returns the mean hessian by default but will return the "
+                              f"hessian of every data in future, please set mean_output=True explicitly to keep the "
+                              f"mean", DeprecationWarning)
+        if method == 'approx':
+            return self.hessian_approx(x=x, mean_output=mean_output, mc_num=mc_num, denormalize=denormalize,
+                                       batch_size=batch_size)
+        elif method == 'diag':
+            return self.hessian_diag(x=x, mean_output=mean_output, mc_num=mc_num, denormalize=denormalize,
+                                     batch_size=batch_size)
+        elif method == 'hvp':
+            if v is None:
+                raise ValueError("Please provide v for method='hvp'")
+            probe = v
+        elif method == 'exact':
+            probe = 'full'
+        else:
+            raise ValueError(f'Unknown method -> {method}')
+
+        x_data, input_tens, output_tens, input_shape, output_shape = self._gradient_setup(x, mc_num)
+        if method == 'hvp':
+            probe = np.asarray(probe, dtype=np.float32).reshape((-1,) + x_data.shape[1:])
+        batch_size = self.batch_size if batch_size is None else batch_size
+        v_tens, hvp_tens, vhv_tens = self._hvp_tensor(input_tens, output_tens, output_shape)
 
         start_time = time.time()
 
-        hessians_diag = np.concatenate(
-            [get_session().run(loops, feed_dict={input_tens: x_data[i:i + 1], tfk.backend.learning_phase(): 0}) for i
-             in range(0, total_num)], axis=0)
+        num_outputs = int(np.prod(output_shape[1:]))
+        hessians = self._hessian_probe(x_data, input_tens, v_tens, hvp_tens, num_outputs, mc_num, batch_size,
+                                       mean_output, probe)
+        if method == 'exact':
+            # reshape flatten inputs back to input shape
+            shape = (*output_shape[1:], *input_shape[1:], *input_shape[1:])
+            hessians = hessians.reshape(shape if mean_output is True else (x_data.shape[0],) + shape)
+        hessians_master = self._hessian_finalize(hessians, denormalize)
+
+        print(f'Finished hessian ({method}) calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
+        return hessians_master
+
+    def hessian_approx(self, x=None, mean_output=False, mc_num=1, denormalize=False, diagonal=False,
+                       batch_size=None):
+        """
+        | Calculate the Gauss-Newton approximation of hessian of output to input from Jacobian, which is the outer product
+        | of the gradients of every output J^T J for every data
+        |
+        | Jacobian is calculated in batches of batch_size data and the outer products of a batch are calculated with a
+        | batched matrix multiplication, so memory usage only depends on the size of the result which is bounded with
+        | mean_output=True or diagonal=True
+
+        :param x: Input Data
+        :type x: ndarray
+        :param mean_output: False to get hessian of every data, True to get the mean over data
+        :type mean_output: boolean
+        :param mc_num: Number of monte carlo integration
+        :type mc_num: int
+        :param denormalize: De-normalize Jacobian before the outer product
+        :type denormalize: bool
+        :param diagonal: True to get only the diagonal part of hessian which is the square of Jacobian
+        :type diagonal: bool
+        :param batch_size: Number of data per session run, default to batch_size // mc_num
+        :type batch_size: Union[NoneType, int]
+        :return: An array of Hessian, with shape (data, output, input, input), or (data, output, input) for
+            diagonal=True, without data axis if mean_output=True
+        :rtype: ndarray
+        """
+        x_data, input_tens, output_tens, input_shape, output_shape = self._gradient_setup(x, mc_num)
+        total_num = x_data.shape[0]
+        batch_size = max(1, self.batch_size // mc_num) if batch_size is None else batch_size
+        num_outputs = int(np.prod(output_shape[1:]))
+        num_inputs = int(np.prod(input_shape[1:]))
+
+        # de-normalization of Jacobian as a factor of every (output, input) pair
+        scale = None
+        if denormalize:
+            scale = np.ones((num_outputs, num_inputs), dtype=np.float32)
+            if self.input_std is not None:
+                input_std = np.asarray(self.input_std, dtype=np.float32)
+                input_std = input_std.reshape(input_std.shape + (1,) * (len(input_shape) - 1 - input_std.ndim))
+                scale /= np.broadcast_to(input_std, input_shape[1:]).reshape(1, num_inputs)
+            if self.labels_std is not None:
+                labels_std = np.broadcast_to(np.asarray(self.labels_std, dtype=np.float32), (num_outputs,))
+                scale *= labels_std.reshape(num_outputs, 1)
 
-        if np.all(hessians_diag == 0.):  # warn user about not so linear activation like ReLU will get all zeros
-            print('The diagonal part of the hessians is detected to be all zeros. The common cause is you did not use '
-                  'any activation or activation that is still too linear in some sense like ReLU.')
+        start_time = time.time()
 
+        result_shape = (num_outputs, num_inputs) if diagonal is True else (num_outputs, num_inputs, num_inputs)
         if mean_output is True:
-            hessians_diag_master = np.mean(hessians_diag, axis=0)
+            hessians = np.zeros(result_shape, dtype=np.float64)
         else:
-            hessians_diag_master = np.array(hessians_diag)
+            hessians = np.zeros((total_num,) + result_shape, dtype=np.float32)
+
+        for i, jacobian in self._jacobian_batches(x_data, input_tens, output_tens, input_shape, output_shape, mc_num,
+                                                  batch_size):
+            jacobian = jacobian.reshape(jacobian.shape[0], num_outputs, num_inputs)
+            if scale is not None:
+                jacobian = jacobian * scale
+            if diagonal is True:
+                if mean_output is True:
+                    hessians += np.einsum('doi,doi->oi', jacobian, jacobian, dtype=np.float64)
+                else:
+                    np.square(jacobian, out=hessians[i:i + jacobian.shape[0]])
+            elif mean_output is True:
+                # (output, input, data) @ (output, data, input) sums outer products over data
+                jacobian = jacobian.astype(np.float64)
+                hessians += np.matmul(jacobian.transpose(1, 2, 0), jacobian.transpose(1, 0, 2))
+            else:
+                np.matmul(jacobian[..., np.newaxis], jacobian[..., np.newaxis, :],
+                          out=hessians[i:i + jacobian.shape[0]])
 
-        hessians_diag_master = np.squeeze(hessians_diag_master)
+        if mean_output is True:
+            hessians /= total_num
 
-        if denormalize:  # no need to denorm input scaling because of we assume first order dependence
-            if self.labels_std is not None:
-                try:
-                    hessians_diag_master = hessians_diag_master * self.labels_std
-                except ValueError:
-                    hessians_diag_master = hessians_diag_master * self.labels_std.reshape(-1, 1)
+        shape = (*output_shape[1:], *input_shape[1:]) if diagonal is True else \
+            (*output_shape[1:], *input_shape[1:], *input_shape[1:])
+        hessians_master = np.squeeze(hessians.reshape(shape if mean_output is True else (total_num,) + shape))
+
+        print(f'Finished approximated hessian calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
+
+        return hessians_master
+
+    def hessian_diag(self, x=None, mean_output=False, mc_num=1, denormalize=False, batch_size=None):
+        """
+        | Calculate the diagonal part of hessian of output to input, avoids the calculation of the whole hessian and takes its diagonal
+        |
+        | Please notice that the de-normalize (if True) assumes the output depends on the input data first orderly
+        | in which the diagonal part of the hessians does not depends on input scaling and only depends on output scaling
+        |
+        | The diagonal part of the hessians can be all zeros and the common cause is you did not use
+        | any activation or activation that is still too linear in some sense like ReLU.
+        |
+        | Every diagonal element is a vector-Hessian-vector product with a one-hot vector, calculated in batches of
+        | batch_size rows of (data, input) pairs
+
+        :param x: Input Data
+        :type x: ndarray
+        :param mean_output: False to get all hessian, True to get the mean
+        :type mean_output: boolean
+        :param mc_num: Number of monte carlo integration
+        :type mc_num: int
+        :param denormalize: De-normalize diagonal part of Hessian
+        :type denormalize: bool
+        :param batch_size: Number of rows of (data, input) pairs per session run, default to batch_size of the model
+        :type batch_size: Union[NoneType, int]
+        :return: An array of Hessian
+        :rtype: ndarray
+        :History: 2018-Jun-13 - Written - Henry Leung (University of Toronto)
+        """
+        x_data, input_tens, output_tens, input_shape, output_shape = self._gradient_setup(x, mc_num)
+        batch_size = self.batch_size if batch_size is None else batch_size
+        v_tens, hvp_tens, vhv_tens = self._hvp_tensor(input_tens, output_tens, output_shape)
+
+        start_time = time.time()
+
+        num_outputs = int(np.prod(output_shape[1:]))
+        hessians_diag = self._hessian_probe(x_data, input_tens, v_tens, vhv_tens, num_outputs, mc_num, batch_size,
+                                            mean_output, 'diag')
+        shape = (*output_shape[1:], *input_shape[1:])
+        hessians_diag = hessians_diag.reshape(shape if mean_output is True else (x_data.shape[0],) + shape)
+        hessians_diag_master = self._hessian_finalize(hessians_diag, denormalize)
 
         print(f'Finished diagonal hessian calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
 
         return hessians_diag_master
 
-    def jacobian(self, x=None, mean_output=False, mc_num=1, denormalize=False):
+    def _jacobian_tensor(self, input_tens, output_tens, input_shape, output_shape):
+        """
+        Build (or get the memoized) tensor of Jacobian of every data in a batch of data each repeated mc_num times,
+        gradients of the sum of an output over the batch is the gradients of every data because data are independent
+
+        :return: placeholder of mc_num and tensor of Jacobian averaged over mc_num with shape
+            (number of data, output shape, input shape)
+        :rtype: tuple
+        """
+        key = (input_tens, output_tens)
+        if key not in self._jacobian_cache:
+            mc_num_tf = tf.placeholder(tf.int32, shape=(), name='jacobian_mc_num')
+            num_outputs = int(np.prod(output_shape[1:]))
+            output_flat = tf.reshape(output_tens, [-1, num_outputs])
+            grads = tf.stack([tf.gradients(output_flat[:, j], input_tens)[0] for j in range(num_outputs)], axis=1)
+            grads = tf.reshape(grads, [-1, mc_num_tf, *output_shape[1:], *input_shape[1:]])
+            self._jacobian_cache[key] = (mc_num_tf, tf.reduce_mean(grads, axis=1))
+        return self._jacobian_cache[key]
+
+    def _jacobian_batches(self, x_data, input_tens, output_tens, input_shape, output_shape, mc_num, batch_size):
+        """
+        Yield the index of the first data and Jacobian of every batch of batch_size data, every data is repeated mc_num
+        times in a session run to draw independent dropout masks
+
+        :return: generator of (index, Jacobian with shape (number of data, output shape, input shape))
+        :rtype: generator
+        """
+        mc_num_tf, jacobian_tens = self._jacobian_tensor(input_tens, output_tens, input_shape, output_shape)
+        for i in range(0, x_data.shape[0], batch_size):
+            x_batch = np.repeat(x_data[i:i + batch_size], mc_num, axis=0)
+            yield i, get_session().run(jacobian_tens, feed_dict={input_tens: x_batch, mc_num_tf: mc_num,
+                                                                 tfk.backend.learning_phase(): 0})
+
+    def jacobian(self, x=None, mean_output=False, mc_num=1, denormalize=False, batch_size=None):
         """
         | Calculate jacobian of gradient of output to input high performance calculation update on 15 April 2018
         |
@@ -553,83 +931,39 @@ class NeuralNetMaster(ABC):
         :type mc_num: int
         :param denormalize: De-normalize Jacobian
         :type denormalize: bool
+        :param batch_size: Number of data per session run, default to batch_size // mc_num
+        :type batch_size: Union[NoneType, int]
         :return: An array of Jacobian
         :rtype: ndarray
         :History:
             | 2017-Nov-20 - Written - Henry Leung (University of Toronto)
             | 2018-Apr-15 - Updated - Henry Leung (University of Toronto)
         """
-        self.has_model_check()
-        if x is None:
-            raise ValueError('Please provide data to calculate the jacobian')
-
-        if mc_num < 1 or isinstance(mc_num, float):
-            raise ValueError('mc_num must be a positive integer')
-
-        if self.input_normalizer is not None:
-            x_data = self.input_normalizer.normalize(x, calc=False)
-        else:
-            # Prevent shallow copy issue
-            x_data = np.array(x)
-            x_data -= self.input_mean
-            x_data /= self.input_std
-
-        try:
-            input_tens = self.keras_model_predict.get_layer("input").input
-            output_tens = self.keras_model_predict.get_layer("output").output
-            input_shape_expectation = self.keras_model_predict.get_layer("input").input_shape
-            output_shape_expectation = self.keras_model_predict.get_layer("output").output_shape
-        except AttributeError:
-            input_tens = self.keras_model.get_layer("input").input
-            output_tens = self.keras_model.get_layer("output").output
-            input_shape_expectation = self.keras_model.get_layer("input").input_shape
-            output_shape_expectation = self.keras_model.get_layer("output").output_shape
-        except ValueError:
-            raise ValueError("astroNN expects input layer is named as 'input' and output layer is named as 'output', "
-                             "but None is found.")
-
-        # just in case only 1 data point is provided and mess up the shape issue
-        if len(input_shape_expectation) == 3:
-            x_data = np.atleast_3d(x_data)
-        elif len(input_shape_expectation) == 4:
-            if len(x_data.shape) < 4:
-                x_data = x_data[:, :, :, np.newaxis]
-        else:
-            raise ValueError('Input data shape do not match neural network expectation')
+        x_data, input_tens, output_tens, input_shape_expectation, output_shape_expectation = \
+            self._gradient_setup(x, mc_num)
 
         total_num = x_data.shape[0]
+        # data per session run, every data is repeated mc_num times to draw independent dropout masks
+        batch_size = max(1, self.batch_size // mc_num) if batch_size is None else batch_size
 
-        grad_list = []
-        for j in range(self._labels_shape):
-            grad_list.append(tf.gradients(output_tens[:, j], input_tens))
-
-        final_stack = tf.stack(tf.squeeze(grad_list))
+        jacobian_shape = (*output_shape_expectation[1:], *input_shape_expectation[1:])
 
-        # Looping variables for tensorflow setup
-        i = tf.constant(0)
-        mc_num_tf = tf.constant(mc_num)
-        #  To store final result
-        l = tf.TensorArray(dtype=tf.float32, infer_shape=False, size=1, dynamic_size=True)
-
-        def body(i, l):
-            l = l.write(i, final_stack)
-            return i + 1, l
-
-        tf_index, loop = tf.while_loop(lambda i, *_: tf.less(i, mc_num_tf), body, [i, l])
-
-        loops = tf.cond(tf.greater(mc_num_tf, 1), lambda: tf.reduce_mean(loop.stack(), axis=0), lambda: loop.stack())
-        loops = tf.reshape(loops,
-                           shape=[tf.shape(input_tens)[0], *output_shape_expectation[1:], *input_shape_expectation[1:]])
         start_time = time.time()
 
-        jacobian = np.concatenate(
-            [get_session().run(loops, feed_dict={input_tens: x_data[i:i + 1], tfk.backend.learning_phase(): 0}) for i
-             in range(0, total_num)], axis=0)
-
         if mean_output is True:
-            jacobian_master = np.mean(jacobian, axis=0)
+            jacobian_master = np.zeros(jacobian_shape, dtype=np.float64)
         else:
-            jacobian_master = np.array(jacobian)
+            jacobian_master = np.zeros((total_num, *jacobian_shape), dtype=np.float32)
+
+        for i, jacobian in self._jacobian_batches(x_data, input_tens, output_tens, input_shape_expectation,
+                                                  output_shape_expectation, mc_num, batch_size):
+            if mean_output is True:
+                jacobian_master += np.sum(jacobian, axis=0)
+            else:
+                jacobian_master[i:i + batch_size] = jacobian
+
+        if mean_output is True:
+            jacobian_master /= total_num
 
         jacobian_master = np.squeeze(jacobian_master)
 
@@ -668,7 +1002,7 @@ class NeuralNetMaster(ABC):
             raise ValueError('Please provide data to calculate the jacobian')
 
         if self.input_normalizer is not None:
-            x_data = self.input_normalizer.normalize(x, calc=False)
+            x_data = self.input_normalizer.normalize(x, calc=False, dtype=np.float32)
         else:
             # Prevent shallow copy issue
             x_data = np.array(x)
@@ -1,5 +1,4 @@
 import json
-import os
 import time
 from abc import ABC
 
@@ -49,12 +48,14 @@ class CVAEDataGenerator(GeneratorMaster):
 
     def _data_generation(self, inputs, recon_inputs, idx_list_temp):
         x = self.input_d_checking(inputs, idx_list_temp)
-        y = self.input_d_checking(recon_inputs, idx_list_temp)
+        y = self.input_d_checking(recon_inputs, idx_list_temp, key='recon_inputs')
         return x, y
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, self.recon_inputs, idx_list_temp)
+
     def __getitem__(self, index):
-        x, y = self._data_generation(self.inputs, self.recon_inputs,
-                                     self.idx_list[self.current_idx:self.current_idx + self.batch_size])
+        x, y = self._get_batch(self.idx_list[self.current_idx:self.current_idx + self.batch_size])
         self.current_idx += self.batch_size
         if (self.current_idx+self.batch_size >= self.steps_per_epoch*self.batch_size-1) and self.manual_reset:
             self.current_idx = 0
@@ -98,8 +99,11 @@ class CVAEPredDataGenerator(GeneratorMaster):
         x = self.input_d_checking(inputs, idx_list_temp)
         return x
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, idx_list_temp)
+
     def __getitem__(self, index):
-        x = self._data_generation(self.inputs, self.idx_list[self.current_idx:self.current_idx + self.batch_size])
+        x = self._get_batch(self.idx_list[self.current_idx:self.current_idx + self.batch_size])
         self.current_idx += self.batch_size
         if (self.current_idx+self.batch_size >= self.steps_per_epoch*self.batch_size-1) and self.manual_reset:
             self.current_idx = 0
@@ -162,6 +166,7 @@ class ConvVAEBase(NeuralNetMaster, ABC):
                 loss_weights=None,
                 sample_weight_mode=None):
         self.keras_model, self.keras_encoder, self.keras_decoder = self.model()
+        self._jacobian_cache = {}  # cached gradient tensors are of the old keras_model
 
         if optimizer is not None:
             self.optimizer = optimizer
@@ -197,12 +202,12 @@ class ConvVAEBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(input_recon_target)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(input_recon_target, calc=False)
 
         if self.keras_model is None:  # only compiler if there is no keras_model, e.g. fine-tuning does not required
@@ -260,11 +265,7 @@ class ConvVAEBase(NeuralNetMaster, ABC):
 
         start_time = time.time()
 
-        self.keras_model.fit_generator(generator=self.training_generator,
-                                       validation_data=self.validation_generator,
-                                       epochs=self.max_epochs, verbose=self.verbose, workers=os.cpu_count(),
-                                       callbacks=self.__callbacks,
-                                       use_multiprocessing=MULTIPROCESS_FLAG)
+        self._fit_pipeline(self.__callbacks)
 
         print(f'Completed Training, {(time.time() - start_time):.{2}f}s in total')
 
@@ -291,12 +292,12 @@ class ConvVAEBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(input_recon_target)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(input_recon_target, calc=False)
 
         steps = input_data.shape[0] // self.batch_size if input_data.shape[0] > self.batch_size else 1
@@ -312,8 +313,8 @@ class ConvVAEBase(NeuralNetMaster, ABC):
         scores = self.keras_model.fit_generator(generator=fit_generator,
                                                 epochs=1,
                                                 verbose=self.verbose,
-                                                workers=os.cpu_count(),
-                                                use_multiprocessing=MULTIPROCESS_FLAG)
+                                                use_multiprocessing=MULTIPROCESS_FLAG,
+                                                **self._queue_kwargs([fit_generator]))
 
         print(f'Completed Training on Batch, {(time.time() - start_time):.{2}f}s in total')
 
@@ -368,7 +369,7 @@ class ConvVAEBase(NeuralNetMaster, ABC):
         input_data = np.atleast_2d(input_data)
 
         if self.input_normalizer is not None:
-            input_array = self.input_normalizer.normalize(input_data, calc=False)
+            input_array = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
         else:
             # Prevent shallow copy issue
             input_array = np.array(input_data)
@@ -377,34 +378,15 @@ class ConvVAEBase(NeuralNetMaster, ABC):
 
         total_test_num = input_data.shape[0]  # Number of testing data
 
-        # for number of training data smaller than batch_size
-        if input_data.shape[0] < self.batch_size:
-            self.batch_size = input_data.shape[0]
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // self.batch_size) * self.batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        predictions = np.zeros((total_test_num, self._labels_shape, 1))
-
         start_time = time.time()
         print("Starting Inference")
 
-        # Data Generator for prediction
+        # Data Generator for prediction, batches are padded to batch_size
         prediction_generator = CVAEPredDataGenerator(batch_size=self.batch_size,
                                                      shuffle=False,
-                                                     steps_per_epoch=input_array.shape[0] // self.batch_size,
-                                                     data=[input_array[:data_gen_shape]])
-        predictions[:data_gen_shape] = np.asarray(self.keras_model.predict_generator(
-            prediction_generator))
-
-        if remainder_shape != 0:
-            remainder_data = input_array[data_gen_shape:]
-            # assume its caused by mono images, so need to expand dim by 1
-            if len(input_array[0].shape) != len(self._input_shape):
-                remainder_data = np.expand_dims(remainder_data, axis=-1)
-            result = self.keras_model.predict(remainder_data)
-            predictions[data_gen_shape:] = result
+                                                     steps_per_epoch=-(-total_test_num // self.batch_size),
+                                                     data=[input_array])
+        predictions = self._predict_padded(self.keras_model, prediction_generator, output_shape=(self._labels_shape, 1))
 
         if self.labels_normalizer is not None:
             predictions[:, :, 0] = self.labels_normalizer.denormalize(predictions[:, :, 0])
@@ -429,7 +411,7 @@ class ConvVAEBase(NeuralNetMaster, ABC):
         self.pre_testing_checklist_master()
         # Prevent shallow copy issue
         if self.input_normalizer is not None:
-            input_array = self.input_normalizer.normalize(input_data, calc=False)
+            input_array = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
         else:
             # Prevent shallow copy issue
             input_array = np.array(input_data)
@@ -438,34 +420,15 @@ class ConvVAEBase(NeuralNetMaster, ABC):
 
         total_test_num = input_data.shape[0]  # Number of testing data
 
-        # for number of training data smaller than batch_size
-        if input_data.shape[0] < self.batch_size:
-            self.batch_size = input_data.shape[0]
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // self.batch_size) * self.batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        encoding = np.zeros((total_test_num, self.latent_dim))
-
         start_time = time.time()
         print("Starting Inference on Encoder")
 
-        # Data Generator for prediction
+        # Data Generator for prediction, batches are padded to batch_size
         prediction_generator = CVAEPredDataGenerator(batch_size=self.batch_size,
                                                      shuffle=False,
-                                                     steps_per_epoch=input_array.shape[0] // self.batch_size,
-                                                     data=[input_array[:data_gen_shape]])
-        encoding[:data_gen_shape] = np.asarray(self.keras_encoder.predict_generator(
-            prediction_generator))
-
-        if remainder_shape != 0:
-            remainder_data = input_array[data_gen_shape:]
-            # assume its caused by mono images, so need to expand dim by 1
-            if len(input_array[0].shape) != len(self._input_shape):
-                remainder_data = np.expand_dims(remainder_data, axis=-1)
-            result = self.keras_encoder.predict(remainder_data)
-            encoding[data_gen_shape:] = result
+                                                     steps_per_epoch=-(-total_test_num // self.batch_size),
+                                                     data=[input_array])
+        encoding = self._predict_padded(self.keras_encoder, prediction_generator, output_shape=(self.latent_dim,))
 
         print(f'Completed Inference on Encoder, {(time.time() - start_time):.{2}f}s elapsed')
 
@@ -488,27 +451,24 @@ class ConvVAEBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self.input_normalizer.normalize(input_data, dtype=np.float32)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
-        eval_batchsize = self.batch_size if input_data.shape[0] > self.batch_size else input_data.shape[0]
-        steps = input_data.shape[0] // self.batch_size if input_data.shape[0] > self.batch_size else 1
-
         start_time = time.time()
         print("Starting Evaluation")
 
-        evaluate_generator = CVAEDataGenerator(batch_size=eval_batchsize,
+        evaluate_generator = CVAEDataGenerator(batch_size=self.batch_size,
                                                shuffle=False,
-                                               steps_per_epoch=steps,
+                                               steps_per_epoch=-(-input_data.shape[0] // self.batch_size),
                                                data=[norm_data,
                                                      norm_labels])
 
-        scores = self.keras_model.evaluate_generator(evaluate_generator)
+        scores = self._evaluate_batches(self.keras_model, evaluate_generator)
         if isinstance(scores, float):  # make sure scores is iterable
             scores = list(str(scores))
         outputname = self.keras_model.output_names
@@ -0,0 +1,302 @@
+###############################################################################
+#   predictor.py: low latency inference with loaded astroNN neural network
+###############################################################################
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as tfk
+
+from astroNN.models.base_bayesian_cnn import BayesianCNNBase
+
+
+class Predictor(object):
+    """
+    | Persistent predictor built once from an astroNN neural network for low latency inference of one or a few data
+    | at a time. The Monte Carlo model (for Bayesian neural network), graph and session are cached, requests from
+    | many threads are grouped to batches by a single worker thread within ``max_latency`` seconds, padded to
+    | ``batch_size`` so every batch has the same shape.
+
+    :param neuralnet: astroNN neural network with a model, trained or from ``load_folder()``
+    :type neuralnet: astroNN.models.base_master_nn.NeuralNetMaster
+    :param batch_size: Maximum number of data in a batch, default to neuralnet.batch_size (limited by
+        neuralnet.mc_memory_budget for Bayesian neural network)
+    :type batch_size: Union[NoneType, int]
+    :param max_latency: Maximum time in second to wait for more requests to be grouped into a batch
+    :type max_latency: float
+    :param mc_num: Number of Monte Carlo integration for Bayesian neural network, default to neuralnet.mc_num
+    :type mc_num: Union[NoneType, int]
+    """
+
+    def __init__(self, neuralnet, batch_size=None, max_latency=0.005, mc_num=None):
+        neuralnet.has_model_check()
+        neuralnet.pre_testing_checklist_master()
+        self.neuralnet = neuralnet
+        self.max_latency = max_latency
+        self.bayesian = isinstance(neuralnet, BayesianCNNBase)
+        self.mc_num = neuralnet.mc_num if mc_num is None and self.bayesian else mc_num
+
+        self.graph = neuralnet.graph if neuralnet.graph is not None else tf.get_default_graph()
+        self.session = neuralnet.session if neuralnet.session is not None else tfk.backend.get_session()
+
+        if batch_size is None:
+            batch_size = neuralnet.batch_size
+            if self.bayesian:
+                num_passes = neuralnet.mc_memory_budget // (neuralnet._mc_pass_nbytes() * self.mc_num)
+                batch_size = max(1, min(batch_size, int(num_passes)))
+        self.batch_size = batch_size
+
+        with self.graph.as_default():
+            if self.bayesian:
+                self.keras_model = neuralnet._fast_mc_model(self.mc_num)
+                self._output_size = int(np.prod(neuralnet.keras_model_predict.output_shape[1:]))
+            else:
+                self.keras_model = neuralnet.keras_model
+            # build predict function now so it is not built concurrently by the worker
+            if hasattr(self.keras_model, '_make_predict_function'):
+                self.keras_model._make_predict_function()
+
+        # number of dimensions of a single data without the channel axis added by astroNN
+        input_shape = tuple(neuralnet._input_shape)
+        self._data_ndim = len(input_shape) - 1 if input_shape[-1] == 1 else len(input_shape)
+        self._batch = np.zeros((self.batch_size,) + tuple(neuralnet._input_shape), dtype=np.float32)
+
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._work, name='astroNN-predictor', daemon=True)
+        self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker thread after finishing requests submitted so far
+
+        :return: None
+        """
+        if self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join()
+
+    def submit(self, input_data):
+        """
+        Submit data to be inferred without blocking
+
+        :param input_data: Data to be inferred with neural network, a single data or a few data
+        :type input_data: ndarray
+        :return: Future of the result of ``predict()``
+        :rtype: concurrent.futures.Future
+        """
+        if not self._worker.is_alive():
+            raise RuntimeError('Predictor is closed')
+        input_data = np.asarray(input_data, dtype=np.float32)
+        if input_data.ndim == self._data_ndim:  # a single data
+            input_data = input_data[np.newaxis]
+        future = Future()
+        self._queue.put((input_data, future))
+        return future
+
+    def predict(self, input_data, timeout=None):
+        """
+        Infer data and wait for the result
+
+        :param input_data: Data to be inferred with neural network, a single data or a few data
+        :type input_data: ndarray
+        :param timeout: Maximum time in second to wait for the result
+        :type timeout: Union[NoneType, float]
+        :return: prediction and prediction uncertainty for Bayesian neural network, otherwise prediction
+        :rtype: Union[tuple, ndarray]
+        """
+        return self.submit(input_data).result(timeout=timeout)
+
+    def _work(self):
+        """
+        Worker thread to group requests into batches and infer
+        """
+        stop = False
+        while not stop:
+            request = self._queue.get()
+            if request is None:
+                break
+            requests = [request]
+            num_data = request[0].shape[0]
+            deadline = time.perf_counter() + self.max_latency
+            while num_data < self.batch_size:
+                try:
+                    request = self._queue.get(timeout=max(0., deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                requests.append(request)
+                num_data += request[0].shape[0]
+
+            try:
+                results = self._infer(np.concatenate([_request[0] for _request in requests]))
+            except Exception as e:
+                for _request in requests:
+                    _request[1].set_exception(e)
+                continue
+
+            start = 0
+            for input_data, future in requests:
+                end = start + input_data.shape[0]
+                if self.bayesian:
+                    future.set_result((results[0][start:end], {key: value[start:end]
+                                                               for key, value in results[1].items()}))
+                else:
+                    future.set_result(results[start:end])
+                start = end
+
+    def _infer(self, input_data):
+        """
+        Normalize, infer in fixed shape batches and denormalize
+        """
+        neuralnet = self.neuralnet
+        if neuralnet.input_normalizer is not None:
+            input_array = neuralnet.input_normalizer.normalize(input_data, calc=False, dtype=np.float32)
+        else:
+            input_array = np.array(input_data, dtype=np.float32)
+            input_array -= neuralnet.input_mean
+            input_array /= neuralnet.input_std
+
+        outputs = []
+        with self.graph.as_default(), self.session.as_default():
+            for i in range(0, input_array.shape[0], self.batch_size):
+                num = min(self.batch_size, input_array.shape[0] - i)
+                # pad with the last data to keep the batch shape fixed
+                self._batch.reshape(self.batch_size, -1)[:num] = input_array[i:i + num].reshape(num, -1)
+                self._batch[num:] = self._batch[num - 1]
+                output = np.asarray(self.keras_model.predict_on_batch(self._batch))
+                if self.bayesian:  # mean and variance of Monte Carlo integration
+                    output = output.reshape(self.batch_size, self._output_size, 2)
+                outputs.append(output[:num])
+        result = np.concatenate(outputs)
+
+        if self.bayesian:
+            return neuralnet._test_postprocess(result)
+
+        result = result.reshape(result.shape[0], -1)
+        if neuralnet.labels_normalizer is not None:
+            return neuralnet.labels_normalizer.denormalize(result)
+        else:
+            result *= neuralnet.labels_std
+            result += neuralnet.labels_mean
+            return result
+
+
+def _to_json(result):
+    """
+    Convert result of Predictor to JSON serializable dictionary
+    """
+    if isinstance(result, tuple):
+        return {'prediction': np.asarray(result[0]).tolist(),
+                **{key: np.asarray(value).tolist() for key, value in result[1].items()}}
+    else:
+        return {'prediction': np.asarray(result).tolist()}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(predictor, host='127.0.0.1', port=8000):
+    """
+    Serve a Predictor with a local HTTP server, POST a JSON object {"input": data} to get a JSON object of
+    "prediction" (and "total", "model", "predictive" uncertainty for Bayesian neural network).
+    Every request is handled in its own thread so concurrent requests are batched by the Predictor.
+
+    :param predictor: Predictor
+    :type predictor: Predictor
+    :param host: Host to bind
+    :type host: str
+    :param port: Port to bind, 0 to use a free port
+    :type port: int
+    :return: HTTP server, call ``serve_forever()`` to start serving and ``shutdown()`` to stop
+    :rtype: http.server.HTTPServer
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                body = json.dumps(_to_json(predictor.predict(np.asarray(request['input'])))).encode('utf-8')
+                status = 200
+            except (ValueError, KeyError, TypeError) as e:
+                body = json.dumps({'error': str(e)}).encode('utf-8')
+                status = 400
+            except Exception as e:  # error of inference
+                body = json.dumps({'error': f'{e.__class__.__name__}: {e}'}).encode('utf-8')
+                status = 500
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _ThreadingHTTPServer((host, port), _Handler)
+
+
+def serve_stdin(predictor, stdin=None, stdout=None):
+    """
+    Serve a Predictor with JSON lines, every line of stdin is a JSON object {"input": data} and the result is
+    written as a line of JSON object to stdout in the same order
+
+    :param predictor: Predictor
+    :type predictor: Predictor
+    :param stdin: File object to read requests, default to sys.stdin
+    :param stdout: File object to write results, default to sys.stdout
+    :return: None
+    """
+    stdin = sys.stdin if stdin is None else stdin
+    stdout = sys.stdout if stdout is None else stdout
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            result = _to_json(predictor.predict(np.asarray(json.loads(line)['input'])))
+        except (ValueError, KeyError, TypeError) as e:
+            result = {'error': str(e)}
+        except Exception as e:  # error of inference
+            result = {'error': f'{e.__class__.__name__}: {e}'}
+        stdout.write(json.dumps(result) + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from astroNN.models import load_folder
+
+    parser = argparse.ArgumentParser(description='Serve a saved astroNN model with a low latency predictor')
+    parser.add_argument('folder', help='astroNN model folder')
+    parser.add_argument('--port', type=int, default=None, help='serve HTTP on this port instead of stdin/stdout')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--max-latency', type=float, default=0.005)
+    args = parser.parse_args()
+
+    with Predictor(load_folder(args.folder), max_latency=args.max_latency) as _predictor:
+        if args.port is None:
+            serve_stdin(_predictor)
+        else:
+            server = serve_http(_predictor, host=args.host, port=args.port)
+            print(f'Serving on http://{args.host}:{server.server_address[1]}', file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                server.shutdown()
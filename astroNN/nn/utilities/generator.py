@@ -1,15 +1,57 @@
+import threading
+import weakref
+
 import numpy as np
 
+import tensorflow as tf
 import tensorflow.keras as tfk
+
 Sequence = tfk.utils.Sequence
 
+# owner of a ring buffer between _ring_buffer() and _ring_release()
+_CLAIMED = object()
+
+
+def _flatten(structure):
+    """
+    Flatten nested tuples and dicts (sorted by keys) of arrays to a list
+    """
+    if isinstance(structure, dict):
+        return [leaf for key in sorted(structure) for leaf in _flatten(structure[key])]
+    elif isinstance(structure, (tuple, list)):
+        return [leaf for item in structure for leaf in _flatten(item)]
+    else:
+        return [structure]
+
+
+def _pack(structure, flat):
+    """
+    Pack a flat list back to the nested structure of _flatten()
+    """
+    flat = iter(flat)
+
+    def _pack_iter(_structure):
+        if isinstance(_structure, dict):
+            return {key: _pack_iter(_structure[key]) for key in sorted(_structure)}
+        elif isinstance(_structure, (tuple, list)):
+            return tuple(_pack_iter(item) for item in _structure)
+        else:
+            return next(flat)
+
+    return _pack_iter(structure)
+
 
 class GeneratorMaster(Sequence):
     """
     | Top-level class of astroNN data pipeline to generate data for NNs.
     | It is implemented based on Tensorflow data ``Sequence`` class.
 
-    You need to implement the ``__getitem__`` in the generator sub-class
+    You need to implement the ``__getitem__`` in the generator sub-class, and ``_get_batch`` to build a batch from
+    a list of index statelessly to use ``tf_dataset``
+
+    | Batches from ``input_d_checking`` are float32 views of ring buffers of at most ``ring_size`` buffers for every
+    | batch shape. A buffer is owned by the batch returned for it and is only reused after that batch is released, so
+    | batches kept by consumers are not changed. ``set_queue()`` sizes the ring for keras workers and queue.
 
     :History: 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
     """
@@ -23,9 +65,113 @@ class GeneratorMaster(Sequence):
 
         self.steps_per_epoch = steps_per_epoch
 
+        # buffers kept for every batch shape, see set_queue()
+        self.ring_size = 2
+        self._ring_buffers = {}
+        self._ring_lock = threading.Lock()
+
+    def __getstate__(self):
+        # lock cannot be pickled and buffers do not need to be sent to other processes
+        state = self.__dict__.copy()
+        state.update({'_ring_buffers': {}, '_ring_lock': None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ring_lock = threading.Lock()
+
     def __len__(self):
         return self.steps_per_epoch
 
+    def set_queue(self, workers, max_queue_size):
+        """
+        Keep enough ring buffers for all batches alive at the same time when batches are built by keras with workers
+        and a queue of max_queue_size batches
+
+        :param workers: Number of workers passed to keras
+        :type workers: int
+        :param max_queue_size: max_queue_size passed to keras
+        :type max_queue_size: int
+        :return: None
+        """
+        # batches being built by workers + batches in the queue + batches being consumed
+        self.ring_size = workers + max_queue_size + 2
+
+    def _get_batch(self, idx_list_temp):
+        """
+        Build a batch from a list of index without changing the state of the generator
+
+        :param idx_list_temp: index of data in this batch
+        :type idx_list_temp: ndarray
+        :return: batch in the same structure as ``__getitem__``
+        """
+        raise NotImplementedError
+
+    def tf_dataset(self, num_parallel_calls=None, prefetch=None, deterministic=False, seed=None, shard_size=None):
+        """
+        Build a ``tf.data.Dataset`` from the data of this generator as an alternative to ``Sequence`` which keeps no
+        mutable state so it is safe to be used with parallel calls. Index are shuffled by shards of contiguous
+        index (shard order then index within a buffer of two shards) so lazily loaded data are read mostly in
+        order, batches are built by ``_get_batch`` with parallel calls and prefetched to overlap with training.
+
+        :param num_parallel_calls: Number of batches to build in parallel, default to tf.data.experimental.AUTOTUNE
+        :type num_parallel_calls: Union[int, NoneType]
+        :param prefetch: Number of batches to prefetch, default to tf.data.experimental.AUTOTUNE
+        :type prefetch: Union[int, NoneType]
+        :param deterministic: True to have the same order of batches in every run, seed default to 0 if True.
+            Order of batches of parallel calls is always kept with tensorflow older than 1.13
+        :type deterministic: bool
+        :param seed: Random seed of shuffling
+        :type seed: Union[int, NoneType]
+        :param shard_size: Number of contiguous index in a shard, default to 16 batches
+        :type shard_size: Union[int, NoneType]
+        :return: infinite dataset of batches, use ``len()`` of this generator as steps per epoch
+        :rtype: tf.data.Dataset
+        """
+        num_data = self.inputs.shape[0]
+        autotune = getattr(tf.data.experimental, 'AUTOTUNE', -1)
+        num_parallel_calls = autotune if num_parallel_calls is None else num_parallel_calls
+        prefetch = autotune if prefetch is None else prefetch
+        shard_size = 16 * self.batch_size if shard_size is None else shard_size
+        if deterministic is True and seed is None:
+            seed = 0
+
+        num_shards = -(-num_data // shard_size)
+        dataset = tf.data.Dataset.range(num_shards)
+        if self.shuffle is True:
+            dataset = dataset.shuffle(num_shards, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.flat_map(
+            lambda shard: tf.data.Dataset.range(shard * shard_size, tf.minimum((shard + 1) * shard_size, num_data)))
+        if self.shuffle is True:
+            dataset = dataset.shuffle(2 * shard_size, seed=seed, reshuffle_each_iteration=True)
+        # drop the last incomplete batch as Sequence does when shuffling in training
+        dataset = dataset.batch(self.batch_size, drop_remainder=self.shuffle is True and num_data >= self.batch_size)
+        dataset = dataset.repeat()
+
+        # structure, dtype and shape of a batch, the first dimension is the batch size
+        example = self._get_batch(np.arange(min(self.batch_size, num_data)))
+        example_flat = [np.asarray(leaf) for leaf in _flatten(example)]
+
+        def _py_get_batch(idx_list_temp):
+            # copy out of ring buffers because tensorflow can keep using the memory of returned arrays
+            return [np.array(leaf) for leaf in _flatten(self._get_batch(idx_list_temp))]
+
+        def _map_func(idx_list_temp):
+            flat = tf.py_func(_py_get_batch, [idx_list_temp], [tf.as_dtype(leaf.dtype) for leaf in example_flat],
+                              stateful=False)
+            for tensor, leaf in zip(flat, example_flat):
+                tensor.set_shape((None,) + leaf.shape[1:])
+            return _pack(example, flat)
+
+        dataset = dataset.map(_map_func, num_parallel_calls=num_parallel_calls)
+        # tf.data.Options is only available since tensorflow 1.13, order of batches is always kept before that
+        if hasattr(tf.data, 'Options') and hasattr(dataset, 'with_options'):
+            options = tf.data.Options()
+            if hasattr(options, 'experimental_deterministic'):
+                options.experimental_deterministic = deterministic
+                dataset = dataset.with_options(options)
+        return dataset.prefetch(prefetch)
+
     def _get_exploration_order(self, idx_list):
         """
         :param idx_list:
@@ -45,22 +191,122 @@ class GeneratorMaster(Sequence):
         #                  for i in range(y.shape[0])])
         pass
 
-    def input_d_checking(self, inputs, idx_list_temp):
-        if inputs.ndim == 2:
-            x = np.empty((len(idx_list_temp), inputs.shape[1], 1))
-            # Generate data
-            x[:, :, 0] = inputs[idx_list_temp]
-
-        elif inputs.ndim == 3:
-            x = np.empty((len(idx_list_temp), inputs.shape[1], inputs.shape[2], 1))
-            # Generate data
-            x[:, :, :, 0] = inputs[idx_list_temp]
-
-        elif inputs.ndim == 4:
-            x = np.empty((len(idx_list_temp), inputs.shape[1], inputs.shape[2], inputs.shape[3]))
-            # Generate data
-            x[:, :, :, :] = inputs[idx_list_temp]
-        else:
+    def _ring_buffer(self, key, shape):
+        """
+        Get a free float32 buffer of the ring buffers of ``key`` and ``shape``, buffers are allocated on first use.
+        The buffer is owned by the caller until it is given to ``_ring_release()`` with the batch using it, a new
+        buffer not kept by the ring is allocated if all ``ring_size`` buffers are owned by batches.
+
+        :return: buffer and its slot in the ring (None if not kept by the ring)
+        :rtype: tuple
+        """
+        with self._ring_lock:
+            ring = self._ring_buffers.setdefault((key, shape), [])
+            for slot in ring:
+                if slot['owner'] is None or (slot['owner'] is not _CLAIMED and slot['owner']() is None):
+                    slot['owner'] = _CLAIMED
+                    return slot['buffer'], slot
+            buffer = np.empty(shape, dtype=np.float32)
+            if len(ring) < self.ring_size:
+                slot = {'buffer': buffer, 'owner': _CLAIMED}
+                ring.append(slot)
+                return buffer, slot
+            return buffer, None
+
+    def _ring_release(self, slot, batch=None):
+        """
+        Hand the buffer of slot over to batch (a view of the buffer), the buffer is free again once batch is released.
+        The buffer is free immediately if batch is None.
+        """
+        if slot is not None:
+            with self._ring_lock:
+                slot['owner'] = None if batch is None else weakref.ref(batch)
+
+    def input_d_checking(self, inputs, idx_list_temp, key='inputs'):
+        """
+        Assemble a batch of inputs with channel axis added if needed
+
+        :param inputs: inputs, ndarray or array-like such as H5LazyArray
+        :type inputs: Union[ndarray, astroNN.datasets.h5.H5LazyArray]
+        :param idx_list_temp: index of inputs in this batch
+        :type idx_list_temp: Union[ndarray, list]
+        :param key: name of the ring buffers to use, different inputs in the same batch need different keys
+        :type key: str
+        :return: batch in a float32 ring buffer
+        :rtype: ndarray
+        """
+        if inputs.ndim not in (2, 3, 4):
             raise ValueError(f"Unsupported data dimension, your data has {inputs.ndim} dimension")
 
-        return x
+        idx_list_temp = np.asarray(idx_list_temp)
+        x, slot = self._ring_buffer(key, (idx_list_temp.shape[0],) + tuple(inputs.shape[1:]))
+        try:
+            if not isinstance(inputs, np.ndarray):
+                x[...] = inputs[idx_list_temp]
+            elif idx_list_temp.shape[0] > 0 and idx_list_temp[-1] - idx_list_temp[0] == idx_list_temp.shape[0] - 1 \
+                    and np.all(np.diff(idx_list_temp) == 1):
+                # unshuffled batch is a contiguous slice
+                x[...] = inputs[idx_list_temp[0]:idx_list_temp[-1] + 1]
+            elif inputs.dtype == x.dtype:
+                np.take(inputs, idx_list_temp, axis=0, out=x)
+            else:
+                x[...] = inputs[idx_list_temp]
+        except BaseException:
+            self._ring_release(slot)
+            raise
+
+        # batch is always a new view (with channel axis if needed) owning the buffer
+        batch = x[...] if inputs.ndim == 4 else x[..., np.newaxis]
+        self._ring_release(slot, batch)
+        return batch
+
+
+class PaddedBatchGenerator(Sequence):
+    """
+    | Wrap an astroNN generator to yield fixed shape batches covering all data, the last batch is padded by repeating
+    | the last data so any number of data can be inferred without a batch of a different shape.
+    | Batches are built by ``_get_batch`` of the wrapped generator statelessly from ``index``.
+
+    :param generator: astroNN generator with ``_get_batch`` implemented
+    :type generator: GeneratorMaster
+    :param sample_weight: True to yield (inputs, targets, sample weights) with zero weight for every output of
+        padded data so they do not contribute to losses and metrics
+    :type sample_weight: bool
+    """
+
+    def __init__(self, generator, sample_weight=False):
+        self.generator = generator
+        self.batch_size = generator.batch_size
+        self.num_data = generator.inputs.shape[0]
+        self.sample_weight = sample_weight
+
+    def __len__(self):
+        return -(-self.num_data // self.batch_size)
+
+    def set_queue(self, workers, max_queue_size):
+        """
+        See ``GeneratorMaster.set_queue()``, batches are built by the wrapped generator
+        """
+        self.generator.set_queue(workers, max_queue_size)
+
+    def num_batch_data(self, index):
+        """
+        Number of data which are not padding in the batch of ``index``
+        """
+        return min(self.batch_size, self.num_data - index * self.batch_size)
+
+    def __getitem__(self, index):
+        idx_list_temp = np.arange(index * self.batch_size, (index + 1) * self.batch_size)
+        np.minimum(idx_list_temp, self.num_data - 1, out=idx_list_temp)
+        batch = self.generator._get_batch(idx_list_temp)
+        if self.sample_weight is False:
+            return batch
+        x, y = batch
+        weight = np.zeros(self.batch_size, dtype=np.float32)
+        weight[:self.num_batch_data(index)] = 1.
+        if isinstance(y, dict):
+            return x, y, {name: weight for name in y}
+        elif isinstance(y, (list, tuple)):
+            return x, y, [weight] * len(y)
+        else:
+            return x, y, weight
@@ -0,0 +1,137 @@
+###############################################################################
+#   inference_graph.py: load and run frozen inference graph exported by astroNN
+###############################################################################
+import json
+
+import numpy as np
+import tensorflow as tf
+
+_METADATA_NODE = 'astroNN_metadata'
+
+
+def float16_constants(graph_def, min_size=16):
+    """
+    Store float32 constants of a GraphDef as float16 followed by a cast back to float32, to halve the size of weights
+    while inference is still done in float32
+
+    :param graph_def: GraphDef with weights as constants
+    :type graph_def: tf.GraphDef
+    :param min_size: Minimum number of elements of a constant to be converted
+    :type min_size: int
+    :return: GraphDef with float16 weights
+    :rtype: tf.GraphDef
+    """
+    output_graph_def = tf.GraphDef()
+    for node in graph_def.node:
+        if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum:
+            value = tf.make_ndarray(node.attr['value'].tensor)
+            if value.size >= min_size:
+                const_node = output_graph_def.node.add()
+                const_node.op = 'Const'
+                const_node.name = f'{node.name}/float16'
+                const_node.device = node.device
+                const_node.attr['dtype'].type = tf.float16.as_datatype_enum
+                const_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value.astype(np.float16)))
+
+                # cast node takes the name of the constant so its consumers are unchanged
+                cast_node = output_graph_def.node.add()
+                cast_node.op = 'Cast'
+                cast_node.name = node.name
+                cast_node.device = node.device
+                cast_node.input.append(const_node.name)
+                cast_node.attr['SrcT'].type = tf.float16.as_datatype_enum
+                cast_node.attr['DstT'].type = tf.float32.as_datatype_enum
+                continue
+        output_graph_def.node.add().CopyFrom(node)
+    output_graph_def.library.CopyFrom(graph_def.library)
+    output_graph_def.versions.CopyFrom(graph_def.versions)
+    return output_graph_def
+
+
+class InferenceGraph(object):
+    """
+    | Run a frozen inference graph exported by ``export_inference_graph()`` of an astroNN neural network.
+    | Normalization and Monte Carlo integration are inside the graph so only tensorflow is needed, astroNN model
+    | classes are not imported. Data are fed as they are (not normalized) in batches of batch_size.
+
+    :param filename: File name of the exported graph
+    :type filename: str
+    :param batch_size: Number of data per session run
+    :type batch_size: int
+    :param config: Session config
+    :type config: Union[NoneType, tf.ConfigProto]
+    """
+
+    def __init__(self, filename, batch_size=64, config=None):
+        self.filename = filename
+        self.batch_size = batch_size
+
+        graph_def = tf.GraphDef()
+        with open(filename, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = tf.Session(graph=self.graph, config=config)
+
+        self.metadata = json.loads(self.session.run(f'{_METADATA_NODE}:0').decode('utf-8'))
+        self.input_tensor = self.graph.get_tensor_by_name(self.metadata['input'])
+        self.output_names = list(self.metadata['outputs'].keys())
+        self.output_tensors = [self.graph.get_tensor_by_name(name) for name in self.metadata['outputs'].values()]
+        self._input_ndim = len(self.input_tensor.shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Close the session of the graph
+
+        :return: None
+        """
+        self.session.close()
+
+    def predict(self, input_data):
+        """
+        Infer data with the graph
+
+        :param input_data: Data to be inferred, not normalized
+        :type input_data: ndarray
+        :return: prediction if the graph only has prediction, otherwise dictionary of every output
+        :rtype: Union[ndarray, dict]
+        """
+        input_data = np.asarray(input_data, dtype=np.float32)
+        if input_data.ndim == self._input_ndim - 1:  # channel axis
+            input_data = input_data[..., np.newaxis]
+
+        outputs = [[] for _ in self.output_tensors]
+        for i in range(0, input_data.shape[0], self.batch_size):
+            results = self.session.run(self.output_tensors,
+                                       feed_dict={self.input_tensor: input_data[i:i + self.batch_size]})
+            for output, result in zip(outputs, results):
+                output.append(result)
+        outputs = {name: np.concatenate(output) for name, output in zip(self.output_names, outputs)}
+
+        if self.output_names == ['prediction']:
+            return outputs['prediction']
+        return outputs
+
+
+def load_inference_graph(filename, batch_size=64, config=None):
+    """
+    Load a frozen inference graph exported by ``export_inference_graph()`` of an astroNN neural network
+
+    :param filename: File name of the exported graph
+    :type filename: str
+    :param batch_size: Number of data per session run
+    :type batch_size: int
+    :param config: Session config
+    :type config: Union[NoneType, tf.ConfigProto]
+    :return: Inference graph with ``predict()``
+    :rtype: InferenceGraph
+    """
+    return InferenceGraph(filename, batch_size=batch_size, config=config)
@@ -41,6 +41,14 @@ class Normalizer(object):
         else:
             data_array = np.array(data)
 
+        self._mode_flags()
+
+        return data_array
+
+    def _mode_flags(self):
+        """
+        Set center and standardization flags according to normalization mode
+        """
         self.normalization_mode = str(self.normalization_mode)  # just to prevent unnecessary type issue
         if self.normalization_mode == '0':
             self.featurewise_center = False
@@ -87,12 +95,124 @@ class Normalizer(object):
         else:
             raise ValueError(f"Unknown Mode -> {self.normalization_mode}")
 
-        return data_array
+    def set_statistics(self, mean, std):
+        """
+        Set mean_labels and std_labels from statistics computed before (e.g. by ``fit()`` or persisted with the data)
+        instead of computing them from data
+
+        :param mean: Mean
+        :type mean: Union[float, ndarray]
+        :param std: Standard derivation
+        :type std: Union[float, ndarray]
+        :return: None
+        """
+        self._mode_flags()
+        self.mean_labels, self.std_labels = np.asarray(mean), np.asarray(std)
+
+    def get_statistics(self, linear_only=False):
+        """
+        Get mean_labels and std_labels of the normalization mode, normalized data is (data - mean) / std followed by a
+        non-linear function for some modes (e.g. '3s')
+
+        :param linear_only: True to raise ValueError if the normalization mode is not linear
+        :type linear_only: bool
+        :return: mean and standard derivation
+        :rtype: tuple
+        """
+        self._mode_flags()
+        if linear_only is True and (self._custom_norm_func is not None or self._custom_denorm_func is not None):
+            raise ValueError(f'Normalization mode {self.normalization_mode} is not linear')
+        return self.mean_labels, self.std_labels
+
+    def fit(self, data, batch_size=4096):
+        """
+        Compute mean_labels and std_labels in a single numerically stable pass over batches of rows without
+        normalizing data, so data does not need to fit in memory. Statistics of batches are merged with Chan et al.
+        parallel algorithm and MAGIC_NUMBER is ignored. Features with MAGIC_NUMBER only have mean 0 and std 1.
+
+        :param data: Data, can be ndarray or array-like supporting shape and slicing like h5py dataset or H5LazyArray,
+            or an iterator of batches of rows
+        :type data: Union[ndarray, h5py.Dataset, astroNN.datasets.h5.H5LazyArray, Iterable[ndarray]]
+        :param batch_size: Number of rows to read at a time if data supports slicing
+        :type batch_size: int
+        :return: None
+        """
+        self._mode_flags()
+        datasetwise = self.datasetwise_center is True or self.datasetwise_stdalization is True
+
+        if hasattr(data, 'shape') and hasattr(data, '__getitem__'):
+            batches = (data[i:i + batch_size] for i in range(0, data.shape[0], batch_size))
+        else:
+            batches = data
+
+        count, mean, m2 = 0, 0., 0.
+        for batch in batches:
+            batch = np.asarray(batch, dtype=np.float64)
+            if batch.ndim == 1:
+                batch = np.expand_dims(batch, 1)
+            axis = None if datasetwise else 0
+            valid = batch != MAGIC_NUMBER
+            batch_count = np.sum(valid, axis=axis)
+            batch_mean = np.sum(batch, axis=axis, where=valid) / np.maximum(batch_count, 1)
+            batch_m2 = np.sum(np.square(batch - batch_mean), axis=axis, where=valid)
 
-    def normalize(self, data, calc=True):
-        data_array = self.mode_checker(data)
+            # merge statistics of this batch with statistics so far
+            new_count = count + batch_count
+            delta = batch_mean - mean
+            mean = mean + delta * batch_count / np.maximum(new_count, 1)
+            m2 = m2 + batch_m2 + np.square(delta) * count * batch_count / np.maximum(new_count, 1)
+            count = new_count
 
-        magic_mask = [(data_array == MAGIC_NUMBER)]
+        std = np.where(count > 0, np.sqrt(m2 / np.maximum(count, 1)), 1.)
+
+        if self.featurewise_center is True or self.datasetwise_center is True:
+            self.mean_labels = mean
+        if self.featurewise_stdalization is True or self.datasetwise_stdalization is True:
+            self.std_labels = std
+
+    def _prepare_output(self, data, out, dtype):
+        """
+        Expand 1D data to 2D and prepare the output buffer, data itself is used as output buffer if out is data
+        """
+        data_array = np.expand_dims(data, 1) if data.ndim == 1 else np.asarray(data)
+        if out is None:
+            out = np.empty(data_array.shape, dtype=data_array.dtype if dtype is None else dtype)
+        elif out.shape != data_array.shape:
+            out = out.reshape(data_array.shape)
+        return data_array, out
+
+    def _transform(self, data_array, out, func, block_size):
+        """
+        Apply func to data_array block by block of rows into out, entries with MAGIC_NUMBER are kept as MAGIC_NUMBER.
+        Magic masks are only allocated for a block at a time, data_array and out can be the same array.
+        """
+        rows = max(1, block_size // max(1, int(np.prod(data_array.shape[1:]))))
+        for i in range(0, data_array.shape[0], rows):
+            src, dst = data_array[i:i + rows], out[i:i + rows]
+            magic_mask = src == MAGIC_NUMBER
+            func(src, dst)
+            np.copyto(dst, MAGIC_NUMBER, where=magic_mask)
+        return out
+
+    def normalize(self, data, calc=True, out=None, dtype=None, block_size=1048576):
+        """
+        Normalize data
+
+        :param data: Data to be normalized
+        :type data: ndarray
+        :param calc: True to calculate mean_labels and std_labels from data first
+        :type calc: bool
+        :param out: Output buffer with the same number of elements as data, can be data itself to normalize in place
+        :type out: Union[NoneType, ndarray]
+        :param dtype: dtype of the output if out is not provided, default to the dtype of data
+        :type dtype: Union[NoneType, numpy.dtype]
+        :param block_size: Number of elements to be processed at a time
+        :type block_size: int
+        :return: Normalized data, 1D data will be expanded to 2D
+        :rtype: ndarray
+        """
+        self._mode_flags()
+        data_array, out = self._prepare_output(data, out, dtype)
 
         if calc is True:
             print(f'====Message from {self.__class__.__name__}====')
@@ -103,45 +223,39 @@ class Normalizer(object):
             print(f'Datawise std Center: {self.datasetwise_stdalization}')
             print('====Message ends====')
 
-            if self.featurewise_center is True:
-                self.mean_labels = np.ma.array(data_array, mask=magic_mask).mean(axis=0)
-                data_array -= self.mean_labels
-            elif self.datasetwise_center is True:
-                self.mean_labels = np.ma.array(data_array, mask=magic_mask).mean()
-                data_array -= self.mean_labels
-
-            if self.featurewise_stdalization is True:
-                self.std_labels = np.ma.array(data_array, mask=magic_mask).std(axis=0)
-                data_array /= self.std_labels
-            elif self.datasetwise_stdalization is True:
-                self.std_labels = np.ma.array(data_array, mask=magic_mask).std()
-                data_array /= self.std_labels
-
-            if self.normalization_mode == '255':
-                data_array -= self.mean_labels
-                data_array /= self.std_labels
-        else:
-            data_array -= self.mean_labels
-            data_array /= self.std_labels
-
-        if self._custom_norm_func is not None:
-            data_array = self._custom_norm_func(data_array)
+            self.fit(data_array)
 
-        np.place(data_array, magic_mask, MAGIC_NUMBER)
-
-        return data_array
+        def _normalize(src, dst):
+            np.subtract(src, self.mean_labels, out=dst, casting='unsafe')
+            np.divide(dst, self.std_labels, out=dst, casting='unsafe')
+            if self._custom_norm_func is not None:
+                dst[...] = self._custom_norm_func(dst)
 
-    def denormalize(self, data):
-        data_array = self.mode_checker(data)
+        return self._transform(data_array, out, _normalize, block_size)
 
-        magic_mask = [data_array == MAGIC_NUMBER]
-
-        if self._custom_denorm_func is not None:
-            data_array = self._custom_denorm_func(data_array)
+    def denormalize(self, data, out=None, dtype=None, block_size=1048576):
+        """
+        Denormalize data
 
-        data_array *= self.std_labels
-        data_array += self.mean_labels
+        :param data: Data to be denormalized
+        :type data: ndarray
+        :param out: Output buffer with the same number of elements as data, can be data itself to denormalize in place
+        :type out: Union[NoneType, ndarray]
+        :param dtype: dtype of the output if out is not provided, default to the dtype of data
+        :type dtype: Union[NoneType, numpy.dtype]
+        :param block_size: Number of elements to be processed at a time
+        :type block_size: int
+        :return: Denormalized data, 1D data will be expanded to 2D
+        :rtype: ndarray
+        """
+        self._mode_flags()
+        data_array, out = self._prepare_output(data, out, dtype)
 
-        np.place(data_array, magic_mask, MAGIC_NUMBER)
+        def _denormalize(src, dst):
+            if self._custom_denorm_func is not None:
+                dst[...] = self._custom_denorm_func(src)
+                src = dst
+            np.multiply(src, self.std_labels, out=dst, casting='unsafe')
+            np.add(dst, self.mean_labels, out=dst, casting='unsafe')
 
-        return data_array
+        return self._transform(data_array, out, _denormalize, block_size)
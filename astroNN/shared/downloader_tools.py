@@ -2,10 +2,39 @@
 #   astroNN.shared.downloader_tools: shared download tools
 # ---------------------------------------------------------#
 
+import atexit
+import base64
+import functools
 import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.util import Finalize
+from urllib.parse import urljoin, urlsplit
 
 from tqdm import tqdm
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# statuses worth retrying, others (e.g. 404) fail immediately
+_RETRY_STATUS = (408, 416, 429, 500, 502, 503, 504)
+# redirections followed as urllib.request does, up to _MAX_REDIRECTS times
+_REDIRECT_STATUS = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 10
+
+_FILEHASH_CACHE = None  # (algorithm, file) -> [size, mtime_ns, inode, checksum], loaded on first use
+_FILEHASH_CACHE_PATH = None
+_FILEHASH_CACHE_LOCK = threading.Lock()
+# new checksums are saved every _FILEHASH_CACHE_FLUSH_SIZE checksums and at exit instead of every checksum
+_FILEHASH_CACHE_PENDING = set()
+_FILEHASH_CACHE_FLUSH_SIZE = 100
+
 
 class TqdmUpTo(tqdm):
     """
@@ -55,3 +84,354 @@ def filehash(filename, block_size=65536, algorithm='sha256'):
         for block in iter(lambda: f.read(block_size), b''):
             func_algorithm.update(block)
     return func_algorithm.hexdigest()
+
+
+def _read_filehash_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _flush_filehash_cache():
+    """
+    Save new checksums of ``cached_filehash()`` to the cache file, merged with the cache file updated by other
+    processes. Called every ``_FILEHASH_CACHE_FLUSH_SIZE`` new checksums and at exit.
+    """
+    global _FILEHASH_CACHE
+    with _FILEHASH_CACHE_LOCK:
+        if not _FILEHASH_CACHE_PENDING:
+            return
+        try:
+            lock_file = open(f'{_FILEHASH_CACHE_PATH}.lock', 'w')
+        except OSError:
+            lock_file = None
+        try:
+            # other processes (e.g. workers of a pool) do not merge the cache file at the same time
+            if lock_file is not None and fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            cache = _read_filehash_cache(_FILEHASH_CACHE_PATH)
+            cache.update({key: _FILEHASH_CACHE[key] for key in _FILEHASH_CACHE_PENDING})
+            _FILEHASH_CACHE = cache
+            _FILEHASH_CACHE_PENDING.clear()
+            temp_path = f'{_FILEHASH_CACHE_PATH}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp_path, _FILEHASH_CACHE_PATH)
+        except OSError:  # cache is still used in this process if it cannot be saved
+            pass
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+
+atexit.register(_flush_filehash_cache)
+
+
+def _filehash_cache_worker_init():
+    """
+    Initializer of ``multiprocessing.Pool`` workers calling ``cached_filehash()``. Workers do not run atexit, so new
+    checksums are saved when a worker exits after ``Pool.close()`` and ``Pool.join()``
+    """
+    Finalize(None, _flush_filehash_cache, exitpriority=10)
+
+
+def cached_filehash(filename, algorithm='sha256', policy=None):
+    """
+    | Computes the hash value for a file with a persistent cache in astroNN cache folder, the cached hash value is
+    | used if size, modification time and inode of the file are unchanged. New hash values are saved to the cache
+    | file in batches and at exit.
+
+    :param filename: filename
+    :type filename: str
+    :param algorithm: hash algorithms like 'sha256' or 'md5' etc.
+    :type algorithm: str
+    :param policy: 'always' to compute every time, 'once' to compute only if the file is changed or 'never' to not
+        compute, default to ``checksumverification`` in configuration file
+    :type policy: Union[NoneType, str]
+    :return: hash value, None if policy is 'never'
+    :rtype: Union[NoneType, str]
+    """
+    from astroNN.config import astroNN_CACHE_DIR, CHECKSUM_VERIFICATION
+    global _FILEHASH_CACHE, _FILEHASH_CACHE_PATH
+
+    policy = CHECKSUM_VERIFICATION if policy is None else policy
+    if policy not in ('always', 'once', 'never'):
+        raise ValueError(f"Unknown policy -> {policy}, only 'always', 'once' and 'never' are supported")
+    if policy == 'never':
+        return None
+
+    # stat before hashing so a file modified during hashing will be hashed again next time
+    stat = os.stat(filename)
+    stamp = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    key = f'{algorithm.lower()}:{os.path.abspath(filename)}'
+
+    with _FILEHASH_CACHE_LOCK:
+        if _FILEHASH_CACHE is None:
+            _FILEHASH_CACHE_PATH = os.path.join(astroNN_CACHE_DIR, 'filehash_cache.json')
+            _FILEHASH_CACHE = _read_filehash_cache(_FILEHASH_CACHE_PATH)
+        entry = _FILEHASH_CACHE.get(key)
+    if policy == 'once' and entry is not None and entry[:3] == stamp:
+        return entry[3]
+
+    checksum = filehash(filename, algorithm=algorithm)
+
+    with _FILEHASH_CACHE_LOCK:
+        _FILEHASH_CACHE[key] = stamp + [checksum]
+        _FILEHASH_CACHE_PENDING.add(key)
+        flush = len(_FILEHASH_CACHE_PENDING) >= _FILEHASH_CACHE_FLUSH_SIZE
+    if flush:
+        _flush_filehash_cache()
+    return checksum
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_hash_manifest(filename, size, mtime_ns):
+    hashes = {}
+    with open(filename) as f:
+        for line in f:
+            item = line.split()
+            if len(item) >= 2:
+                hashes[item[1].lstrip('*')] = item[0]
+    return hashes
+
+
+def hash_manifest(filename):
+    """
+    | Read a manifest of checksum (e.g. sha1sum or md5sum file with lines of checksum and file name) to a dictionary of
+    | file name to checksum. Parsed manifests are kept in a LRU cache by file name, size and modification time so
+    | a manifest is only parsed again if it is changed. Do not modify the returned dictionary.
+
+    :param filename: file name of the manifest
+    :type filename: str
+    :return: dictionary of file name to checksum
+    :rtype: dict
+    """
+    stat = os.stat(filename)
+    return _parse_hash_manifest(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+def manifest_lookup(hashes, name):
+    """
+    Find checksum of a file in parsed manifest by its name, or the first file name containing name
+
+    :param hashes: dictionary of file name to checksum from ``hash_manifest()``
+    :type hashes: dict
+    :param name: file name
+    :type name: str
+    :return: checksum, None if not found
+    :rtype: Union[NoneType, str]
+    """
+    checksum = hashes.get(name)
+    if checksum is None:
+        checksum = next((item_hash for item, item_hash in hashes.items() if name in item), None)
+    return checksum
+
+
+class _ConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections, one per host per thread so a connection is reused for every request of a thread
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get(self, scheme, netloc):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if (scheme, netloc) not in connections:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connections[(scheme, netloc)]
+
+    def discard(self, scheme, netloc):
+        connection = getattr(self._local, 'connections', {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+
+def _read_manifest(manifest):
+    """
+    Read records of downloaded files from a JSON lines manifest, keyed by full file name
+    """
+    records = {}
+    if manifest is not None and os.path.isfile(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    records[record['file']] = record
+                except (ValueError, KeyError):  # line partially written when interrupted
+                    pass
+    return records
+
+
+def bulk_download(jobs, algorithm='sha1', max_workers=8, retries=3, backoff=1., timeout=60., manifest=None,
+                  overwrite=False, auth=None, verbose=1):
+    """
+    | Download many files concurrently by a bounded number of threads over keep-alive connections.
+    | Failed requests (connection errors, server errors or checksum mismatch) are retried with exponential backoff,
+    | partial downloads are kept as ``.part`` file and resumed with HTTP range request if the server supports it.
+    |
+    | Every verified file is recorded in manifest (JSON lines), existing files recorded with the same size and checksum
+    | are not hashed again so an interrupted bulk download can be resumed by running it again with the same manifest.
+
+    :param jobs: List of (url, full file name, checksum or None)
+    :type jobs: list
+    :param algorithm: hash algorithm of the checksum like 'sha1' or 'md5'
+    :type algorithm: str
+    :param max_workers: Maximum number of concurrent downloads
+    :type max_workers: int
+    :param retries: Maximum number of retries of a file
+    :type retries: int
+    :param backoff: Wait backoff * 2 ** (retry - 1) seconds before a retry
+    :type backoff: float
+    :param timeout: Timeout of connections in seconds
+    :type timeout: float
+    :param manifest: File name of the manifest, None to not use manifest
+    :type manifest: Union[NoneType, str]
+    :param overwrite: True to download again even if file exists
+    :type overwrite: bool
+    :param auth: (username, password) for HTTP basic authentication
+    :type auth: Union[NoneType, tuple]
+    :param verbose: verbose, set 0 to silent most logging
+    :type verbose: int
+    :return: list of full file name, False if the file failed to download
+    :rtype: list
+    """
+    records = _read_manifest(manifest)
+    manifest_lock = threading.Lock()
+    pool = _ConnectionPool(timeout)
+    headers = {}
+    if auth is not None:
+        headers['Authorization'] = 'Basic ' + base64.b64encode(f'{auth[0]}:{auth[1]}'.encode()).decode()
+
+    def _record(fullfilename, checksum):
+        record = {'file': fullfilename, 'size': os.path.getsize(fullfilename), 'hash': checksum}
+        with manifest_lock:
+            records[fullfilename] = record
+            if manifest is not None:
+                with open(manifest, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    def _fetch(url, fullfilename):
+        part_filename = fullfilename + '.part'
+        offset = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+        request_headers = dict(headers)
+        if offset > 0:
+            request_headers['Range'] = f'bytes={offset}-'
+
+        for redirect in range(_MAX_REDIRECTS + 1):
+            parsed = urlsplit(url)
+            path = parsed.path + (f'?{parsed.query}' if parsed.query else '')
+            connection = pool.get(parsed.scheme, parsed.netloc)
+            try:
+                connection.request('GET', path, headers=request_headers)
+                response = connection.getresponse()
+                location = response.getheader('Location')
+                if response.status in (200, 206):
+                    folder = os.path.dirname(fullfilename)
+                    if folder and not os.path.exists(folder):
+                        os.makedirs(folder, exist_ok=True)
+                    with open(part_filename, 'ab' if response.status == 206 else 'wb') as f:
+                        for block in iter(lambda: response.read(1048576), b''):
+                            f.write(block)
+                    os.replace(part_filename, fullfilename)
+                else:
+                    response.read()  # read the body so the connection can be reused
+                    if response.status == 416 and os.path.isfile(part_filename):
+                        os.remove(part_filename)  # partial download cannot be resumed
+                if response.will_close:
+                    pool.discard(parsed.scheme, parsed.netloc)
+            except (OSError, http.client.HTTPException):
+                pool.discard(parsed.scheme, parsed.netloc)
+                raise
+            if response.status not in _REDIRECT_STATUS or location is None or redirect == _MAX_REDIRECTS:
+                return response.status
+            url = urljoin(url, location)
+            # credentials are not sent to another host
+            if urlsplit(url).netloc != parsed.netloc:
+                request_headers.pop('Authorization', None)
+
+    def _job(job):
+        url, fullfilename, checksum = job
+        if overwrite is not True and os.path.isfile(fullfilename):
+            record = records.get(fullfilename)
+            if record is not None and record['size'] == os.path.getsize(fullfilename) and \
+                    (checksum is None or record['hash'] == checksum):
+                return fullfilename
+            file_checksum = cached_filehash(fullfilename, algorithm=algorithm)
+            if checksum is None or file_checksum is None or file_checksum == checksum:
+                _record(fullfilename, file_checksum)
+                return fullfilename
+            if verbose:
+                print(f'File corruption detected, astroNN attempting to download {fullfilename} again')
+
+        message = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                status = _fetch(url, fullfilename)
+            except (OSError, http.client.HTTPException) as e:
+                message = f'Connection error - {e}'
+                continue
+            if status in (200, 206):
+                file_checksum = cached_filehash(fullfilename, algorithm=algorithm, policy='always')
+                if checksum is None or file_checksum == checksum:
+                    _record(fullfilename, file_checksum)
+                    return fullfilename
+                message = 'File corruption detected'
+                os.remove(fullfilename)
+            elif status in _RETRY_STATUS:
+                message = f'HTTP {status}'
+            elif status == 404:
+                if verbose:
+                    print(f'{url} cannot be found on server, skipped')
+                return False
+            elif status in _REDIRECT_STATUS:
+                message = f'HTTP {status}, more than {_MAX_REDIRECTS} redirections'
+                break
+            elif status == 401:
+                message = 'HTTP 401, wrong username or password'
+                break
+            else:
+                message = f'HTTP {status}'
+                break
+
+        if verbose:
+            print(f'Failed to download {url} - {message}')
+        return False
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                tqdm(total=len(jobs), unit='file', disable=not verbose) as progress:
+            # the same file is only downloaded once even if it appears in multiple jobs
+            futures = {}
+            for job in jobs:
+                if job[1] not in futures:
+                    futures[job[1]] = executor.submit(_job, job)
+                    futures[job[1]].add_done_callback(lambda _: progress.update())
+                else:
+                    progress.update()
+            results = [futures[job[1]].result() for job in jobs]
+    finally:
+        pool.close()
+
+    return results
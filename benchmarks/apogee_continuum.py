@@ -0,0 +1,57 @@
+# ---------------------------------------------------------#
+#   Benchmark: batched apogee continuum normalization against fitting spectrum by spectrum
+# ---------------------------------------------------------#
+
+import os
+import time
+
+import numpy as np
+
+import astroNN
+from astroNN.apogee import chips_split, gap_delete
+from astroNN.apogee.chips import continuum
+
+
+def continuum_loop(spectra, spectra_err, cont_mask, deg=2):
+    """
+    Reference implementation fitting Chebyshev polynomials spectrum by spectrum
+    """
+    spectra = np.atleast_2d(np.array(spectra))
+    spectra_err = np.atleast_2d(np.array(spectra_err))
+    flux_ivars = 1 / (np.square(np.array(spectra_err)) + 1e-8)
+    pix_element = np.arange(spectra.shape[1])
+    for counter, (spectrum, spectrum_err, flux_ivar) in enumerate(zip(spectra, spectra_err, flux_ivars)):
+        fit = np.polynomial.chebyshev.Chebyshev.fit(x=pix_element[cont_mask], y=spectrum[cont_mask],
+                                                    w=flux_ivar[cont_mask], deg=deg)
+        spectra[counter] = spectrum / fit(pix_element)
+        spectra_err[counter] = spectrum_err / fit(pix_element)
+    return spectra, spectra_err
+
+
+def main(num_spectra=10000, dr=14):
+    rng = np.random.RandomState(0)
+    pix = np.linspace(0., 1., 8575)
+    spectra = (1. + 0.3 * pix - 0.2 * pix ** 2) * rng.uniform(0.5, 2., (num_spectra, 1))
+    spectra += rng.normal(0., 0.01, spectra.shape)
+    spectra_err = rng.uniform(0.005, 0.05, spectra.shape)
+    cont_mask = np.load(os.path.join(os.path.dirname(astroNN.__path__[0]), 'astroNN', 'data', f'dr{dr}_contmask.npy'))
+
+    chips = list(zip(chips_split(gap_delete(spectra, dr=dr), dr=dr),
+                     chips_split(gap_delete(spectra_err, dr=dr), dr=dr),
+                     chips_split(cont_mask, dr=dr)))
+
+    start_time = time.time()
+    batched = [continuum(chip, chip_err, cont_mask=mask[0]) for chip, chip_err, mask in chips]
+    batched_time = time.time() - start_time
+
+    start_time = time.time()
+    ref = [continuum_loop(chip, chip_err, cont_mask=mask[0]) for chip, chip_err, mask in chips]
+    loop_time = time.time() - start_time
+
+    max_diff = max(np.max(np.abs(_batched[0] - _ref[0])) for _batched, _ref in zip(batched, ref))
+    print(f'{spectra.shape[0]}x{sum(chip[0].shape[1] for chip in chips)} spectra: batched {batched_time:.{2}f}s, '
+          f'loop {loop_time:.{2}f}s, speedup {loop_time / batched_time:.{1}f}x, max abs difference {max_diff:.{2}e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# ---------------------------------------------------------#
+#   Benchmark: latency of Predictor against test() for single data requests from many threads
+# ---------------------------------------------------------#
+
+import sys
+import threading
+import time
+
+import numpy as np
+
+from astroNN.models import load_folder
+from astroNN.models.predictor import Predictor
+
+
+def latency_percentiles(latency):
+    return np.percentile(latency, 50) * 1000., np.percentile(latency, 99) * 1000.
+
+
+def run_predictor(predictor, data, num_threads):
+    latency = np.zeros(data.shape[0])
+
+    def _request(idx):
+        for i in idx:
+            start_time = time.perf_counter()
+            predictor.predict(data[i])
+            latency[i] = time.perf_counter() - start_time
+
+    threads = [threading.Thread(target=_request, args=(np.arange(i, data.shape[0], num_threads),))
+               for i in range(num_threads)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latency, time.perf_counter() - start_time
+
+
+def main(folder, num_requests=1000, num_threads=16):
+    neuralnet = load_folder(folder)
+    rng = np.random.RandomState(0)
+    input_shape = tuple(neuralnet._input_shape)
+    data_shape = input_shape[:-1] if input_shape[-1] == 1 else input_shape
+    data = neuralnet.input_mean + neuralnet.input_std * rng.normal(size=(num_requests,) + data_shape)
+    data = data.astype(np.float32)
+
+    # test() one request at a time as the reference
+    num_reference = min(num_requests, 50)
+    latency = np.zeros(num_reference)
+    for i in range(num_reference):
+        start_time = time.perf_counter()
+        neuralnet.test(data[i:i + 1])
+        latency[i] = time.perf_counter() - start_time
+    p50, p99 = latency_percentiles(latency)
+    print(f'test(): {num_reference} requests, p50 {p50:.{2}f}ms, p99 {p99:.{2}f}ms')
+
+    with Predictor(neuralnet) as predictor:
+        predictor.predict(data[0])  # warm up
+        for threads in (1, num_threads):
+            latency, total_time = run_predictor(predictor, data, threads)
+            p50, p99 = latency_percentiles(latency)
+            print(f'Predictor with {threads} threads: {num_requests} requests, p50 {p50:.{2}f}ms, p99 {p99:.{2}f}ms, '
+                  f'{num_requests / total_time:.{1}f} requests/s')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -27,6 +27,7 @@ setup(
         'pandas',
         'seaborn',
         'scikit-learn',
+        'scipy',
         'tqdm',
         'packaging'],
     extras_require={
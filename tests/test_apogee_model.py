@@ -5,6 +5,7 @@ import numpy as np
 from astroNN.models import ApogeeCNN, ApogeeBCNN, ApogeeBCNNCensored, ApogeeDR14GaiaDR2BCNN, StarNet2017, ApogeeCVAE
 from astroNN.models import load_folder
 from astroNN.nn.callbacks import ErrorOnNaN
+from astroNN.nn.utilities.inference_graph import load_inference_graph
 
 
 class ApogeeModelTestCase(unittest.TestCase):
@@ -44,8 +45,14 @@ class ApogeeModelTestCase(unittest.TestCase):
         prediction = neuralnet.test(random_xdata)
         jacobian = neuralnet.jacobian(random_xdata[:2])
         hessian = neuralnet.hessian_diag(random_xdata[:2])
-        hessian_full_approx = neuralnet.hessian(random_xdata[:2], method='approx')
-        hessian_full_exact = neuralnet.hessian(random_xdata[:2], method='exact')
+        with self.assertWarns(DeprecationWarning):  # mean hessian is still the default for 'approx' and 'exact'
+            hessian_full_approx = neuralnet.hessian(random_xdata[:2], method='approx')
+        with self.assertWarns(DeprecationWarning):
+            hessian_full_exact = neuralnet.hessian(random_xdata[:2], method='exact')
+        hessian_approx = neuralnet.hessian(random_xdata[:2], method='approx', mean_output=False)
+        hessian_approx_diag = neuralnet.hessian_approx(random_xdata[:2], diagonal=True)
+        hessian_exact = neuralnet.hessian(random_xdata[:2], method='exact', mean_output=False)
+        hessian_vector = neuralnet.hessian(random_xdata[:2], method='hvp', v=np.ones(random_xdata.shape[1]))
 
         #  make sure raised if data dimension not as expected
         self.assertRaises(ValueError, neuralnet.jacobian, np.atleast_3d(random_xdata[:3]))
@@ -63,6 +70,15 @@ class ApogeeModelTestCase(unittest.TestCase):
                                                       random_xdata.shape[1]])
         # hessian approx and exact result should have the same shape
         np.testing.assert_array_equal(hessian_full_approx.shape, hessian_full_exact.shape)
+        # approx hessian of every data is the outer product of jacobian
+        np.testing.assert_allclose(hessian_approx, np.einsum('doi,doj->doij', jacobian, jacobian), rtol=1e-3,
+                                   atol=1e-5)
+        np.testing.assert_allclose(hessian_approx_diag, np.diagonal(hessian_approx, axis1=2, axis2=3), rtol=1e-3,
+                                   atol=1e-5)
+        np.testing.assert_allclose(hessian_full_approx, np.mean(hessian_approx, axis=0), rtol=1e-3, atol=1e-5)
+        # diagonal and Hessian-vector product should agree with exact hessian
+        np.testing.assert_allclose(hessian, np.diagonal(hessian_exact, axis1=2, axis2=3), rtol=1e-3, atol=1e-5)
+        np.testing.assert_allclose(hessian_vector, np.sum(hessian_exact, axis=3), rtol=1e-3, atol=1e-5)
 
         # save weight and model again
         neuralnet.save(name='apogee_cnn')
@@ -79,6 +95,19 @@ class ApogeeModelTestCase(unittest.TestCase):
         # ApogeeCNN is deterministic check again
         np.testing.assert_array_equal(prediction, prediction_loaded)
 
+        # inference only model is cached for the unchanged folder
+        neuralnet_inference = load_folder("apogee_cnn", inference_only=True)
+        self.assertIs(neuralnet_inference, load_folder("apogee_cnn", inference_only=True))
+        np.testing.assert_array_equal(prediction, neuralnet_inference.test(random_xdata))
+
+        # exported inference graph gives the same prediction, weights in float16 are close enough
+        neuralnet.export_inference_graph('apogee_cnn.pb')
+        with load_inference_graph('apogee_cnn.pb') as graph:
+            np.testing.assert_allclose(graph.predict(random_xdata), prediction, rtol=1e-4, atol=1e-4)
+        neuralnet.export_inference_graph('apogee_cnn_float16.pb', float16=True)
+        with load_inference_graph('apogee_cnn_float16.pb') as graph:
+            np.testing.assert_allclose(graph.predict(random_xdata), prediction, rtol=1e-1, atol=1e-1)
+
         # Fine tuning test
         neuralnet_loaded.max_epochs = 5
         neuralnet_loaded.callbacks = ErrorOnNaN()
@@ -88,6 +117,11 @@ class ApogeeModelTestCase(unittest.TestCase):
         # prediction should not be equal after fine-tuning
         self.assertRaises(AssertionError, np.testing.assert_array_equal, prediction, prediction_loaded)
 
+        # gradient tensors of the old model are not kept after compiling a new one
+        self.assertGreater(len(neuralnet._jacobian_cache), 0)
+        neuralnet.compile()
+        self.assertEqual(len(neuralnet._jacobian_cache), 0)
+
     def test_apogee_bcnn(self):
         """
         Test ApogeeBCNN models
@@ -128,6 +162,17 @@ class ApogeeModelTestCase(unittest.TestCase):
         bneuralnet_loaded.mc_num = 2
         pred, pred_err = bneuralnet_loaded.test(random_xdata)
         bneuralnet_loaded.aspcap_residue_plot(pred, pred, pred_err['total'])
+
+        # exported Monte Carlo inference graph has the same outputs as test()
+        bneuralnet_loaded.export_inference_graph('apogee_bcnn.pb')
+        with load_inference_graph('apogee_bcnn.pb') as graph:
+            graph_pred = graph.predict(random_xdata)
+        np.testing.assert_array_equal(graph_pred['prediction'].shape, pred.shape)
+        for key in pred_err:
+            np.testing.assert_array_equal(graph_pred[key].shape, pred_err[key].shape)
+        bneuralnet_loaded.export_inference_graph('apogee_bcnn_pred.pb', uncertainty=False)
+        with load_inference_graph('apogee_bcnn_pred.pb') as graph:
+            np.testing.assert_array_equal(graph.predict(random_xdata).shape, pred.shape)
         bneuralnet_loaded.jacobian_aspcap(jacobian)
         bneuralnet_loaded.save()
 
@@ -137,6 +182,73 @@ class ApogeeModelTestCase(unittest.TestCase):
         bneuralnet_loaded.train(random_xdata, random_ydata)
         pred, pred_err = bneuralnet_loaded.test_old(random_xdata)
 
+    def test_apogee_bcnn_h5loader(self):
+        """
+        Test ApogeeBCNN trained from a H5Loader
+        - persisted normalization statistics, reused and computed again when the h5 file is modified
+        - inputs normalized batch by batch the same as normalizing all data
+        """
+        import os
+        from unittest import mock
+        import h5py
+        from astroNN.datasets import H5Loader
+        from astroNN.nn.utilities.normalizer import Normalizer
+
+        random_xdata = np.random.normal(1, 2, (200, 7514)).astype(np.float32)
+        random_xerr = np.random.uniform(0, 0.1, (200, 7514)).astype(np.float32)
+        random_ydata = np.random.normal(0, 1, (200, 2)).astype(np.float32)
+        with h5py.File('apogee_bcnn_h5loader.h5', 'w') as F:
+            F.create_dataset('spectra', data=random_xdata, chunks=(16, 7514))
+            F.create_dataset('spectra_err', data=random_xerr)
+            F.create_dataset('in_flag', data=np.zeros(200, dtype=np.float32))
+            F.create_dataset('teff', data=random_ydata[:, 0])
+            F.create_dataset('logg', data=random_ydata[:, 1])
+            F.create_dataset('teff_err', data=np.zeros(200, dtype=np.float32))
+            F.create_dataset('logg_err', data=np.zeros(200, dtype=np.float32))
+        loader = H5Loader('apogee_bcnn_h5loader.h5', target=['teff', 'logg'])
+        loader.load_err = True
+
+        # statistics are the same as normalizing all data in memory and are persisted
+        eager_normalizer = Normalizer(mode=1)
+        eager_data = eager_normalizer.normalize(random_xdata, dtype=np.float32)
+        mean, std = loader.load_normalization(1)
+        np.testing.assert_allclose(mean, eager_normalizer.mean_labels, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(std, eager_normalizer.std_labels, rtol=1e-4, atol=1e-5)
+        self.assertTrue(os.path.isfile('apogee_bcnn_h5loader_norm.h5'))
+        with mock.patch.object(Normalizer, 'fit', autospec=True, side_effect=Normalizer.fit) as fit:
+            np.testing.assert_array_equal(loader.load_normalization(1)[0], mean)
+            self.assertEqual(fit.call_count, 0)
+            # modified h5 file invalidates persisted statistics
+            stat = os.stat('apogee_bcnn_h5loader.h5')
+            os.utime('apogee_bcnn_h5loader.h5', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            np.testing.assert_allclose(loader.load_normalization(1)[0], mean)
+            self.assertEqual(fit.call_count, 1)
+
+        bneuralnet = ApogeeBCNN()
+        bneuralnet.max_epochs = 1
+        bneuralnet.callbacks = ErrorOnNaN()
+        bneuralnet.train(loader, None)
+        self.assertFalse(loader.lazy)  # loader of the caller is unchanged
+        self.assertEqual(list(bneuralnet.targetname), ['teff', 'logg'])
+        np.testing.assert_allclose(bneuralnet.input_mean, eager_normalizer.mean_labels, rtol=1e-4, atol=1e-5)
+
+        # batches normalized in place by the generator are the same as normalizing all data
+        generator = bneuralnet.training_generator
+        idx = np.arange(8)
+        x, y = generator._get_batch(idx)
+        rows = bneuralnet.train_idx[idx]
+        np.testing.assert_allclose(x['input'][..., 0], eager_data[rows], rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(x['input_err'][..., 0], random_xerr[rows] / std, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(y['output'], bneuralnet.labels_normalizer.normalize(random_ydata[rows],
+                                                                                           calc=False))
+
+        bneuralnet.mc_num = 2
+        prediction, prediction_err = bneuralnet.test(random_xdata[:10])
+        np.testing.assert_array_equal(prediction.shape, (10, 2))
+        self.assertTrue(np.all(np.isfinite(prediction)))
+        os.remove('apogee_bcnn_h5loader.h5')
+        os.remove('apogee_bcnn_h5loader_norm.h5')
+
     def test_apogee_bcnnconsered(self):
         """
         Test ApogeeBCNNCensored models
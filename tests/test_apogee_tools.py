@@ -5,6 +5,7 @@ import numpy.testing as npt
 from astroNN.apogee import gap_delete, apogee_default_dr, bitmask_decompositor, chips_split, bitmask_boolean, \
     apogee_continuum, aspcap_mask, combined_spectra, visit_spectra
 from astroNN.apogee.apogee_shared import apogeeid_digit
+from astroNN.apogee.chips import continuum
 
 
 class ApogeeToolsCase(unittest.TestCase):
@@ -51,6 +52,22 @@ class ApogeeToolsCase(unittest.TestCase):
         cont_spectra, cont_spectra_arr = apogee_continuum(raw_spectra, raw_spectra_err)
         self.assertAlmostEqual(float(np.mean(cont_spectra)), 1.)
 
+    def test_continuum(self):
+        # batched continuum should agree with fitting Chebyshev polynomials spectrum by spectrum
+        rng = np.random.RandomState(0)
+        pix = np.linspace(0., 1., 500)
+        spectra = (1. + 0.3 * pix - 0.2 * pix ** 2) * rng.uniform(0.5, 2., (20, 1)) + rng.normal(0., 0.01, (20, 500))
+        spectra_err = rng.uniform(0.005, 0.05, (20, 500))
+        cont_mask = rng.uniform(size=500) < 0.2
+
+        norm_spectra, norm_spectra_err = continuum(spectra, spectra_err, cont_mask=cont_mask, deg=2)
+        for spectrum, spectrum_err, norm_spectrum, norm_spectrum_err in zip(spectra, spectra_err, norm_spectra,
+                                                                            norm_spectra_err):
+            fit = np.polynomial.chebyshev.Chebyshev.fit(x=np.arange(500)[cont_mask], y=spectrum[cont_mask],
+                                                        w=1 / (spectrum_err[cont_mask] ** 2 + 1e-8), deg=2)
+            npt.assert_array_almost_equal(norm_spectrum, spectrum / fit(np.arange(500)))
+            npt.assert_array_almost_equal(norm_spectrum_err, spectrum_err / fit(np.arange(500)))
+
     def test_apogee_digit_extractor(self):
         # Test apogeeid digit extractor
         # just to make no error
@@ -72,6 +89,33 @@ class ApogeeToolsCase(unittest.TestCase):
 
 
 class ApogeeDownloaderCase(unittest.TestCase):
+    def test_allstar_index(self):
+        """
+        Test the persisted index of allStar used to look up location, field and telescope of stars
+        """
+        import os
+        import tempfile
+        from astropy.io import fits
+        from astroNN.apogee.downloader import _load_allstar_index
+
+        allstar_path = os.path.join(tempfile.mkdtemp(), 'allStar-test.fits')
+        fits.BinTableHDU.from_columns([
+            fits.Column('APOGEE_ID', '18A', array=['2M00000001', '2M00000002', '2M00000001']),
+            fits.Column('TELESCOPE', '8A', array=['apo25m', 'apo25m', 'lco25m']),
+            fits.Column('LOCATION_ID', 'J', array=[4405, 4406, 4407]),
+            fits.Column('FIELD', '16A', array=['field1', 'field2', 'field3'])]).writeto(allstar_path)
+
+        index = _load_allstar_index(allstar_path)
+        self.assertTrue(os.path.isfile(os.path.join(os.path.dirname(allstar_path), 'allStar-test_index.npz')))
+        # first entry is found without telescope
+        row = index['rows']['2M00000001']
+        self.assertEqual((index['LOCATION_ID'][row], index['FIELD'][row], index['TELESCOPE'][row]),
+                         (4405, 'field1', 'apo25m'))
+        row = index['rows'][('2M00000001', 'lco25m')]
+        self.assertEqual((index['LOCATION_ID'][row], index['FIELD'][row]), (4407, 'field3'))
+        # persisted index is loaded again
+        self.assertEqual(_load_allstar_index(allstar_path)['rows'], index['rows'])
+
     def test_apogee_combined_download(self):
         """
         Test APOGEE combined spectra downloading function, assert functions can deal with missing files
@@ -98,6 +142,68 @@ class ApogeeDownloaderCase(unittest.TestCase):
         # assert error if DR not supported
         self.assertRaises(ValueError, visit_spectra, dr=1, location=4406, apogee='2M19060637+4717296')
 
+    def test_apogee_bulk_spectra_auth(self):
+        """
+        Test DR16 bulk spectra downloading with APOGEE credentials, from argument or prompted for
+        """
+        import base64
+        import functools
+        import os
+        import tempfile
+        import threading
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+        from unittest import mock
+        from astroNN.apogee import bulk_spectra
+        from astroNN.apogee import downloader
+
+        server_dir, local_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        folder = os.path.join(server_dir, 'apogeework/apogee/spectro/aspcap/r10/l31c/apo25m/K06_078+16')
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'aspcapStar-r10-2M19060637+4717296.fits'), 'wb') as f:
+            f.write(os.urandom(1000))
+        expected_auth = 'Basic ' + base64.b64encode(b'sdss:secret').decode()
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def do_GET(self):
+                if self.headers.get('Authorization') != expected_auth:
+                    self.send_response(401)
+                    self.send_header('WWW-Authenticate', 'Basic realm="SDSS"')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                super().do_GET()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=server_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        targets = [('2M19060637+4717296', 'K06_078+16', 'apo25m')]
+        fullfilename = os.path.join(local_dir, 'apogeework/apogee/spectro/aspcap/r10/l31c/apo25m/K06_078+16',
+                                    'aspcapStar-r10-2M19060637+4717296.fits')
+
+        with mock.patch.dict(os.environ, {'SDSS_LOCAL_SAS_MIRROR': local_dir}):
+            # wrong username or password is not retried and returns False
+            self.assertEqual(bulk_spectra(targets, dr=16, base_url=url, auth=('sdss', 'wrong'), retries=3,
+                                          backoff=0., verbose=0), [False])
+            self.assertEqual(bulk_spectra(targets, dr=16, base_url=url, auth=('sdss', 'secret'), verbose=0),
+                             [fullfilename])
+            os.remove(fullfilename)
+            # username and password are prompted for if not provided
+            setattr(downloader, '__apogee_credentials_username', None)
+            with mock.patch('builtins.input', return_value='sdss'), \
+                    mock.patch('getpass.getpass', return_value='secret') as prompt:
+                self.assertEqual(bulk_spectra(targets, dr=16, base_url=url, verbose=0), [fullfilename])
+                self.assertEqual(bulk_spectra(targets, dr=16, base_url=url, flag=1, verbose=0), [fullfilename])
+                self.assertEqual(prompt.call_count, 1)
+            setattr(downloader, '__apogee_credentials_username', None)
+            setattr(downloader, '__apogee_credentials_pw', None)
+        server.shutdown()
+        server.server_close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,53 @@ import unittest
 
 import requests
 import numpy as np
+import numpy.testing as npt
 from astroNN.data import datapath, data_description
 from astroNN.datasets.galaxy10 import _G10_ORIGIN
 from astroNN.datasets.galaxy10 import galaxy10cls_lookup, galaxy10_confusion
+from astroNN.datasets.h5 import H5Compiler
+
+
+class SyntheticH5Compiler(H5Compiler):
+    """
+    H5Compiler reading synthetic spectra instead of APOGEE files, fails at star fail_at to simulate an interruption
+    """
+
+    def __init__(self, num_star, fail_at=None):
+        super().__init__()
+        self.apogee_dr = 14
+        self.spectra_only = True
+        self.cont_mask = np.ones(7514, dtype=bool)
+        self.buffer_size = 5
+        self.num_star = num_star
+        self.fail_at = fail_at
+        self.stars_read = []
+
+    def load_allstar(self):
+        data = {'APOGEE_ID': np.array([f'2M{i:08d}' for i in range(self.num_star)]),
+                'LOCATION_ID': np.arange(self.num_star) + 4000}
+
+        class _HDU(object):
+            pass
+
+        hdu = _HDU()
+        hdu.data = data
+        return [None, hdu]
+
+    def filter_apogeeid_list(self, hdulist):
+        return np.arange(0, self.num_star, 2)
+
+    def _read_star(self, star):
+        apogee_id, location_id = star
+        self.stars_read.append(apogee_id)
+        if location_id == self.fail_at:
+            raise RuntimeError('Interrupted')
+        if location_id % 7 == 0:  # star not found
+            return None
+        rng = np.random.RandomState(location_id)
+        nvisits = location_id % 3 + 1
+        return rng.normal(size=(nvisits, 7514)).astype(np.float32), \
+            rng.uniform(size=(nvisits, 7514)).astype(np.float32), rng.uniform(size=nvisits).astype(np.float32)
 
 
 class DatasetTestCase(unittest.TestCase):
@@ -27,6 +71,145 @@ class DatasetTestCase(unittest.TestCase):
                                    swap=False)
         self.assertEqual(len(idx_1), len(idx_2))
 
+    def test_xmatch_index(self):
+        import os
+        import tempfile
+        from astroNN.datasets import xmatch, XMatchIndex
+        from astroNN.datasets.xmatch import xmatch_index
+
+        rng = np.random.RandomState(0)
+        cat2_ra = rng.uniform(0., 360., 5000)
+        cat2_dec = np.degrees(np.arcsin(rng.uniform(-1., 1., 5000)))
+        pmra, pmdec = rng.normal(0., 50., 5000), rng.normal(0., 50., 5000)
+        # cat1 are perturbed cat2 sources with some duplicates and some random sources
+        cat1_ra = np.concatenate([cat2_ra[:3000] + rng.normal(0., 3e-4, 3000), cat2_ra[:100],
+                                  rng.uniform(0., 360., 500)])
+        cat1_dec = np.concatenate([cat2_dec[:3000] + rng.normal(0., 3e-4, 3000), cat2_dec[:100],
+                                   rng.uniform(-90., 90., 500)])
+
+        index = XMatchIndex(cat2_ra, cat2_dec)
+        n1, n2, sep = index.query(cat1_ra, cat1_dec, maxdist=2, chunk_size=1000)
+        x1, x2, xsep = xmatch(cat1_ra, cat2_ra, colRA1=cat1_ra, colDec1=cat1_dec, colRA2=cat2_ra, colDec2=cat2_dec)
+        npt.assert_array_equal(n1, x1)
+        npt.assert_array_equal(n2, x2)
+        npt.assert_array_almost_equal(sep.arcsec, xsep.arcsec, decimal=6)
+
+        # proper motion epoch propagation
+        m1, m2, sep = XMatchIndex(cat2_ra, cat2_dec, epoch=2015.5, pmra=pmra, pmdec=pmdec).query(cat1_ra, cat1_dec)
+        x1, x2, xsep = xmatch(cat1_ra, cat2_ra, colRA1=cat1_ra, colDec1=cat1_dec, epoch1=2000., colRA2=cat2_ra,
+                              colDec2=cat2_dec, epoch2=2015.5, colpmRA2=pmra, colpmDec2=pmdec)
+        npt.assert_array_equal(m1, x1)
+        npt.assert_array_equal(m2, x2)
+
+        # every match within radius includes the closest match
+        r1, r2, rsep = index.query_radius(cat1_ra, cat1_dec, radius=2, chunk_size=1000)
+        self.assertTrue(np.all(rsep.arcsec < 2))
+        pairs = set(zip(r1.tolist(), r2.tolist()))
+        self.assertTrue(all(pair in pairs for pair in zip(n1.tolist(), n2.tolist())))
+
+        # number of processes is n_jobs before scipy 1.6
+        import scipy
+        from astroNN.datasets.xmatch import _workers_kwargs
+        scipy_version = scipy.__version__
+        try:
+            scipy.__version__ = '1.5.4'
+            self.assertEqual(_workers_kwargs(2), {'n_jobs': 2})
+            scipy.__version__ = '1.6.0'
+            self.assertEqual(_workers_kwargs(2), {'workers': 2})
+        finally:
+            scipy.__version__ = scipy_version
+
+        # saved index is loaded if built from the same catalog
+        filename = os.path.join(tempfile.mkdtemp(), 'index.pkl')
+        index = xmatch_index(cat2_ra, cat2_dec, filename)
+        self.assertTrue(os.path.isfile(filename))
+        loaded_index = xmatch_index(cat2_ra, cat2_dec, filename)
+        self.assertEqual(loaded_index.checksum(), index.checksum())
+        npt.assert_array_equal(loaded_index.query(cat1_ra, cat1_dec)[1], index.query(cat1_ra, cat1_dec)[1])
+        self.assertNotEqual(xmatch_index(cat2_ra[:10], cat2_dec[:10], filename).checksum(), index.checksum())
+
+    def test_h5loader(self):
+        import os
+        import h5py
+        from astroNN.datasets import H5Loader
+
+        spectra = np.random.normal(size=(100, 20)).astype(np.float32)
+        teff = np.random.normal(size=100).astype(np.float32)
+        teff[::10] = -9999.
+        in_flag = np.zeros(100, dtype=np.float32)
+        in_flag[1::3] = 1.
+        with h5py.File('h5loader_test.h5', 'w') as F:
+            # chunked spectra as compiled by H5Compiler and contiguous spectra_err
+            F.create_dataset('spectra', data=spectra, chunks=(8, 20))
+            F.create_dataset('spectra_err', data=spectra * 2)
+            F.create_dataset('in_flag', data=in_flag)
+            F.create_dataset('teff', data=teff)
+
+        loader = H5Loader('h5loader_test.h5', target=['teff'])
+        loader.exclude9999 = True
+        allowed_index = np.where((in_flag == 0) & (teff != -9999.))[0]
+        x, y = loader.load()
+        npt.assert_array_equal(x, spectra[allowed_index])
+        npt.assert_array_equal(y, teff[allowed_index])
+
+        # lazy loading should give the same data
+        loader.lazy = True
+        x, y = loader.load()
+        x_err = loader.load_entry('spectra_err')
+        self.assertEqual(x.shape, (allowed_index.shape[0], 20))
+        npt.assert_array_equal(x[[5, 1, 1, 30]], spectra[allowed_index][[5, 1, 1, 30]])
+        npt.assert_array_equal(x[3:40:4, 2], spectra[allowed_index][3:40:4, 2])
+        npt.assert_array_equal(np.asarray(x_err), spectra[allowed_index] * 2)
+        x.close()
+        x_err.close()
+        os.remove('h5loader_test.h5')
+
+    def test_h5compiler_resume(self):
+        import os
+        import tempfile
+        import h5py
+
+        folder = tempfile.mkdtemp()
+        # one-shot compilation with a pool of workers
+        compiler = SyntheticH5Compiler(40)
+        compiler.filename = os.path.join(folder, 'oneshot')
+        compiler.n_workers = 2
+        compiler.compile()
+
+        # interrupted compilation
+        compiler = SyntheticH5Compiler(40, fail_at=4000 + 26)
+        compiler.filename = os.path.join(folder, 'resumed')
+        self.assertRaises(RuntimeError, compiler.compile)
+        with h5py.File(f'{compiler.filename}.h5', 'r') as F:
+            self.assertTrue(F.attrs['compiling'])
+            stars_done = int(F.attrs['stars_done'])
+        self.assertGreater(stars_done, 0)
+        self.assertLessEqual(stars_done, 13)
+
+        # unfinished file with another continuum mask is not resumed
+        compiler = SyntheticH5Compiler(40, fail_at=4000 + 26)
+        compiler.filename = os.path.join(folder, 'other_mask')
+        self.assertRaises(RuntimeError, compiler.compile)
+        compiler = SyntheticH5Compiler(40)
+        compiler.filename = os.path.join(folder, 'other_mask')
+        compiler.cont_mask[:10] = False
+        compiler.compile()
+        self.assertEqual(len(compiler.stars_read), 20)
+
+        # resumed compilation only reads stars not compiled yet
+        compiler = SyntheticH5Compiler(40)
+        compiler.filename = os.path.join(folder, 'resumed')
+        compiler.compile()
+        self.assertEqual(len(compiler.stars_read), 20 - stars_done)
+
+        with h5py.File(os.path.join(folder, 'oneshot.h5'), 'r') as F1, \
+                h5py.File(os.path.join(folder, 'resumed.h5'), 'r') as F2:
+            self.assertEqual(sorted(F1.keys()), sorted(F2.keys()))
+            self.assertEqual(len(F2.attrs), 0)  # compilation attributes are removed when finished
+            for name in F1.keys():
+                npt.assert_array_equal(F1[name][()], F2[name][()])
+            self.assertEqual(F1['spectra'].shape[0], F1['in_flag'].shape[0])
+
     def test_apokasc(self):
         from astroNN.datasets.apokasc import apokasc_load
 
@@ -1,7 +1,9 @@
 import unittest
 
 import numpy as np
+import numpy.testing as npt
 from astroNN.lamost import wavelength_solution, pseudo_continuum
+from astroNN.lamost.chips import smooth_spec
 
 
 class LamostToolsTestCase(unittest.TestCase):
@@ -13,6 +15,24 @@ class LamostToolsTestCase(unittest.TestCase):
     def test_norm(self):
         pseudo_continuum(np.ones(3909), np.ones(3909))
 
+        # batch of spectra should be the same as normalizing them one by one
+        flux = np.random.uniform(0.5, 1.5, (5, 3909))
+        ivar = np.random.uniform(0., 10., (5, 3909))
+        norm_flux, norm_ivar = pseudo_continuum(flux, ivar)
+        self.assertEqual(norm_flux.shape, (5, 3909))
+        npt.assert_array_almost_equal(norm_flux[2], pseudo_continuum(flux[2], ivar[2])[0])
+
+    def test_smooth_spec(self):
+        wavelength = wavelength_solution()
+        flux = np.random.uniform(0.5, 1.5, (5, 3909))
+        ivar = np.random.uniform(0., 10., (5, 3909))
+        w = np.exp(-0.5 * (wavelength[:, None] - wavelength[None, :]) ** 2 / 50 ** 2)
+        dense_smoothed = np.dot(flux * ivar, w.T) / np.dot(ivar, w.T)
+
+        # without truncation it is the same as dense Gaussian weights, truncated at 4L it is very close
+        npt.assert_array_almost_equal(smooth_spec(flux, ivar, wavelength, L=50, truncate=None), dense_smoothed)
+        npt.assert_array_almost_equal(smooth_spec(flux, ivar, wavelength, L=50), dense_smoothed, decimal=3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,9 @@ import sys
 import unittest
 from importlib import import_module
 
+import h5py
 import numpy as np
+import numpy.testing as npt
 import tensorflow.keras as tfk
 
 import astroNN
@@ -35,7 +37,17 @@ class Models_TestCase(unittest.TestCase):
         mnist_test.train(x_train[:200], y_train[:200])
         output_shape = mnist_test.output_shape
         mnist_test.test(x_test[:200])
-        mnist_test.evaluate(x_train[:100], y_train[:100])
+        scores = mnist_test.evaluate(x_train[:100], y_train[:100])
+        # the last batch is not a full batch, scores should be the same as evaluating all data with keras
+        norm_x = mnist_test.input_normalizer.normalize(x_train[:100], calc=False)
+        norm_y = mnist_test.labels_normalizer.normalize(y_train[:100], calc=False)
+        keras_scores = mnist_test.keras_model.evaluate(norm_x, norm_y, batch_size=mnist_test.batch_size, verbose=0)
+        self.assertTrue(np.all(np.isfinite(list(scores.values()))))
+        npt.assert_array_almost_equal(list(scores.values()), keras_scores, decimal=4)
+        # fewer data than batch size are padded without changing the model
+        batch_size = mnist_test.batch_size
+        self.assertEqual(mnist_test.test(x_test[:3]).shape[0], 3)
+        self.assertEqual(mnist_test.batch_size, batch_size)
 
         # create model instance for binary classification
         mnist_test = Cifar10CNN()
@@ -53,6 +65,15 @@ class Models_TestCase(unittest.TestCase):
         # Cifar10_CNN is deterministic
         np.testing.assert_array_equal(prediction, prediction_loaded)
 
+        # low latency predictor should give the same result as test(), also without normalizers
+        from astroNN.models.predictor import Predictor
+        with Predictor(mnist_reloaded, batch_size=8) as predictor:
+            np.testing.assert_allclose(predictor.predict(x_test[:20]), prediction_loaded[:20], rtol=1e-5, atol=1e-6)
+        mnist_reloaded.input_normalizer, mnist_reloaded.labels_normalizer = None, None
+        with Predictor(mnist_reloaded, batch_size=8) as predictor:
+            np.testing.assert_allclose(predictor.predict(x_test[:20]), mnist_reloaded.test(x_test[:20]),
+                                       rtol=1e-5, atol=1e-6)
+
     def test_color_images(self):
         # test colored 8bit images
         (x_train, y_train), (x_test, y_test) = mnist.load_data()
@@ -84,7 +105,11 @@ class Models_TestCase(unittest.TestCase):
         mnist_test.save('cifar10_test')
         mnist_reloaded = load_folder("cifar10_test")
         prediction_loaded = mnist_reloaded.test(x_test[:200])
-        mnist_reloaded.jacobian(x_test[:2], mean_output=True, mc_num=2)
+        jacobian_mean = mnist_reloaded.jacobian(x_test[:3], mean_output=True, mc_num=2)
+        # batches of different sizes should give the same Jacobian of every data
+        jacobian = mnist_reloaded.jacobian(x_test[:3], batch_size=2)
+        np.testing.assert_allclose(jacobian, mnist_reloaded.jacobian(x_test[:3], batch_size=1), rtol=1e-4, atol=1e-6)
+        self.assertEqual(jacobian.shape[1:], jacobian_mean.shape)
         # mnist_reloaded.hessian_diag(x_test[:10], mean_output=True, mc_num=2)
 
         # Cifar10_CNN is deterministic
@@ -117,6 +142,54 @@ class Models_TestCase(unittest.TestCase):
         net_reloaded = load_folder("mnist_bcnn_test")
         net_reloaded.mc_num = 3  # prevent memory issue on Tavis CI
         prediction_loaded = net_reloaded.test(x_test[:200])
+        # Monte Carlo model is reused by later calls
+        num_cached = len(net_reloaded._mc_model_cache)
+        net_reloaded.test(x_test[:10])
+        self.assertEqual(len(net_reloaded._mc_model_cache), num_cached)
+
+        # tiny memory budget to do forward passes one by one
+        net_reloaded.mc_memory_budget = 1
+        prediction_chunked = net_reloaded.test(x_test[:201])
+        self.assertEqual(prediction_chunked[0].shape[0], 201)
+
+        # mean and variance of forward passes one by one are statistically consistent with those all at once
+        net_reloaded.mc_num = 20
+        input_array, inputs_err = net_reloaded._test_normalize(x_test[:100], None)
+        result_chunked = net_reloaded._mc_inference(input_array, inputs_err)
+        net_reloaded.mc_memory_budget = 2 ** 30
+        result_full = net_reloaded._mc_inference(input_array, inputs_err)
+        self.assertTrue(np.all(np.isfinite(result_chunked)))
+        npt.assert_allclose(np.mean(result_chunked[:, :, 0], axis=0), np.mean(result_full[:, :, 0], axis=0),
+                            rtol=0.1, atol=0.05)
+        npt.assert_allclose(np.mean(result_chunked[:, :, 1], axis=0), np.mean(result_full[:, :, 1], axis=0),
+                            rtol=0.25, atol=1e-3)
+
+        # forward passes are chunked in at most two sizes (7 and the remainder 6) so the cache stays bounded
+        net_reloaded.mc_memory_budget = net_reloaded._mc_pass_nbytes() * net_reloaded.batch_size * 7
+        for _ in range(3):
+            net_reloaded.test(x_test[:10])
+        self.assertEqual(sorted(key[0] for key in net_reloaded._mc_model_cache), [1, 3, 6, 7, 20])
+        net_reloaded.mc_num = 3
+        net_reloaded.mc_memory_budget = 1
+
+        # streaming inference written to HDF5 chunk by chunk
+        num_written = net_reloaded.test_stream(x_test[:201], chunk_size=64, sink='mnist_bcnn_stream.h5')
+        self.assertEqual(num_written, 201)
+        with h5py.File('mnist_bcnn_stream.h5', 'r') as F:
+            self.assertEqual(F['prediction'].shape[0], 201)
+            self.assertEqual(F['total'].shape[0], 201)
+        os.remove('mnist_bcnn_stream.h5')
+
+        # low latency predictor with concurrent requests
+        from concurrent.futures import ThreadPoolExecutor
+        from astroNN.models.predictor import Predictor
+        with Predictor(net_reloaded, batch_size=8) as predictor:
+            pred, pred_std = predictor.predict(x_test[0])
+            self.assertEqual(pred.shape[0], 1)
+            with ThreadPoolExecutor(4) as executor:
+                results = list(executor.map(predictor.predict, x_test[:20]))
+            self.assertEqual(len(results), 20)
+            self.assertEqual(results[0][1]['total'].shape[0], 1)
 
         net_reloaded.folder_name = None  # set to None so it can be saved
         net_reloaded.save()
@@ -145,6 +218,31 @@ class Models_TestCase(unittest.TestCase):
         net_reloaded.mc_num = 3  # prevent memory issue on Tavis CI
         prediction_loaded = net_reloaded.test(x_test[:200])
 
+    def test_tf_data_pipeline(self):
+        (x_train, y_train), (x_test, y_test) = mnist.load_data()
+
+        y_train = utils.to_categorical(y_train, 10).astype(np.float32)
+        x_train = x_train.astype(np.float32)
+        x_test = x_test.astype(np.float32)
+
+        # train with tf.data pipeline instead of keras generator
+        net = Cifar10CNN()
+        net.max_epochs = 1
+        net.callbacks = ErrorOnNaN()
+        net.data_pipeline = 'tf.data'
+        net.data_pipeline_deterministic = True
+        net.train(x_train[:200], y_train[:200])
+        self.assertEqual(net.test(x_test[:10]).shape, (10, 10))
+
+        # Bayesian neural network with dictionary of inputs and outputs
+        net = MNIST_BCNN()
+        net.max_epochs = 1
+        net.callbacks = ErrorOnNaN()
+        net.data_pipeline = 'tf.data'
+        net.train(x_train[:200], y_train[:200])
+        net.mc_num = 2
+        self.assertEqual(net.test(x_test[:10])[0].shape, (10, 10))
+
     def test_load_flawed_fodler(self):
         from astroNN.config import astroNN_CACHE_DIR
         self.assertRaises(FileNotFoundError, load_folder, astroNN_CACHE_DIR)
@@ -203,5 +301,35 @@ class Models_TestCase(unittest.TestCase):
         self.assertRaises(AttributeError, nomodel.test, np.zeros(100))
 
 
+    def test_predictor_server_error(self):
+        import io
+        import json
+        import threading
+        import urllib.error
+        import urllib.request
+        from astroNN.models.predictor import serve_http, serve_stdin
+
+        class FailingPredictor(object):
+            def predict(self, input_data):
+                if input_data.ndim == 0:
+                    raise ValueError('bad input')
+                raise RuntimeError('inference failed')
+
+        server = serve_http(FailingPredictor(), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        for data, status in (([1., 2.], 500), (1., 400)):
+            request = urllib.request.Request(url, data=json.dumps({'input': data}).encode('utf-8'))
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(request, timeout=10)
+            self.assertEqual(context.exception.code, status)
+            self.assertIn('error', json.loads(context.exception.read().decode('utf-8')))
+        server.shutdown()
+        server.server_close()
+
+        stdout = io.StringIO()
+        serve_stdin(FailingPredictor(), stdin=io.StringIO('{"input": [1.0]}\n'), stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue()), {'error': 'RuntimeError: inference failed'})
+
 if __name__ == '__main__':
     unittest.main()
@@ -20,6 +20,205 @@ class UtilitiesTestCase(unittest.TestCase):
         self.assertEqual(sha256_pred, '36C265C907F440114D747DA21D2A014D32B5E442D541F183C0EE862F5865FD26'.lower())
         self.assertRaises(ValueError, filehash, anderson2017_path, algorithm='sha123')
 
+    def test_cached_checksum(self):
+        import tempfile
+        from astroNN.shared.downloader_tools import cached_filehash, filehash
+
+        filename = os.path.join(tempfile.mkdtemp(), 'data.bin')
+        with open(filename, 'wb') as f:
+            f.write(b'astroNN')
+        checksum = cached_filehash(filename, algorithm='sha1', policy='always')
+        self.assertEqual(checksum, filehash(filename, algorithm='sha1'))
+        self.assertEqual(cached_filehash(filename, algorithm='sha1', policy='once'), checksum)
+        self.assertEqual(cached_filehash(filename, algorithm='sha1', policy='never'), None)
+
+        # modified file is hashed again
+        with open(filename, 'ab') as f:
+            f.write(b'astroNN')
+        os.utime(filename, ns=(0, 0))
+        self.assertEqual(cached_filehash(filename, algorithm='sha1', policy='once'),
+                         filehash(filename, algorithm='sha1'))
+        self.assertRaises(ValueError, cached_filehash, filename, policy='sometimes')
+
+    def test_cached_checksum_policy(self):
+        import json
+        import tempfile
+        from unittest import mock
+        from astroNN.shared import downloader_tools
+        from astroNN.shared.downloader_tools import cached_filehash, filehash
+
+        filename = os.path.join(tempfile.mkdtemp(), 'data.bin')
+        with open(filename, 'wb') as f:
+            f.write(b'astroNN')
+        with mock.patch.object(downloader_tools, 'filehash', wraps=filehash) as hashing:
+            checksum = cached_filehash(filename, algorithm='md5', policy='once')
+            self.assertEqual(hashing.call_count, 1)
+            # reading the file does not change its modification time, so it is not hashed again
+            with open(filename, 'rb') as f:
+                f.read()
+            self.assertEqual(cached_filehash(filename, algorithm='md5', policy='once'), checksum)
+            self.assertEqual(hashing.call_count, 1)
+            # always policy hashes every time
+            cached_filehash(filename, algorithm='md5', policy='always')
+            self.assertEqual(hashing.call_count, 2)
+            # touched file is hashed again
+            stat = os.stat(filename)
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(cached_filehash(filename, algorithm='md5', policy='once'), checksum)
+            self.assertEqual(hashing.call_count, 3)
+
+        # new checksums are saved to the cache file when flushed
+        downloader_tools._flush_filehash_cache()
+        with open(downloader_tools._FILEHASH_CACHE_PATH) as f:
+            self.assertEqual(json.load(f)[f'md5:{os.path.abspath(filename)}'][3], checksum)
+
+        # checksums computed by workers of a pool are saved when the workers exit
+        import functools
+        from multiprocessing import Pool
+        filenames = []
+        for i in range(6):
+            filenames.append(os.path.join(os.path.dirname(filename), f'data{i}.bin'))
+            with open(filenames[-1], 'wb') as f:
+                f.write(os.urandom(100))
+        pool = Pool(2, initializer=downloader_tools._filehash_cache_worker_init)
+        checksums = pool.map(functools.partial(cached_filehash, algorithm='sha1', policy='always'), filenames,
+                             chunksize=1)
+        pool.close()
+        pool.join()
+        with open(downloader_tools._FILEHASH_CACHE_PATH) as f:
+            cache = json.load(f)
+        for name, checksum in zip(filenames, checksums):
+            self.assertEqual(cache[f'sha1:{os.path.abspath(name)}'][3], checksum)
+            self.assertEqual(checksum, filehash(name, algorithm='sha1'))
+
+    def test_hash_manifest(self):
+        import tempfile
+        from astroNN.shared.downloader_tools import hash_manifest, manifest_lookup
+
+        filename = os.path.join(tempfile.mkdtemp(), 'stars.sha1sum')
+        with open(filename, 'w') as f:
+            f.write('aaa  apStar-r8-2M0001.fits\nbbb *apStar-r8-2M0002.fits\n\n')
+        hashes = hash_manifest(filename)
+        self.assertEqual(hashes, {'apStar-r8-2M0001.fits': 'aaa', 'apStar-r8-2M0002.fits': 'bbb'})
+        # parsed manifest is cached
+        self.assertIs(hash_manifest(filename), hashes)
+        self.assertEqual(manifest_lookup(hashes, 'apStar-r8-2M0002.fits'), 'bbb')
+        self.assertEqual(manifest_lookup(hashes, 'apStar-r8-2M0001'), 'aaa')
+        self.assertEqual(manifest_lookup(hashes, 'apStar-r8-2M0003'), None)
+
+        # modified manifest is parsed again
+        with open(filename, 'a') as f:
+            f.write('ccc  apStar-r8-2M0003.fits\n')
+        os.utime(filename, ns=(0, 0))
+        self.assertEqual(manifest_lookup(hash_manifest(filename), 'apStar-r8-2M0003.fits'), 'ccc')
+
+    def test_bulk_download(self):
+        import functools
+        import hashlib
+        import tempfile
+        import threading
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+        from astroNN.shared.downloader_tools import bulk_download, filehash
+
+        server_dir, local_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        checksums = []
+        for i in range(10):
+            data = os.urandom(1000 + i)
+            with open(os.path.join(server_dir, f'file{i}.fits'), 'wb') as f:
+                f.write(data)
+            checksums.append(hashlib.sha1(data).hexdigest())
+
+        requests_count = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def do_GET(self):
+                requests_count.append(self.path)
+                if self.path.startswith('/redirect/'):
+                    # relative redirection to the file, or to itself forever
+                    self.send_response(302)
+                    self.send_header('Location', self.path if self.path.endswith('loop') else f'../{self.path[10:]}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                super().do_GET()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=server_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        manifest = os.path.join(local_dir, 'manifest.jsonl')
+
+        jobs = [(f'{url}/file{i}.fits', os.path.join(local_dir, f'file{i}.fits'), checksums[i]) for i in range(10)]
+        # missing file on server and checksum mismatch
+        jobs.append((f'{url}/missing.fits', os.path.join(local_dir, 'missing.fits'), None))
+        jobs.append((f'{url}/file0.fits', os.path.join(local_dir, 'corrupted.fits'), '0' * 40))
+        results = bulk_download(jobs, max_workers=1, retries=2, backoff=0., manifest=manifest, verbose=0)
+        self.assertEqual(results[:10], [job[1] for job in jobs[:10]])
+        self.assertEqual(results[10:], [False, False])
+        self.assertEqual(len(requests_count), 10 + 1 + 3)
+
+        # resume from manifest without requests, corrupted file is downloaded again
+        with open(jobs[3][1], 'wb') as f:
+            f.write(b'corrupted')
+        results = bulk_download(jobs[:10], max_workers=4, manifest=manifest, verbose=0)
+        self.assertEqual(results, [job[1] for job in jobs[:10]])
+        self.assertEqual(len(requests_count), 10 + 1 + 3 + 1)
+        self.assertEqual(filehash(jobs[3][1], algorithm='sha1'), checksums[3])
+
+        # redirections are followed with a limit
+        redirect_jobs = [(f'{url}/redirect/file5.fits', os.path.join(local_dir, 'redirected.fits'), checksums[5]),
+                         (f'{url}/redirect/loop', os.path.join(local_dir, 'loop.fits'), None)]
+        results = bulk_download(redirect_jobs, max_workers=1, verbose=0)
+        self.assertEqual(results, [os.path.join(local_dir, 'redirected.fits'), False])
+        self.assertEqual(filehash(results[0], algorithm='sha1'), checksums[5])
+        server.shutdown()
+        server.server_close()
+
+    def test_generator_ring_buffer(self):
+        import numpy as np
+        from astroNN.models.base_cnn import CNNDataGenerator
+
+        x = np.arange(100 * 4, dtype=np.float32).reshape(100, 4)
+        y = np.arange(100, dtype=np.float32).reshape(100, 1)
+        generator = CNNDataGenerator(batch_size=8, shuffle=False, steps_per_epoch=13, data=[x, y])
+        generator.ring_size = 2
+        # batches kept alive for more than ring_size batches are not overwritten
+        batches = [generator._get_batch(np.arange(i * 8, min((i + 1) * 8, 100))) for i in range(13)]
+        for i, (x_batch, y_batch) in enumerate(batches):
+            npt.assert_array_equal(x_batch[..., 0], x[i * 8:(i + 1) * 8])
+            npt.assert_array_equal(np.squeeze(y_batch), np.squeeze(y[i * 8:(i + 1) * 8]))
+        # released buffers are reused, the short last batch has its own ring buffers
+        del batches, x_batch, y_batch
+        buffers = {generator._get_batch(np.arange(8))[0].base.ctypes.data for _ in range(10)}
+        self.assertLessEqual(len(buffers), generator.ring_size)
+        # ownership is tracked by the batch, other references to the buffer (e.g. a debugger) do not matter
+        x_batch = generator._get_batch(np.arange(8))[0]
+        buffer = x_batch.base
+        del x_batch
+        self.assertIs(generator._get_batch(np.arange(8, 16))[0].base, buffer)
+        npt.assert_array_equal(buffer, x[8:16])
+        # ring buffers are sized for the workers and the queue of keras
+        generator.set_queue(workers=3, max_queue_size=4)
+        self.assertEqual(generator.ring_size, 3 + 4 + 2)
+        self.assertEqual(generator._get_batch(np.arange(96, 100))[0].shape[0], 4)
+        self.assertIn(('inputs', (8, 4)), generator._ring_buffers)
+        self.assertIn(('inputs', (4, 4)), generator._ring_buffers)
+
+        # padded batches have a fixed shape and zero sample weight for padded data
+        from astroNN.nn.utilities.generator import PaddedBatchGenerator
+        padded_generator = PaddedBatchGenerator(generator, sample_weight=True)
+        self.assertEqual(len(padded_generator), 13)
+        x_batch, y_batch, weight = padded_generator[12]
+        self.assertEqual(x_batch.shape, (8, 4, 1))
+        npt.assert_array_equal(x_batch[:4, :, 0], x[96:])
+        npt.assert_array_equal(weight, [1., 1., 1., 1., 0., 0., 0., 0.])
+        self.assertEqual(padded_generator.num_batch_data(12), 4)
+        npt.assert_array_equal(padded_generator[0][2], np.ones(8))
+
     def test_normalizer(self):
         from astroNN.nn.utilities.normalizer import Normalizer
         from astroNN.config import MAGIC_NUMBER
@@ -51,6 +250,51 @@ class UtilitiesTestCase(unittest.TestCase):
         data = np.random.normal(0, 1, (100, 10))
         npt.assert_array_almost_equal(s3_norm.denormalize(s3_norm.normalize(data)), data)
 
+        # test normalizing into float32 and in place with small blocks give the same result
+        data[magic_idx] = MAGIC_NUMBER
+        norm_data = normer.normalize(data, calc=False)
+        norm_data_32 = normer.normalize(data, calc=False, dtype=np.float32, block_size=64)
+        self.assertEqual(norm_data_32.dtype, np.float32)
+        npt.assert_array_almost_equal(norm_data_32, norm_data, decimal=5)
+        data_copy = np.array(data)
+        normer.normalize(data_copy, calc=False, out=data_copy, block_size=64)
+        npt.assert_array_almost_equal(data_copy, norm_data)
+        self.assertEqual(data_copy[magic_idx], MAGIC_NUMBER)
+        normer.denormalize(data_copy, out=data_copy, block_size=64)
+        npt.assert_array_almost_equal(data_copy, data)
+
+    def test_normalizer_fit(self):
+        from astroNN.nn.utilities.normalizer import Normalizer
+        from astroNN.config import MAGIC_NUMBER
+        import numpy as np
+
+        data = np.random.normal(1e4, 1, (1000, 10))
+        data[np.random.uniform(size=data.shape) < 0.1] = MAGIC_NUMBER
+        magic_mask = data == MAGIC_NUMBER
+
+        for mode, mean, std in [('1', np.ma.array(data, mask=magic_mask).mean(),
+                                 np.ma.array(data, mask=magic_mask).std()),
+                                ('2', np.ma.array(data, mask=magic_mask).mean(axis=0),
+                                 np.ma.array(data, mask=magic_mask).std(axis=0)),
+                                ('3', np.ma.array(data, mask=magic_mask).mean(axis=0), [1.]),
+                                ('3s', np.ma.array(data, mask=magic_mask).mean(axis=0), [1.]),
+                                ('4', [0.], np.ma.array(data, mask=magic_mask).std(axis=0))]:
+            # slicing in batches and an iterator of batches should give the same statistics
+            for fit_data in [data, (data[i:i + 64] for i in range(0, 1000, 64))]:
+                normer = Normalizer(mode=mode)
+                normer.fit(fit_data, batch_size=64)
+                npt.assert_array_almost_equal(normer.mean_labels, mean)
+                npt.assert_array_almost_equal(normer.std_labels, std)
+
+            # statistics set from those computed before normalize the same way
+            stored_normer = Normalizer(mode=mode)
+            stored_normer.set_statistics(*normer.get_statistics())
+            npt.assert_array_equal(stored_normer.normalize(data, calc=False), normer.normalize(data, calc=False))
+            if mode == '3s':
+                self.assertRaises(ValueError, normer.get_statistics, linear_only=True)
+            else:
+                npt.assert_array_equal(normer.get_statistics(linear_only=True)[1], normer.std_labels)
+
     def test_cpu_gpu_management(self):
         from astroNN.shared.nn_tools import cpu_fallback
 